@@ -38,7 +38,7 @@
 
 # ## Section I - Data Auditing
 
-# The mother of all steps is to first import all the required libraries and define the OSM filename variable.
+# The mother of all steps is to first import all the required libraries and define the OSM filename variable. The streaming functions (`audit_map()`, `process_map()`) can also read the compressed `data/singapore.osm.bz2` directly, without decompressing it to disk first.
 
 # In[23]:
 
@@ -53,6 +53,16 @@ import time
 OSMFILE = "data/singapore.osm"
 
 
+# Instead of timing cells with `time.time()`, the main steps below -- parsing, classifying the keys with `key_type()`, `shape_element()`, each of the cleaners, `json.dumps()` and the writes to MongoDB -- are timed by a `Profiler` (see `osm_profile.py`). Set `PROFILE = True` to get the calls, elements and seconds of every stage and the slowest cleaners with `print(profiler)` or `profiler.report()`. When it is off, the functions are not wrapped at all, so the import runs at full speed.
+
+# In[ ]:
+
+from osm_profile import Profiler
+
+PROFILE = False
+profiler = Profiler(enabled=PROFILE)
+
+
 # To have an overview understanding of the XML file, we will start by analyzing the types and occurences of elements in the XML file. This allows us to understand what are the important elements to focus on and what are the relationships among those elements.
 # 
 # The function **`count_tags()`** receives an input of a dataset filename and returns a dictionary with the element name as the key and its number of occurence as the value.
@@ -189,24 +199,30 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 def key_type(element, keys):
     if element.tag == "tag":
         if problemchars.search(element.attrib['k']):
-            keys['problemchars'].append(element.attrib['k'])       
+            keys.add('problemchars', element.attrib['k'])
         elif lower_colon.search(element.attrib['k']):
-            keys['lower_colon'].append(element.attrib['k'])
+            keys.add('lower_colon', element.attrib['k'])
         elif lower_two_colon.search(element.attrib['k']):
-            keys['lower_two_colon'].append(element.attrib['k'])
+            keys.add('lower_two_colon', element.attrib['k'])
         elif lower.search(element.attrib['k']):
-            keys['lower'].append(element.attrib['k'])
+            keys.add('lower', element.attrib['k'])
         else:
-            keys['other'] .append(element.attrib['k'])          
+            keys.add('other', element.attrib['k'])
     return keys
 
 
+# The function **`process_map(filename)`** classifies every 'k' attribute of the file. Instead of keeping every key in a list, a `KeyTypes` object (see `osm_audit.py`) counts the keys of each class and of each distinct key, and keeps only the first 20 keys of each class as examples, while `iter_elements()` clears the parsed tags. The audit thus runs in the same memory however big the file is.
+
 # In[ ]:
 
+from osm_audit import KeyTypes
+from osm_utils import iter_elements
+
 def process_map(filename):
-    keys = {"lower": [], "lower_colon": [], "lower_two_colon": [],"problemchars": [], "other": []}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    keys = KeyTypes(exemplars=20)
+    classify = profiler.wrap("classify", key_type)
+    for element in profiler.iterate("parse", iter_elements(filename, tags=("tag",))):
+        keys = classify(element, keys)
     return keys
 
 
@@ -214,7 +230,7 @@ def process_map(filename):
 
 start_time = time.time()
 keys = process_map(OSMFILE)
-sorted_by_occurrence = [(key,len(keys[key])) for key in sorted(keys, key=lambda k:len(keys[k]), reverse=True) ]
+sorted_by_occurrence = keys.sorted_by_occurrence()
 
 print 'Keys and occurrence in singapore.osm:\n'
 pprint.pprint(sorted_by_occurrence)
@@ -228,27 +244,27 @@ print('\n--- %s seconds ---' % (time.time() - start_time))
 
 # In[22]:
 
-print(keys['lower'][:20])
+print(keys.exemplars['lower'])
 
 
 # In[17]:
 
-print(keys['lower_colon'][:20])
+print(keys.exemplars['lower_colon'])
 
 
 # In[18]:
 
-print(keys['lower_two_colon'][:20])
+print(keys.exemplars['lower_two_colon'])
 
 
 # In[19]:
 
-print(keys['other'][:20])
+print(keys.exemplars['other'])
 
 
 # In[24]:
 
-print(keys['problemchars'])
+print(keys.most_common('problemchars'))
 
 
 # From the results above, we can see that:
@@ -267,6 +283,30 @@ print(keys['problemchars'])
 # 
 # To standardize those interesting formats, it will take lots of time and probably also high-level regex skills. As such, we will not be touching on it in this project.
 
+# Each of the audit functions above reads the whole OSM file again, and `count_tags()` even loads the full tree into memory. For large extracts, the function **`audit_map()`** in `osm_audit.py` computes the element, attribute and key counts as well as the key format classes in a single streaming pass, and reports the throughput and peak memory of the run.
+
+# In[ ]:
+
+from osm_audit import audit_map
+
+report = audit_map(OSMFILE)
+
+print 'Element tags and occurrences of Singapore.osm:\n'
+pprint.pprint(report.sorted_by_occurrence(report.tags))
+print '\nKeys and occurrence in singapore.osm:\n'
+pprint.pprint(report.sorted_by_occurrence(report.key_types))
+
+print('\n' + str(report))
+
+
+# **`expat_audit()`** from `osm_expat.py` gives exactly the same report, but counts straight from the start tag callbacks of the expat parser instead of building an `Element` for every `<tag>` and `<nd>`, which makes it about 1.5 times faster. Running it here would only read the file once more; `python osm_expat.py data/singapore.osm` runs both audits and checks that their counts agree.
+
+
+# The same audit can be spread over all CPU cores with **`parallel_audit()`** from `osm_parallel.py`, which parses byte ranges of the file in a process pool and sums up the counts. For a city extract one pass is quick enough; `python osm_parallel.py data/singapore.osm` times it against `audit_map()`.
+
+
+# When only the share of each key format class is needed, **`approximate_audit()`** from `osm_sample.py` estimates it from a random sample of byte ranges of the file (say 5% of them) and reports a 95% confidence interval for each class, in a fraction of the time of a full audit. The full audit above already has the exact shares, so the estimate is left to `python osm_sample.py data/singapore.osm 0.05`.
+
 # ## Section II: Problems in the OSM File and Writing Dataset to Database
 
 # Besides auditing the elements, attributes, and keys, we also need to analyze the contents of the 'key' element, in which there may be some inconsistent / unstandardized data format.
@@ -278,263 +318,287 @@ print(keys['problemchars'])
 # - Unstandardized **phone numbers**
 # - Invalid **postal codes** (Singapore postal codes should be 6 digits)
 # - Names in **other languages**, such as in Chinese, Malay, or even Korean
+# 
+# The subset is made by **`sample_osm()`** from `osm_sample.py` in a single pass over the file. It keeps every 100th node, way and relation (or, with `method="reservoir"`, a fixed number of each), plus every node used by one of the sampled ways, so the sample is a valid OSM file that the functions below can run on in seconds while the cleaning rules are worked out. Making it is one more pass over the whole extract, so it is only written when `SAMPLE = True`; once written, it stays in `SAMPLEFILE` for the next runs.
 
-# The regular expressions below are used to check on some of the aforementioned issues:
-# - phone_re: to check for unstandardized phone numbers
-# - housenumber_re: to check for unstandardized house numbers
-# - postcode_re: to check for invalid postal codes
+# In[ ]:
 
-# In[25]:
+from osm_sample import sample_osm
 
-phone_re = re.compile(r'(60|65|\+60|\+65)?\D?(\d{4})\D?(\d{4})', re.IGNORECASE)
-housenumber_re = re.compile(r'(\d+[a-z]?|#?\d{2}-\d{2}|blk \d+)', re.IGNORECASE)
-postcode_re = re.compile(r'^\d{6}$')
+SAMPLE = False
+SAMPLEFILE = "data/sample.osm"
 
+if SAMPLE:
+    print(sample_osm(OSMFILE, SAMPLEFILE, rate=0.01, seed=1))
 
+# The cleaning code below lives in `osm_shape.py`, so that the benchmarks, the tests and the worker processes can import it without running this whole analysis.
+# 
+# The regular expressions below are used to check on some of the aforementioned issues:
+# - phone_re: to check for unstandardized phone numbers
+# - housenumber_re: to check for unstandardized house numbers
+# - postcode_re: to check for invalid postal codes
+# 
 # We define the variables below for data cleaning and transformation:
 # - CREATED: for transformation of XML to JSON. This variables holds the key for the JSON data structure.
 # - expected: for the expected content of street/ address element. This will be used to check whether there is any strange or inconsistent street / address element
 # - mapping: dictionary for mapping out invalid/ inconsistent street element
+# 
+# Street names, postal codes and phone numbers of chain stores repeat a lot, so the cleaners below are memoized with a bounded LRU cache of `CACHE_SIZE` values (see `osm_cache.py`). `cleanName.cache_info()` shows the hits, misses and evictions of a cleaner. Values that cannot be cleaned are collected in `exceptions` instead of being printed one by one.
+# 
+# The function **`cleanName(name)`** checks for unstandardized address element according to the 'mapping' dictionary as defined above. All the 'mapping' keys are compiled into a single regex with word boundaries, so a name is scanned once instead of once per key, and a key inside a longer word (e.g. 'Ave' in 'Avenue') is left alone.
+# 
+# The function **`cleanPhoneNumber(phone_number)`** checks for unstandardized phone numbers. This is done with adding the country code (+65) to the phone numbers, as well as by using regex 'phone_re' to check for invalid phone number format.
+# 
+# The function **`cleanHouseNumber(house_number)`** checks for unstandardized house numbers. This is done by using regex to check whether the house has any block numbers, and also the consistency of the unit number formatting.
+# 
+# The function **`cleanPostCode(postcode)`** checks for unstandardized postal codes. This is done by using regex to check whether the value of the postal codes are 6 characters long.
 
-# In[26]:
-
-#Variables for data cleaning and data transformation
+# In[25]:
 
-#for the creation information
-CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
+from osm_shape import phone_re, housenumber_re, postcode_re, CREATED, expected, mapping
+from osm_shape import CACHE_SIZE, exceptions
+from osm_shape import cleanName, cleanPhoneNumber, cleanHouseNumber, cleanPostCode
 
-#expected content of address element
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons", "Way", "Walk", "View", "Valley", "Green", "Crescent", "Terrace", "road"]
 
-#dictionary for mapping out invalid/ unstandardized street element
-mapping = { 
-            "Ave": "Avenue",
-            "Rd." : "Road",
-            "Rd" : "Road",
-            "Jl." : "Jalan ",
-            "Jl" : "Jalan",
-            "Jln" : "Jalan",
-            "Btk" : "Butik",
-            "Upp" : "Upper"
-            }
+# The rules in `osm_shape.py` decide what happens to each 'k' attribute (see `tag_rules.py`):
+# - keys with problematic characters are skipped
+# - 'addr:city', 'is_in:country' and 'addr:country' reject areas outside Singapore (Malaysia or Indonesia)
+# - street names, names, phone numbers, house numbers and postal codes have their own cleaner
+# - names in other languages and alternate names go to 'names', address tags go to 'address'
+# 
+# The rules are compiled into a dispatch table keyed on the 'k' attribute, so the checks run once per distinct key instead of once per tag. `rules.report()` lists how often each rule fired and, with `rules.timed = True`, how much time each cleaner took.
+# 
+# The function **`cleanValue(tag)`** cleans the value of a tag with the cleaner of its 'k' attribute, e.g. checking that postal codes are 6 characters long, and the function **`inSingapore(tag)`** checks whether an area is within the Singapore city.
 
+# In[32]:
 
-# The function **`cleanName(name)`** checks for unstandardized address element according to the 'mapping' dictionary as defined above.
+from osm_shape import rules, cleanValue, inSingapore
 
-# In[27]:
+#time every cleaner as a 'clean.<name>' stage of the profiler
+rules.profile(profiler)
 
-# transforms unstandardized address element
-def cleanName(name):
-    for key,val in mapping.iteritems():
-        name = re.sub(key,val, name) #if 'name' matches with 'key', substitute it with 'val'
- 
-    return name
 
+# Most nodes from Johor Bahru and Batam have no 'addr:city' or 'addr:country' tag, so `inSingapore()` lets them through. A **`Geofence`** (see `osm_geofence.py`) checks the position of each node against the boundary polygon of Singapore, read from the local file `GEOFENCE` (an Osmosis `.poly` file or GeoJSON). A grid over the polygon marks each cell as inside, outside or on the boundary beforehand, so only nodes in boundary cells need an exact point in polygon test, and tens of millions of nodes can be checked per minute.
 
-# The function **`cleanPhoneNumber(phone_number)`** checks for unstandardized phone numbers. This is done with adding the country code (+65) to the phone numbers, as well as by using regex 'phone_re' to check for invalid phone number format.
+# In[ ]:
 
-# In[28]:
+from osm_geofence import Geofence, inside_fence
 
-#transforms unstandardized phone numbers
-def cleanPhoneNumber(phone_number):
-    
-    #print phone_number
-    if not phone_number:
-        return 	
+GEOFENCE = "data/singapore.poly"
 
-    phone_number = phone_number.replace(" ", "")
-    phone_number = phone_number.replace("-", "")
-    if len(phone_number) == 8 :
-        phone_number = "+65" + phone_number 
 
-    m = phone_re.search(phone_number)
-    if not m:
-        print "EXCEPTION phone Number: " +phone_number    
-        return None
-    else:
-        return m.group()
+# The function **`shape_element(element)`** in `osm_shape.py` transforms OSM XML to the desired JSON format to be exported to MongoDB.
 
+# In[83]:
 
-# The function **`cleanHouseNumber(house_number)`** checks for unstandardized house numbers. This is done by using regex to check whether the house has any block numbers, and also the consistency of the unit number formatting.
+from osm_shape import shape_element, collect_stats, merge_stats
 
-# In[29]:
-
-#transforms unstandardized house numbers
-def cleanHouseNumber(house_number):
-    
-    #print house
-    if not house_number:
-        return
-    
-    m = housenumber_re.search(house_number)
-    if not m:
-        print "EXCEPTION House Number: " +house_number
-        return None
-    else:
-        return m.group()
 
+# The function **`process_map(file_in, pretty=False)`** write the transformed JSON data to MongoDB. The shaped documents are streamed from `shape_map()` and written to MongoDB in fixed-size unordered batches by `load_documents()` (see `osm_loader.py`), so the memory used stays flat no matter how big the OSM file is.
+# 
+# With `columns=True`, the same documents are also written column by column to `<file>.columns/` by `ColumnWriter` (see `osm_columns.py`): typed arrays for the id, type, position and creation fields, and dictionary-encoded columns for the tags. An analysis can then memory-map just the columns it needs with `load_columns()` instead of parsing the whole JSON file; tag columns are named `tags/<field>` (e.g. `tags/amenity`), so a tag called `lat` or `id` does not hide the column of the same name.
+# 
+# With `processes` set, the file is split into byte ranges that are parsed and shaped in a process pool by `parallel_shape()` (see `osm_parallel.py`). The documents still come out in the same order as in the serial run. The cleaners run in the worker processes, so `collect_stats()` sends the `exceptions`, the cache counters and the rule hits of each range back with its documents, and `merge_stats()` adds them to those of this process. The cache sizes shown by `cache_info()` are still those of this process.
+# 
+# With `geometry=True`, the node positions are kept in a `NodeStore` (see `osm_nodes.py`): sorted int64 ids and float coordinate arrays searched by binary search. Every way then gets a `centroid`, `bbox` and `length` (in meters) computed from its node_refs. In the serial run the store is filled in the same pass, because the nodes come before the ways in the file; with `processes` it is built by a quick pass over the nodes first.
+# 
+# For extracts too big for the node positions to fit in memory, `join_memory_mb` switches to the out-of-core join of `join_map()` (see `osm_join.py`): the nodes and the node refs are spilled to sorted runs on disk and merge-joined within that many megabytes. Ways then also get their `geometry` (the list of their points), and relations, which `shape_element()` skips, are written with the positions of their node members and the geometry of their way members. Their tags go through the same `rules` as those of the nodes and ways, so their names and addresses are cleaned and flattened the same way (their `type` tag goes to `relation_type`), and the relations that `inSingapore()` rejects are left out. The join replaces the pool of `processes`, so the two cannot be combined, and it always adds the geometry.
+# 
+# With `geofence=True`, nodes (and, with `geometry=True`, ways) that lie outside the `GEOFENCE` polygon are dropped by `inside_fence()` before they are written.
+# 
+# With `compression="gzip"` (or `"zstd"`, which needs the `zstandard` module), the JSON output goes to `<file>.json.gz` (or `.json.zst`) through a **`JSONLinesWriter`** (see `osm_jsonl.py`) instead: the documents are written in blocks of a few megabytes, each compressed on a thread pool, and without `pretty` they are encoded with `orjson` when it is installed. `read_json_lines()` reads such a file (or a plain one) back document by document, and `LocalCollection` reads compressed files too.
+# 
+# With `checkpoint=True`, the documents are loaded by **`checkpointed_load()`** from `osm_checkpoint.py`, which saves a checkpoint to `<file>.checkpoint` before the first document and then every 100000 documents: the byte offset and id of the element of the last document written, the number of documents and the length of the JSON output, with the summaries so far. If the import is interrupted, `process_map(file_in, resume=True)` starts again from the element after the checkpoint, cuts the JSON file back to the recorded length, and upserts the documents that the interrupted run may already have inserted after its checkpoint instead of inserting them twice. This works for the serial `shape_map()` run only (with or without `geofence` and `compression`), since the other options keep state across the whole file.
+# 
+# With `name_index=True`, every `name` and every value of `names` (the names in other languages and the alternate name) is also added to a **`NameIndexBuilder`** (see `osm_names.py`), which is saved to `<file>.names` at the end: the names, normalized (case-folded, without accents and punctuation), as a sorted array pointing to the ids of the elements. A resumed run builds it from the JSON output instead, which holds the documents of both runs.
+# 
+# With `expat=True` (without `processes`, `geometry` or `join_memory_mb`), the documents are built by **`expat_shape_map()`** from `osm_expat.py` straight from the expat parser callbacks, with the same `rules` and `CREATED` fields as `shape_element()`. The documents are identical, so any change to `shape_element()` has to be made there too; `python -m unittest test_osm_expat` checks that both give the same documents for a generated file.
+# 
+# With `pipelined=True`, the documents are written by **`pipeline_load()`** from `osm_pipeline.py` instead: `json.dumps()`, the writes to the JSON file and the inserts into MongoDB each run on a thread of their own, connected by bounded queues, so the disk and database I/O overlap with the parsing. When the writes cannot keep up, the full queues hold the parser back, and an error in any of the threads stops the whole pipeline and is raised by `process_map()`.
+# 
+# Options that would make `process_map()` silently ignore another one, such as `expat` with `processes`, raise a `ValueError` instead.
+# 
+# While the documents are loaded, the counts needed in Section III (documents per type, per user, per amenity, per religion of places of worship and per cuisine of restaurants) are kept in a `Summaries` object (see `osm_summary.py`). They are written to the `singaporeOSM_summaries` collection and to `<file>.summaries.json`, so those questions can be answered without scanning the whole collection again.
 
-# The function **`cleanPostCode(postcode)`** checks for unstandardized postal codes. This is done by using regex to check whether the value of the postal codes are 6 characters long.
+# In[84]:
 
-# In[30]:
-
-def cleanPostCode(postcode):
-    
-    if not postcode:
-        return None
-    
-    m = postcode_re.search(postcode.strip())
-    if not m:
-        print "EXCEPTION postcode: " +postcode
-        return None
+from osm_loader import shape_map, load_documents
+from osm_parallel import parallel_shape
+from osm_columns import ColumnWriter
+from osm_nodes import NodeStore, with_geometry, add_geometry
+from osm_join import join_map
+from osm_summary import Summaries
+from osm_pipeline import pipeline_load
+from osm_expat import expat_shape_map
+from osm_jsonl import JSONLinesWriter, SUFFIXES
+from osm_checkpoint import Checkpoint, ResumableSource, checkpointed_load, reopen_output
+from osm_jsonl import read_json_lines
+from osm_names import NameIndexBuilder
+
+def process_map(file_in, pretty=False, batch_size=1000, write_concern=None, processes=None,
+                columns=False, geometry=False, join_memory_mb=None, pipelined=False, expat=False,
+                geofence=False, compression=None, checkpoint=False, resume=False,
+                name_index=False):
+    file_out = "{0}.json".format(re.sub(r'\.(bz2|gz)$', '', file_in))
+    columns_out = ColumnWriter(file_out[:-len(".json")] + ".columns") if columns else None
+    client = MongoClient()
+    db = client.final_project
+    collection = db.singaporeOSM
+    summaries = Summaries()
+    names_out = NameIndexBuilder() if name_index else None
+    #the profiler times shape_element() apart from parsing, except in the worker processes
+    shape = profiler.wrap("shape", shape_element)
+    dumps = profiler.wrap("serialize", json.dumps)
+
+    #the documents come from one source; refuse the options it would ignore
+    checkpoint = checkpoint or resume
+    if checkpoint and (processes or geometry or join_memory_mb or expat or pipelined or columns):
+        raise ValueError("checkpoints only work with the serial shape_map() run")
+    if join_memory_mb and (processes or expat):
+        raise ValueError("join_memory_mb cannot be combined with processes or expat")
+    if expat and (processes or geometry):
+        raise ValueError("expat cannot be combined with processes or geometry")
+    checkpoint_file = file_out[:-len(".json")] + ".checkpoint"
+    #resuming without a checkpoint starts from the beginning
+    resumed = Checkpoint.load(checkpoint_file) if resume else None
+    if resumed:
+        summaries = Summaries.from_documents(resumed.state["summaries"])
+    output_offset = resumed.output_offset if resumed else None
+
+    if compression:
+        fo = JSONLinesWriter(file_out + SUFFIXES[compression], compression=compression,
+                             pretty=pretty, offset=output_offset)
+        write_document = profiler.wrap("serialize", fo.write_document)
+    elif resumed:
+        fo = reopen_output(file_out, output_offset)
     else:
-        return m.group()
-
-
-# The function **`cleanValue(tag)`** checks for unstandardized postal codes. This is done by using regex to check whether the value of the postal codes are 6 characters long.
-
-# In[31]:
-
-def cleanValue(tag):
-    #print ":D"
-     
-    if is_streetName_or_name(tag):
-        return cleanName(tag.attrib['v'])
-    elif is_phone_number(tag):
-        return cleanPhoneNumber(tag.attrib['v'])
-    elif is_house_number(tag):
-        return cleanHouseNumber(tag.attrib['v'])                    
-    elif tag.attrib['k'] == "addr:postcode":
-        return cleanPostCode(tag.attrib['v'])  
+        fo = codecs.open(file_out, "w")
+
+    with fo:
+        if checkpoint:
+            source = ResumableSource(file_in, shape, resumed)
+            documents = source
+        elif join_memory_mb:
+            documents = join_map(file_in, shape, rules, CREATED, memory_mb=join_memory_mb)
+        elif processes:
+            documents = parallel_shape(file_in, shape_element, processes=processes,
+                                       collect=collect_stats, merge=merge_stats)
+            if geometry:
+                documents = add_geometry(documents, NodeStore.from_osm(file_in))
+        elif geometry:
+            documents = shape_map(file_in, with_geometry(shape, NodeStore()))
+        elif expat:
+            documents = expat_shape_map(file_in, rules, CREATED)
+        else:
+            documents = shape_map(file_in, shape)
+        if geofence:
+            documents = inside_fence(documents, Geofence.from_file(GEOFENCE))
+        documents = profiler.iterate("parse", documents)
+
+        def shaped():
+            for el in documents:
+                #the pipeline serializes and writes the file on its own threads
+                if not pipelined:
+                    if compression:
+                        write_document(el)
+                    elif pretty:
+                        fo.write(dumps(el, indent=2)+"\n")
+                    else:
+                        fo.write(dumps(el) + "\n")
+                if columns_out:
+                    columns_out.write(el)
+                if names_out is not None:
+                    names_out.add(el)
+                summaries.add(el)
+                yield el
+
+        if checkpoint:
+            def save_summaries(saved):
+                saved.state["summaries"] = summaries.to_documents()
+            stats = checkpointed_load(source, collection, checkpoint_file, documents=shaped(),
+                                      output=fo, batch_size=batch_size,
+                                      write_concern=write_concern,
+                                      on_checkpoint=save_summaries)
+        elif pipelined:
+            stats = pipeline_load(shaped(), fo, collection, batch_size=batch_size,
+                                  write_concern=write_concern, pretty=pretty)
+            profiler.add("serialize", stats.serialize_seconds, calls=stats.batches,
+                         items=stats.documents)
+        else:
+            #write into mongodb batch by batch
+            stats = load_documents(shaped(), collection, batch_size=batch_size,
+                                   write_concern=write_concern)
+        profiler.add("write", stats.write_seconds, calls=stats.batches, items=stats.documents)
 
+    if columns_out:
+        columns_out.close()
+    if names_out is not None:
+        if resumed:
+            #the documents of the interrupted run are only in the JSON file
+            names_out = NameIndexBuilder.from_documents(
+                read_json_lines(file_out + SUFFIXES[compression] if compression else file_out))
+        names_out.save(file_out[:-len(".json")] + ".names")
+    summaries.save(file_out[:-len(".json")] + ".summaries.json")
+    summaries.save_to(db.singaporeOSM_summaries)
 
-# The functions below check 'k' attributes to see which 'k' types (e.g. street, phone) it belongs to.
+    print(stats)
+    return stats
 
-# In[32]:
 
-#check for the value of 'k' attributes
-def is_streetName_or_name(elem):
-    return (elem.attrib['k'] == "addr:street" or elem.attrib['k'] == "name")
-def is_phone_number(elem):
-    return (elem.attrib['k'] == "phone")
-def is_house_number(elem):
-    return (elem.attrib['k'] == "addr:housenumber")	
-def is_source(elem):
-    return (elem.attrib['k'] == "source")
+# Once all the documents are loaded, **`build_indexes()`** from `osm_indexes.py` creates the indexes used by the queries of Section III (`type`, `amenity`, `created.user`, `amenity` with `cuisine` or `religion`) and a 2d index on `pos`. Building them after the bulk load is much cheaper than updating them on every insert. `python osm_indexes.py` times the Section III queries with and without these indexes.
 
+# In[85]:
 
-# The function **`inSingapore(tag)`** checks whether an area is within the Singapore city.
+from osm_indexes import build_indexes
 
-# In[33]:
+def run():
+    process_map(OSMFILE, name_index=True)
+    build_indexes(MongoClient().final_project.singaporeOSM)
 
-def inSingapore(tag):
-    
-    if tag.get('k') == "addr:city" and tag.get('v') != 'Singapore':
-        return False
-    if tag.get('k') == "is_in:country" and tag.get('v') != 'Singapore'    :
-        return False
-    if tag.get('k') == "addr:country" and tag.get('v') != 'SG'    :
-        return False        
+    #values that could not be cleaned, and how well the cleaner caches did
+    print(exceptions)
+    for cleaner in (cleanName, cleanPhoneNumber, cleanHouseNumber, cleanPostCode):
+        print('%s: %s' % (cleaner.__name__, cleaner.cache_info()))
 
-    return True
+    #where the time went, when PROFILE is on
+    if profiler.enabled:
+        print(profiler)
+        profiler.save("data/profile.json")
 
 
-# The function **`shape_element(element)`** transforms OSM XML to the desired JSON format to be exported to MongoDB.
+# In[86]:
 
-# In[83]:
+run()
 
-def shape_element(element):
-    node = {}
-    if  element.tag == "node" or element.tag == "way" :
-        # YOUR CODE HERE
-        node['id'] =  element.get('id')
-        node['type'] =  element.tag 
-        node['visible'] =  "true"
-        node['names']={}
-        node['address'] = {}
-        node['node_refs'] =[]
-        node['created']={}
-        
-        #get the element based on the key in CREATED dict
-        for c in CREATED:
-            node['created'][c] = element.get(c)
-        
-        #get the lat and long position
-        if element.get('lat') and element.get('lon'):
-            node['pos'] = [float(element.get('lat')),float(element.get('lon'))]
-        
-        #processing 'tag' children element
-        for tag in element.iter('tag'):
-            if not tag.get('k') or problemchars.search(tag.get('k')):
-                continue
-                
-            #excluding areas belonging to Malaysia or Indonesia    
-            if not inSingapore(tag) :
-                return None
-                
-            tagKey = tag.get('k')
-            #check for invalid tag that starts with a colon
-            if tagKey.startswith(':'): 
-                tagKey = tagKey[1:]           
-            
-            if tagKey.startswith('name:'): #check for names in other languages: zh, ms, en, in
-                node['names'][tagKey[5:]] = tag.get('v')
-            elif tagKey.startswith('alt_name:'): #check for the alternate name of an amenity
-                node['names']['alt'] = tag.get('v')
-            elif tagKey == 'name': #name of an amenity
-                node['name'] = cleanValue(tag)               
-            elif tagKey.startswith('addr:'): #address tag
-                node['address'][tagKey[5:]] = cleanValue(tag)                            
-            else:
-                node[tagKey] = tag.get('v')	
-                        
-        #processing 'nd' children element under 'way' element
-        for tag in element.iter('nd'):
-            node['node_refs'].append(tag.get('ref'))
-
-        return node 
-    else:
-        return None
 
+# To keep the database up to date, there is no need to run `run()` on a full extract again. The function **`update(change_file)`** applies an OsmChange file (e.g. a daily diff of Singapore) to the collection with **`apply_changes()`** from `osm_delta.py`: created and modified elements go through `shape_element()` and are upserted, deleted elements are removed, and an element is only written if its version is newer than the one in the database. The summaries in `singaporeOSM_summaries` are updated with the same changes.
 
-# The function **`process_map(file_in, pretty=False)`** write the transformed JSON data to MongoDB
+# In[ ]:
 
-# In[84]:
+from osm_delta import apply_changes
 
-def process_map(file_in, pretty=False):
-    file_out = "{0}.json".format(file_in)
-    data = []
+def update(change_file):
     client = MongoClient()
     db = client.final_project
-    collection = db.singaporeOSM
-    
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            
-            el = shape_element(element)
-            if el:
-                data.append(el)
+    summaries = Summaries.load_from(db.singaporeOSM_summaries)
+    stats = apply_changes(change_file, shape_element, db.singaporeOSM, summaries=summaries)
+    summaries.save_to(db.singaporeOSM_summaries)
+    print(stats)
+    return stats
 
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-                    
-    collection.insert_many(data)    #write into mongodb    
-    
-    return data
 
+# When the shaped documents of the whole city are needed in memory at once (e.g. to analyze them without MongoDB), a list of dicts takes over a kilobyte per node and a few per way. **`compact()`** from `osm_record.py` wraps `shape_element()` to return `OSMRecord`s instead: objects with `__slots__`, ids, versions and timestamps as integers, interned keys, users and short values, and the node_refs in an int64 array. A record is turned back into the same document only when it is written out, with `to_dict()` or `to_json()`. Nothing in this analysis needs the whole city in memory, so `memory_report()` only compares both on the first 100000 documents.
 
-# In[85]:
+# In[ ]:
 
-def run():
-    process_map(OSMFILE)
+from itertools import islice
+from osm_record import memory_report
 
+dict_bytes, record_bytes = memory_report(list(islice(shape_map(OSMFILE, shape_element), 100000)))
+print('100000 documents: %.1f MB as dicts, %.1f MB as records' % (dict_bytes / 1e6, record_bytes / 1e6))
 
-# In[86]:
 
-run()
+# To measure the speed of the functions above in a repeatable way (instead of the `time.time()` prints), `osm_bench.py` generates a synthetic OSM file shaped like the Singapore extract, with a configurable number of nodes, ways per node, tag density and rates of dirty phone numbers and postal codes. **`run_benchmarks()`** then runs every stage (parsing, auditing, `shape_element()`, `json.dumps()` and, with a MongoDB collection, the batched inserts of `process_map()`) in a process of its own and saves the elements/sec and peak memory of each stage to a JSON file. This takes minutes and a few hundred MB of disk, so it is not run here but from the command line: `python osm_bench.py generate data/synthetic.osm --nodes 1000000`, then `python osm_bench.py run data/synthetic.osm --out data/benchmark.json --mongo bench.singaporeOSM` (which imports `shape_element()` from `osm_shape.py`), and `python osm_bench.py compare old.json new.json` to compare two result files.
 
 
 # ## Section III: Overview of the Dataset
@@ -625,6 +689,55 @@ pprint.pprint(list(result))
 
 # Interestingly, Japanese cuisines seems to be popular in Singapore.
 
+# The same queries can also be run without a MongoDB server. **`LocalCollection`** from `osm_aggregate.py` streams the `data/singapore.osm.json` file written by `process_map()` and runs `count()`, `distinct()` and the `$match`/`$group`/`$sort`/`$limit` pipelines above on it, with hash aggregation for `$group` and a heap for `$sort` followed by `$limit`. `python osm_aggregate.py data/singapore.osm.json --mongo` times every query above on both and checks that they give the same results.
+
+# In[ ]:
+
+from osm_aggregate import LocalCollection
+
+local = LocalCollection("data/singapore.osm.json")
+
+print(local.count())
+print(local.count({"type":"node"}))
+print(len(local.distinct("created.user")))
+
+#top 10 popular cuisine types, from the JSON file
+pprint.pprint(local.aggregate(pipeline))
+
+
+# The summaries kept up to date by `process_map()` and `update()` answer the same questions straight away, without going through the documents at all:
+
+# In[ ]:
+
+summaries = Summaries.load_from(db.singaporeOSM_summaries)
+
+print(summaries.documents)
+print(summaries.count("type", "node"))
+print(summaries.distinct("created.user"))
+pprint.pprint(summaries.top("created.user", 5))
+pprint.pprint(summaries.users_by_posts()[:1])
+pprint.pprint(summaries.top("amenity", 10))
+pprint.pprint(summaries.top("religion"))
+pprint.pprint(summaries.top("cuisine", 10))
+
+
+# Looking an element up by name in MongoDB takes a regex scan over the whole collection, and a different one for every language. The name index saved by `process_map(name_index=True)` answers exact and prefix lookups over all the names and their translations in microseconds instead: **`NameIndex`** from `osm_names.py` memory-maps `data/singapore.osm.names` on its first lookup and binary-searches the normalized names, so "ION Orchard", "ion orchard" and "Ion-Orchard" are the same name. `python osm_names.py data/singapore.osm.names` times the lookups.
+
+# In[ ]:
+
+from osm_names import NameIndex
+
+names = NameIndex("data/singapore.osm.names")
+
+#elements named Marina Bay Sands, and the names starting with 'orchard'
+print(names.exact("Marina Bay Sands"))
+print(names.completions("orchard", 10))
+
+#the first elements whose name, in any language, starts with 'ion orch'
+for element_type, element_id in names.prefix("ion orch", limit=5):
+    pprint.pprint(collection.find_one({"type": element_type, "id": element_id},
+                                      {"name": 1, "names": 1}))
+
 # ## Section IV: Further Exploration
 
 # ### Information appearing in arbitrary field that is not expected
@@ -640,6 +753,21 @@ pprint.pprint(list(result))
 # - Property pricing exploration: which factors (distance to train station, schools, shopping malls) correlate to property prices? Of course, we will need to merge with additional data sources to get property prices.
 # 
 # All this can be implemented with [Turf.js](http://turfjs.org/) and [Leaflet](http://leafletjs.com/), and it can potentially become a very serious and long-term project.
+#
+# The first two questions can already be answered in Python with **`GridIndex`** from `osm_spatial.py`, an in-memory grid index bulk loaded from the `pos` of every node. It answers radius, bounding box and nearest-neighbour queries, optionally only for one tag such as `amenity=restaurant`, without scanning all the nodes (`python osm_spatial.py` benchmarks it against a linear scan).
+
+# In[ ]:
+
+from osm_spatial import GridIndex
+
+nodes = GridIndex.from_documents(collection.find({"type":"node", "pos":{"$exists":1}}))
+
+#restaurants within 500 meter of Marina Bay Sands, and the 5 nearest ones
+marina_bay_sands = (1.2834, 103.8607)
+print(len(nodes.within_radius(marina_bay_sands[0], marina_bay_sands[1], 500,
+                              tag=("amenity", "restaurant"))))
+pprint.pprint(nodes.nearest(marina_bay_sands[0], marina_bay_sands[1], k=5,
+                            tag=("amenity", "restaurant")))
 
 # ## References
 
@@ -0,0 +1,504 @@
+#!/usr/bin/python
+
+"""
+    Mongo-free aggregation over the JSON output of process_map().
+
+    The Section III queries need a running MongoDB server. LocalCollection
+    runs the same queries and $match / $group / $sort / $limit pipelines
+    in a streaming pass over data/singapore.osm.json:
+
+    local = LocalCollection("data/singapore.osm.json")
+    local.count({"type": "node"})
+    len(local.distinct("created.user"))
+    local.aggregate([{"$group": {"_id": "$created.user", "count": {"$sum": 1}}},
+                     {"$sort": {"count": -1}}, {"$limit": 5}])
+
+    $match is compiled to a predicate once, $group is a hash aggregation
+    (one dict entry per group, so memory grows with the number of
+    groups, not of documents) and a $sort followed by a $limit keeps only
+    the top k documents in a heap. Values sort in MongoDB's type order
+    (null, numbers, strings, objects, arrays, booleans), a missing field
+    sorts as null, and documents that tie on the sort keys keep the order
+    in which their groups were first seen (MongoDB leaves that order
+    unspecified).
+
+    Run this module to time the Section III pipelines, and to compare them
+    with MongoDB when pymongo and a local mongod are available:
+
+    python osm_aggregate.py data/singapore.osm.json [--mongo]
+"""
+
+import heapq
+import json
+import numbers
+import operator
+import re
+import sys
+
+try:
+    from pymongo import MongoClient
+except ImportError:
+    MongoClient = None
+
+from osm_jsonl import read_json_lines
+from osm_utils import clock, string_types
+
+
+# the pipelines of Section III of the wrangling script
+SECTION_III_PIPELINES = [
+    ("top 5 users",
+     [{"$group": {"_id": "$created.user", "count": {"$sum": 1}}},
+      {"$sort": {"count": -1}}, {"$limit": 5}]),
+    ("users that posted once",
+     [{"$group": {"_id": "$created.user", "count": {"$sum": 1}}},
+      {"$group": {"_id": "$count", "num_users": {"$sum": 1}}},
+      {"$sort": {"_id": 1}}, {"$limit": 1}]),
+    ("top 10 amenities",
+     [{"$match": {"amenity": {"$exists": 1}}},
+      {"$group": {"_id": "$amenity", "count": {"$sum": 1}}},
+      {"$sort": {"count": -1}}, {"$limit": 10}]),
+    ("religions",
+     [{"$match": {"amenity": "place_of_worship"}},
+      {"$group": {"_id": "$religion", "count": {"$sum": 1}}},
+      {"$sort": {"count": -1}}]),
+    ("top 10 cuisines",
+     [{"$match": {"amenity": "restaurant"}},
+      {"$group": {"_id": "$cuisine", "count": {"$sum": 1}}},
+      {"$sort": {"count": -1}}, {"$limit": 10}]),
+]
+
+_MISSING = object()
+
+_ORDER_OPERATORS = {"$gt": operator.gt, "$gte": operator.ge,
+                    "$lt": operator.lt, "$lte": operator.le}
+
+
+def read_documents(filename):
+    """ yield the documents of a process_map() output file, written with
+        or without pretty=True, plain or .gz / .zst compressed
+    """
+    return read_json_lines(filename)
+
+
+def get_field(doc, path):
+    """ value of a dotted field path such as 'created.user', or _MISSING """
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def bson_order(value):
+    """ sort key putting values in MongoDB's order of types """
+    if value is None or value is _MISSING:
+        return (1,)
+    if _is_number(value):
+        return (2, value)
+    if isinstance(value, string_types):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, [(key, bson_order(item)) for key, item in value.items()])
+    if isinstance(value, (list, tuple)):
+        return (5, [bson_order(item) for item in value])
+    if isinstance(value, bool):
+        return (8, value)
+    return (9, repr(value))
+
+
+def _compare(op, expected):
+    """ predicate on a field value for one query operator """
+    if op == "$eq":
+        return lambda value: value == expected
+    if op == "$ne":
+        return lambda value: value != expected
+    if op in _ORDER_OPERATORS:
+        key = bson_order(expected)
+        order = _ORDER_OPERATORS[op]
+
+        # like MongoDB, only values of the same type compare
+        def compare(value):
+            if value is _MISSING:
+                return False
+            value_key = bson_order(value)
+            return value_key[0] == key[0] and order(value_key, key)
+        return compare
+    if op == "$in":
+        return lambda value: value in expected
+    if op == "$nin":
+        return lambda value: value not in expected
+    if op == "$regex":
+        pattern = re.compile(expected)
+        return lambda value: (isinstance(value, string_types)
+                              and pattern.search(value) is not None)
+    raise ValueError("unsupported query operator %s" % op)
+
+
+def _field_matcher(path, condition):
+    """ predicate on a document for one {field: condition} of a query """
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        exists = None
+        tests = []
+        for op, expected in condition.items():
+            if op == "$exists":
+                exists = bool(expected)
+            else:
+                tests.append((op, _compare(op, expected)))
+    else:
+        exists = None
+        tests = [("$eq", _compare("$eq", condition))]
+
+    def matches(doc):
+        value = get_field(doc, path)
+        if exists is not None and (value is not _MISSING) != exists:
+            return False
+        for op, test in tests:
+            if value is _MISSING:
+                value_matches = op in ("$ne", "$nin") or (op == "$eq" and condition is None)
+            elif isinstance(value, list) and op not in ("$ne", "$nin"):
+                # an array matches when the array or any element does
+                value_matches = test(value) or any(test(item) for item in value)
+            elif op in ("$ne", "$nin") and isinstance(value, list):
+                value_matches = test(value) and all(test(item) for item in value)
+            else:
+                value_matches = test(value)
+            if not value_matches:
+                return False
+        return True
+    return matches
+
+
+def compile_query(query):
+    """ predicate on a document for a find() / $match query """
+    matchers = []
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            parts = [compile_query(part) for part in condition]
+            matchers.append(lambda doc, parts=parts: all(part(doc) for part in parts))
+        elif key == "$or":
+            parts = [compile_query(part) for part in condition]
+            matchers.append(lambda doc, parts=parts: any(part(doc) for part in parts))
+        else:
+            matchers.append(_field_matcher(key, condition))
+    if len(matchers) == 1:
+        return matchers[0]
+    return lambda doc: all(matcher(doc) for matcher in matchers)
+
+
+def _expression(spec):
+    """ function of a document for a $group expression: '$field', a
+        constant, or a document of expressions
+    """
+    if isinstance(spec, string_types) and spec.startswith("$"):
+        path = spec[1:]
+
+        def field(doc):
+            value = get_field(doc, path)
+            return None if value is _MISSING else value
+        return field
+    if isinstance(spec, dict):
+        parts = [(key, _expression(value)) for key, value in spec.items()]
+        return lambda doc: dict((key, part(doc)) for key, part in parts)
+    return lambda doc: spec
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return ("dict", tuple((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return ("list", tuple(_hashable(item) for item in value))
+    if isinstance(value, string_types):
+        return ("string", value)
+    if _is_number(value):
+        # 1 and 1.0 are the same group
+        return ("number", value)
+    return (type(value).__name__, value)
+
+
+class _Accumulator(object):
+    """ running value of one $group accumulator """
+
+    def __init__(self, op, spec):
+        if op not in ("$sum", "$avg", "$min", "$max", "$first", "$last",
+                      "$push", "$addToSet"):
+            raise ValueError("unsupported accumulator %s" % op)
+        self.op = op
+        self.value = _expression(spec)
+
+    def start(self):
+        return {"$sum": 0, "$avg": [0, 0], "$min": _MISSING, "$max": _MISSING,
+                "$first": _MISSING, "$last": None, "$push": [],
+                "$addToSet": []}[self.op]
+
+    def add(self, state, doc):
+        value = self.value(doc)
+        op = self.op
+        if op == "$sum":
+            return state + value if _is_number(value) else state
+        if op == "$avg":
+            if _is_number(value):
+                state[0] += value
+                state[1] += 1
+            return state
+        if op in ("$min", "$max"):
+            if value is None:
+                return state
+            if state is _MISSING:
+                return value
+            if (bson_order(value) < bson_order(state)) == (op == "$min"):
+                return value
+            return state
+        if op == "$first":
+            return value if state is _MISSING else state
+        if op == "$last":
+            return value
+        if op == "$push":
+            state.append(value)
+            return state
+        if value not in state:
+            state.append(value)
+        return state
+
+    def result(self, state):
+        if self.op == "$avg":
+            return float(state[0]) / state[1] if state[1] else None
+        if state is _MISSING:
+            return None
+        return state
+
+
+def _group(documents, spec):
+    """ hash aggregation: one entry per distinct _id """
+    group_id = _expression(spec["_id"])
+    accumulators = []
+    for field, accumulator in spec.items():
+        if field == "_id":
+            continue
+        (op, value), = accumulator.items()
+        accumulators.append((field, _Accumulator(op, value)))
+
+    groups = {}
+    for doc in documents:
+        value = group_id(doc)
+        key = _hashable(value)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [value] + [accumulator.start() for _, accumulator in accumulators]
+        for i, (_, accumulator) in enumerate(accumulators, 1):
+            group[i] = accumulator.add(group[i], doc)
+
+    for group in groups.values():
+        result = {"_id": group[0]}
+        for i, (field, accumulator) in enumerate(accumulators, 1):
+            result[field] = accumulator.result(group[i])
+        yield result
+
+
+class _SortKey(object):
+    """ comparable key of a document for a $sort specification """
+
+    __slots__ = ("values", "directions")
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for value, other_value, direction in zip(self.values, other.values, self.directions):
+            if value != other_value:
+                return (value < other_value) == (direction > 0)
+        return False
+
+
+def _sort_key(spec):
+    # a list of (field, direction) pairs keeps the order of the keys on
+    # Python 2, where dicts do not
+    fields = list(spec.items()) if isinstance(spec, dict) else list(spec)
+    directions = [direction for _, direction in fields]
+    return lambda doc: _SortKey([bson_order(get_field(doc, path)) for path, _ in fields],
+                                directions)
+
+
+def aggregate(documents, pipeline):
+    """ run an aggregation pipeline over an iterable of documents and
+        return the list of results
+    """
+    stages = list(pipeline)
+    results = iter(documents)
+    i = 0
+    while i < len(stages):
+        (name, spec), = stages[i].items()
+        if name == "$match":
+            results = _filter(results, compile_query(spec))
+        elif name == "$group":
+            results = _group(results, spec)
+        elif name == "$sort":
+            key = _sort_key(spec)
+            following = stages[i + 1] if i + 1 < len(stages) else {}
+            if "$limit" in following:
+                # top-k: only the k best documents are kept, in a heap
+                results = iter(heapq.nsmallest(following["$limit"], results, key=key))
+                i += 1
+            else:
+                results = iter(sorted(results, key=key))
+        elif name == "$limit":
+            results = _limit(results, spec)
+        elif name == "$skip":
+            results = _skip(results, spec)
+        elif name == "$count":
+            results = iter([{spec: sum(1 for _ in results)}])
+        else:
+            raise ValueError("unsupported pipeline stage %s" % name)
+        i += 1
+    return list(results)
+
+
+def _filter(documents, predicate):
+    for doc in documents:
+        if predicate(doc):
+            yield doc
+
+
+def _limit(documents, count):
+    for i, doc in enumerate(documents):
+        if i >= count:
+            break
+        yield doc
+
+
+def _skip(documents, count):
+    for i, doc in enumerate(documents):
+        if i >= count:
+            yield doc
+
+
+class LocalCollection(object):
+    """ read-only, collection-like view of a process_map() output file;
+        every call is one streaming pass over the file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        return read_documents(self.filename)
+
+    def find(self, query=None):
+        return _filter(iter(self), compile_query(query))
+
+    def count(self, query=None):
+        return sum(1 for _ in self.find(query))
+
+    def distinct(self, field, query=None):
+        """ distinct values of a field, elements of array values counted
+            one by one as in MongoDB
+        """
+        seen = {}
+        for doc in self.find(query):
+            value = get_field(doc, field)
+            if value is _MISSING:
+                continue
+            for item in (value if isinstance(value, list) else [value]):
+                seen.setdefault(_hashable(item), item)
+        return list(seen.values())
+
+    def aggregate(self, pipeline):
+        return aggregate(iter(self), pipeline)
+
+
+def same_results(local, mongo, pipeline):
+    """ 'match' when the results are equal, 'tie order' when they only
+        differ in the order of documents that tie on the $sort keys,
+        'MISMATCH' otherwise
+    """
+    if local == mongo:
+        return "match"
+    sorts = [stage["$sort"] for stage in pipeline if "$sort" in stage]
+    canonical = lambda docs: sorted(json.dumps(doc, sort_keys=True) for doc in docs)
+    if sorts and len(local) == len(mongo):
+        key = _sort_key(sorts[-1])
+        tied = [key(doc).values for doc in local] == [key(doc).values for doc in mongo]
+        has_limit = any("$limit" in stage for stage in pipeline)
+        if tied and (has_limit or canonical(local) == canonical(mongo)):
+            return "tie order"
+    return "MISMATCH"
+
+
+def benchmark(filename, collection=None, repeat=3):
+    """ best-of-`repeat` seconds of the Section III queries on the local
+        file and, when `collection` is given, on MongoDB, checking that
+        both give the same results
+    """
+    local = LocalCollection(filename)
+    queries = [("documents", lambda c: c.count({}), None),
+               ("nodes", lambda c: c.count({"type": "node"}), None),
+               ("ways", lambda c: c.count({"type": "way"}), None),
+               ("unique users", lambda c: len(c.distinct("created.user")), None)]
+    queries += [(name, lambda c, pipeline=pipeline: list(c.aggregate(pipeline)), pipeline)
+                for name, pipeline in SECTION_III_PIPELINES]
+
+    def timed(query, target):
+        best = None
+        for _ in range(repeat):
+            start_time = clock()
+            result = query(target)
+            seconds = clock() - start_time
+            best = seconds if best is None else min(best, seconds)
+        return result, best
+
+    for name, query, pipeline in queries:
+        local_result, local_seconds = timed(query, local)
+        line = "%-24s local %8.3f s" % (name, local_seconds)
+        if collection is not None:
+            # Collection.count() is gone from recent pymongo versions
+            mongo_query = query
+            if pipeline is None and name != "unique users":
+                mongo_query = lambda c, query=query: query(_Counting(c))
+            mongo_result, mongo_seconds = timed(mongo_query, collection)
+            if pipeline is None:
+                verdict = "match" if local_result == mongo_result else "MISMATCH"
+            else:
+                verdict = same_results(local_result, mongo_result, pipeline)
+            line += "   mongo %8.3f s   %s" % (mongo_seconds, verdict)
+        print(line)
+
+
+def count_documents(collection, query):
+    """ the number of documents of a pymongo collection matching
+        `query`, with count_documents() where pymongo has it (3.7 on) and
+        find().count() before
+    """
+    if hasattr(collection, "count_documents"):
+        return collection.count_documents(query)
+    return collection.find(query).count()
+
+
+class _Counting(object):
+    """ count() on a pymongo collection of any version """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def count(self, query):
+        return count_documents(self.collection, query)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("usage: python osm_aggregate.py <file>.json [--mongo]")
+    collection = None
+    if "--mongo" in sys.argv[2:]:
+        if MongoClient is None:
+            sys.exit("--mongo needs pymongo")
+        collection = MongoClient().final_project.singaporeOSM
+    benchmark(sys.argv[1], collection)
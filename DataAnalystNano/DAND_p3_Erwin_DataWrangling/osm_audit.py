@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""
+    Single-pass audit of an OSM XML file.
+
+    count_tags(), count_attrs(), count_keys() and the key_type() audit in
+    P3_DAND_SingaporeOSM.py each read the whole file again (count_tags
+    even builds the full tree with ET.parse). audit_map() computes all of
+    them in one iterparse pass, clearing elements as it goes, and returns
+    a single AuditReport:
+
+    report = audit_map("data/singapore.osm")
+    report.tags        -> element name: occurrences   (count_tags)
+    report.attrs       -> attribute name: occurrences (count_attrs)
+    report.keys        -> 'k' value: occurrences      (count_keys)
+    report.key_types   -> key format class: occurrences (key_type)
+
+    KeyTypes keeps what the key_type() audit needs in bounded memory:
+    the occurrences of each class, the occurrences of each distinct key
+    within a class and the first few keys seen of each class, instead of
+    a list with every key of the file.
+"""
+
+import os
+import re
+from collections import Counter, defaultdict
+import xml.etree.cElementTree as ET
+
+from osm_utils import TOP_LEVEL_TAGS, MemorySampler, clock, open_osm, string_types
+
+
+lower = re.compile(r'^([a-z]|_)*$')
+lower_colon = re.compile(r'^([a-z]|_)*\:([a-z]|_)*$')
+lower_two_colon = re.compile(r'^([a-z]|_)*\:([a-z]|_)*\:([a-z]|_)*$')
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+KEY_TYPES = ("lower", "lower_colon", "lower_two_colon", "problemchars", "other")
+
+
+def classify_key(key):
+    """ return the format class of a tag key, checked in the same order
+        as key_type() in the wrangling script
+    """
+    if problemchars.search(key):
+        return "problemchars"
+    elif lower_colon.search(key):
+        return "lower_colon"
+    elif lower_two_colon.search(key):
+        return "lower_two_colon"
+    elif lower.search(key):
+        return "lower"
+    return "other"
+
+
+class KeyTypes(object):
+    """ occurrences of tag keys by format class, with the first
+        `exemplars` keys of each class in the order they were seen
+    """
+
+    def __init__(self, exemplars=20):
+        self.max_exemplars = exemplars
+        self.counts = dict((key_type, 0) for key_type in KEY_TYPES)
+        self.keys = dict((key_type, Counter()) for key_type in KEY_TYPES)
+        self.exemplars = dict((key_type, []) for key_type in KEY_TYPES)
+
+    def add(self, key_type, key):
+        self.counts[key_type] += 1
+        self.keys[key_type][key] += 1
+        exemplars = self.exemplars[key_type]
+        if len(exemplars) < self.max_exemplars:
+            exemplars.append(key)
+
+    def most_common(self, key_type, n=None):
+        """ (key, occurrences) of the most frequent keys of a class """
+        return self.keys[key_type].most_common(n)
+
+    def sorted_by_occurrence(self):
+        """ (key format class, occurrences), most frequent first """
+        return AuditReport.sorted_by_occurrence(self.counts)
+
+
+class AuditReport(object):
+    """ counters collected by audit_map() plus the cost of the run """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.tags = defaultdict(int)
+        self.attrs = defaultdict(int)
+        self.keys = defaultdict(int)
+        self.key_types = dict((key_type, 0) for key_type in KEY_TYPES)
+        self.elements = 0
+        self.bytes = None
+        self.seconds = 0.0
+        # RSS reached during the audit, above the RSS at its start
+        self.peak_rss_kb = None
+
+    @property
+    def elements_per_sec(self):
+        if not self.seconds:
+            return 0.0
+        return self.elements / self.seconds
+
+    @property
+    def mb_per_sec(self):
+        if not self.seconds or self.bytes is None:
+            return None
+        return self.bytes / 1048576.0 / self.seconds
+
+    @staticmethod
+    def sorted_by_occurrence(counts):
+        """ (name, count) pairs, most frequent first """
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def __str__(self):
+        lines = ["%d elements in %.2f seconds (%.0f elements/sec)"
+                 % (self.elements, self.seconds, self.elements_per_sec)]
+        if self.mb_per_sec is not None:
+            lines.append("%.1f MB read (%.1f MB/sec)"
+                         % (self.bytes / 1048576.0, self.mb_per_sec))
+        if self.peak_rss_kb is not None:
+            lines.append("peak RSS %.1f MB above the start of the audit"
+                         % (self.peak_rss_kb / 1024.0))
+        return "\n".join(lines)
+
+
+def audit_map(filename):
+    """ count elements, attributes, keys and key format classes of an OSM
+        file (optionally .bz2 or .gz) in a single streaming pass and return
+        an AuditReport
+    """
+    report = AuditReport(filename)
+    try:
+        report.bytes = os.path.getsize(filename)
+    except (TypeError, OSError):
+        pass
+
+    tags, attrs, keys, key_types = (report.tags, report.attrs, report.keys,
+                                    report.key_types)
+    start_time = clock()
+    root = None
+    root_attrib = None
+    f = open_osm(filename) if isinstance(filename, string_types) else filename
+    try:
+        with MemorySampler() as memory:
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        # clearing the root below also drops its attributes
+                        root, root_attrib = elem, dict(elem.attrib)
+                    continue
+
+                tags[elem.tag] += 1
+                for attr in (root_attrib if elem is root else elem.attrib):
+                    attrs[attr] += 1
+
+                if elem.tag == "tag":
+                    key = elem.get("k")
+                    if key:
+                        keys[key] += 1
+                        key_types[classify_key(key)] += 1
+                elif elem.tag in TOP_LEVEL_TAGS:
+                    root.clear()
+    finally:
+        if f is not filename:
+            f.close()
+
+    report.elements = sum(tags.values())
+    report.seconds = clock() - start_time
+    report.peak_rss_kb = memory.peak_kb
+    return report
@@ -0,0 +1,451 @@
+#!/usr/bin/python
+
+"""
+    Synthetic Singapore-like OSM data and a throughput benchmark for the
+    wrangling pipeline.
+
+    generate_osm() writes an OSM XML file of any size with the features
+    the wrangling script deals with: a few heavy contributors, amenities
+    with cuisines and religions, street names with Jln / Rd / Ave
+    abbreviations, names in Chinese and Malay, some addresses in Johor
+    Bahru, and phone numbers and postal codes that are dirty at a
+    configurable rate:
+
+    params = generate_osm("data/synthetic.osm", nodes=1000000, ways_per_node=0.12,
+                          tag_density=0.15, dirty_phone_rate=0.2)
+
+    run_benchmarks() runs each stage of the pipeline on a file in a
+    process of its own, so the peak RSS it reports belongs to that stage,
+    and saves elements/sec, seconds and peak RSS of every stage as JSON:
+
+    run_benchmarks("data/synthetic.osm", shape=shape_element,
+                   out="benchmarks/2017-03-01.json", params=params)
+
+    From the command line, the shape and serialize stages time
+    shape_element() of osm_shape.py (or any other "module:function" given
+    to --shape), and --mongo adds the load stage, which writes the
+    documents in batches like process_map(). compare_results() lines two
+    result files up to spot regressions:
+
+    python osm_bench.py generate data/synthetic.osm --nodes 1000000
+    python osm_bench.py run data/synthetic.osm --out new.json --mongo bench.singaporeOSM
+    python osm_bench.py compare old.json new.json
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+from xml.sax.saxutils import quoteattr
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from osm_audit import audit_map
+from osm_utils import MemorySampler, clock, iter_elements
+
+
+LAT_RANGE = (1.23, 1.47)
+LON_RANGE = (103.61, 104.03)
+
+AMENITIES = ["restaurant", "restaurant", "restaurant", "place_of_worship",
+             "cafe", "fast_food", "school", "parking", "bank", "atm",
+             "toilets", "pharmacy", "clinic", "bar"]
+CUISINES = ["chinese", "japanese", "indian", "malay", "italian", "korean",
+            "thai", "western", "vegetarian"]
+RELIGIONS = ["muslim", "christian", "buddhist", "hindu", "taoist"]
+STREETS = ["Orchard Road", "Orchard Rd", "Jalan Besar", "Jln Besar",
+           "Upp Thomson Rd", "Upper Thomson Road", "Ang Mo Kio Ave 3",
+           "Bukit Timah Rd.", "Rowell Road", "Serangoon Road", "Jl. Kayu"]
+NAMES = ["Por's house", "Jln Kayu Prata", "Fairprice", "Kopitiam",
+         "Ave 3 Food Court", "Masjid Sultan", "Toa Payoh Library"]
+# Chinatown, Orchard Road, Lion City
+NAMES_ZH = [u"\u725b\u8f66\u6c34", u"\u4e4c\u8282\u8def", u"\u72ee\u57ce"]
+NAMES_MS = ["Pecinan", "Jalan Orchard", "Masjid Sultan"]
+HIGHWAYS = ["residential", "service", "footway", "primary", "secondary",
+            "tertiary", "unclassified"]
+CITIES = ["Singapore"] * 19 + ["Johor Bahru"]
+
+# stages are closures over the shape function, so the child processes
+# have to be forked rather than spawned
+try:
+    _processes = multiprocessing.get_context("fork")
+except (AttributeError, ValueError):
+    _processes = multiprocessing
+
+# seconds between two checks that a stage process is still running
+POLL_SECONDS = 0.5
+
+
+def _phone(rng, dirty_rate):
+    if rng.random() < dirty_rate:
+        return rng.choice(["+65 6396", "call us", "6396-06O9", "+60 12 345"])
+    number = "%04d %04d" % (rng.randint(6000, 9999), rng.randint(0, 9999))
+    return rng.choice([number, "+65 " + number, number.replace(" ", "")])
+
+
+def _postcode(rng, dirty_rate):
+    if rng.random() < dirty_rate:
+        return rng.choice(["S%06d" % rng.randint(0, 999999), "%05d" % rng.randint(0, 99999),
+                           "Singapore %06d" % rng.randint(0, 999999)])
+    return "%06d" % rng.randint(10000, 829999)
+
+
+def _node_tags(rng, dirty_phone_rate, dirty_postcode_rate):
+    tags = []
+    amenity = rng.choice(AMENITIES)
+    tags.append(("amenity", amenity))
+    if amenity == "restaurant" and rng.random() < 0.6:
+        tags.append(("cuisine", rng.choice(CUISINES)))
+    if amenity == "place_of_worship" and rng.random() < 0.9:
+        tags.append(("religion", rng.choice(RELIGIONS)))
+    if rng.random() < 0.7:
+        tags.append(("name", rng.choice(NAMES)))
+    if rng.random() < 0.1:
+        tags.append(("name:zh", rng.choice(NAMES_ZH)))
+    if rng.random() < 0.05:
+        tags.append(("name:ms", rng.choice(NAMES_MS)))
+    if rng.random() < 0.4:
+        tags.append(("addr:street", rng.choice(STREETS)))
+        tags.append(("addr:housenumber", rng.choice(["%d" % rng.randint(1, 999),
+                                                     "#%02d-%02d" % (rng.randint(1, 30),
+                                                                      rng.randint(1, 99)),
+                                                     "Blk %d" % rng.randint(1, 999)])))
+        tags.append(("addr:postcode", _postcode(rng, dirty_postcode_rate)))
+        tags.append(("addr:city", rng.choice(CITIES)))
+    if rng.random() < 0.3:
+        tags.append(("phone", _phone(rng, dirty_phone_rate)))
+    return tags
+
+
+def _attrs(rng, element_id, users):
+    user = users[min(int(rng.paretovariate(1.2)) - 1, len(users) - 1)]
+    return ('id="%d" visible="true" version="%d" changeset="%d" '
+            'timestamp="20%02d-%02d-%02dT%02d:%02d:%02dZ" user=%s uid="%d"' % (
+                element_id, rng.randint(1, 6), rng.randint(1, 45000000),
+                rng.randint(8, 16), rng.randint(1, 12), rng.randint(1, 28),
+                rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                quoteattr(user[0]), user[1]))
+
+
+def _write_tags(out, tags):
+    for key, value in tags:
+        out.write(u'    <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(value)))
+
+
+def generate_osm(filename, nodes=100000, ways_per_node=0.12, relations_per_way=0.01,
+                 tag_density=0.15, dirty_phone_rate=0.2, dirty_postcode_rate=0.05,
+                 users=2000, seed=0):
+    """ write a synthetic OSM file and return the parameters used
+
+        tag_density is the fraction of nodes that have tags; every way
+        has a highway or building tag and 2 to 12 node refs. The same
+        seed gives the same file on the same Python version.
+    """
+    rng = random.Random(seed)
+    params = {"nodes": nodes, "ways_per_node": ways_per_node,
+              "relations_per_way": relations_per_way, "tag_density": tag_density,
+              "dirty_phone_rate": dirty_phone_rate,
+              "dirty_postcode_rate": dirty_postcode_rate, "users": users, "seed": seed}
+    user_list = [(u"user%d" % i, 1000 + i) for i in range(users)]
+    ways = int(nodes * ways_per_node)
+    relations = int(ways * relations_per_way)
+
+    with open(filename, "wb") as f:
+        out = _Utf8Writer(f)
+        out.write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                  u'<osm version="0.6" generator="osm_bench">\n'
+                  u' <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n'
+                  % (LAT_RANGE[0], LON_RANGE[0], LAT_RANGE[1], LON_RANGE[1]))
+        for node_id in range(1, nodes + 1):
+            attrs = _attrs(rng, node_id, user_list)
+            position = ' lat="%.7f" lon="%.7f"' % (rng.uniform(*LAT_RANGE),
+                                                   rng.uniform(*LON_RANGE))
+            if rng.random() < tag_density:
+                out.write(u'  <node %s%s>\n' % (attrs, position))
+                _write_tags(out, _node_tags(rng, dirty_phone_rate, dirty_postcode_rate))
+                out.write(u'  </node>\n')
+            else:
+                out.write(u'  <node %s%s/>\n' % (attrs, position))
+
+        first_way = nodes + 1
+        for way_id in range(first_way, first_way + ways):
+            out.write(u'  <way %s>\n' % _attrs(rng, way_id, user_list))
+            start = rng.randint(1, max(1, nodes - 12))
+            for ref in range(start, min(nodes, start + rng.randint(2, 12)) + 1):
+                out.write(u'    <nd ref="%d"/>\n' % ref)
+            if rng.random() < 0.6:
+                tags = [("highway", rng.choice(HIGHWAYS)), ("name", rng.choice(STREETS))]
+            else:
+                tags = [("building", "yes")]
+            _write_tags(out, tags)
+            out.write(u'  </way>\n')
+
+        first_relation = first_way + ways
+        for relation_id in range(first_relation, first_relation + relations if ways else 0):
+            out.write(u'  <relation %s>\n' % _attrs(rng, relation_id, user_list))
+            for _ in range(rng.randint(1, 4)):
+                out.write(u'    <member type="way" ref="%d" role="outer"/>\n'
+                          % rng.randint(first_way, first_way + ways - 1))
+            _write_tags(out, [("type", "multipolygon")])
+            out.write(u'  </relation>\n')
+        out.write(u'</osm>\n')
+        out.flush()
+
+    params["ways"] = ways
+    params["relations"] = relations
+    params["bytes"] = os.path.getsize(filename)
+    return params
+
+
+class _Utf8Writer(object):
+    """ buffered UTF-8 writes of unicode text, the same on Python 2 and 3 """
+
+    def __init__(self, f, buffer_size=1 << 16):
+        self._f = f
+        self._parts = []
+        self._size = 0
+        self._buffer_size = buffer_size
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        self._f.write(u"".join(self._parts).encode("utf-8"))
+        self._parts = []
+        self._size = 0
+
+
+def parse_stage(filename):
+    for _ in iter_elements(filename):
+        pass
+
+
+def audit_stage(filename):
+    audit_map(filename)
+
+
+def shape_stage(shape):
+    def stage(filename):
+        for element in iter_elements(filename):
+            shape(element)
+    return stage
+
+
+def serialize_stage(shape):
+    def stage(filename):
+        with open(os.devnull, "w") as out:
+            for element in iter_elements(filename):
+                doc = shape(element)
+                if doc:
+                    out.write(json.dumps(doc) + "\n")
+    return stage
+
+
+def load_stage(shape, collection, batch_size=1000):
+    def stage(filename):
+        # imported here so the other stages run without pymongo
+        from osm_loader import load_documents, shape_map
+        load_documents(shape_map(filename, shape), collection, batch_size=batch_size)
+    return stage
+
+
+def _run_stage(stage, filename, results):
+    try:
+        # the forked child starts at the RSS of the parent, so the peak
+        # is sampled while the stage runs instead of read from ru_maxrss
+        with MemorySampler() as memory:
+            start_time = clock()
+            stage(filename)
+            seconds = clock() - start_time
+        results.put((seconds, memory.start_kb, memory.max_kb, None))
+    except Exception as e:
+        results.put((None, None, None, repr(e)))
+
+
+def measure(stage, filename, timeout=None):
+    """ (seconds, RSS in kB at the start, peak RSS in kB while it ran)
+        of stage(filename), run in a child process
+
+        Raises RuntimeError when the child dies without a result (e.g.
+        killed for running out of memory) or takes longer than `timeout`
+        seconds.
+    """
+    results = _processes.Queue()
+    process = _processes.Process(target=_run_stage, args=(stage, filename, results))
+    process.start()
+    start_time = clock()
+    try:
+        while True:
+            # a child that has exited has flushed its result, if any
+            alive = process.is_alive()
+            try:
+                seconds, start_rss, end_rss, error = results.get(timeout=POLL_SECONDS)
+                break
+            except Empty:
+                pass
+            if not alive:
+                raise RuntimeError("stage process exited with code %s without a result"
+                                   % process.exitcode)
+            if timeout is not None and clock() - start_time > timeout:
+                process.terminate()
+                raise RuntimeError("stage timed out after %.0f seconds" % timeout)
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError("stage failed: %s" % error)
+    return seconds, start_rss, end_rss
+
+
+def load_function(spec):
+    """ the function named by "module:function", e.g.
+        "osm_shape:shape_element"
+    """
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError("expected module:function, not %r" % (spec,))
+    return getattr(importlib.import_module(module), name)
+
+
+def count_elements(filename):
+    return sum(1 for _ in iter_elements(filename))
+
+
+def run_benchmarks(filename, shape=None, collection=None, stages=None, out=None,
+                   params=None, repeat=1):
+    """ time each stage on `filename` and return (and save to `out`) the
+        results
+
+        The stages are parse, audit, and with a shape function shape and
+        serialize (json.dumps); with a MongoDB collection as well, load.
+        `stages` adds (name, function of the filename) pairs such as
+        ("count_tags", count_tags). elements/sec is the number of
+        top-level elements of the file over the best time of `repeat`
+        runs.
+    """
+    all_stages = [("parse", parse_stage), ("audit", audit_stage)]
+    if shape is not None:
+        all_stages += [("shape", shape_stage(shape)), ("serialize", serialize_stage(shape))]
+        if collection is not None:
+            all_stages.append(("load", load_stage(shape, collection)))
+    all_stages += list(stages or [])
+
+    elements = count_elements(filename)
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "file": os.path.basename(filename),
+               "bytes": os.path.getsize(filename),
+               "elements": elements,
+               "generator": params,
+               "stages": []}
+    for name, stage in all_stages:
+        runs = [measure(stage, filename) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        result = {"stage": name, "seconds": seconds,
+                  "elements_per_sec": elements / seconds if seconds else None,
+                  "start_rss_kb": max(run[1] for run in runs),
+                  "peak_rss_kb": max(run[2] for run in runs)}
+        results["stages"].append(result)
+        print("%-12s %8.2f s %10.0f elements/sec %8s kB peak RSS (%s kB at the start)" % (
+            name, seconds, result["elements_per_sec"] or 0, result["peak_rss_kb"],
+            result["start_rss_kb"]))
+
+    if out is not None:
+        directory = os.path.dirname(out)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def compare_results(old, new, tolerance=0.1):
+    """ print elements/sec and peak RSS of two result files side by side
+        and return the stages that got more than `tolerance` slower
+    """
+    with open(old) as f:
+        old_stages = dict((stage["stage"], stage) for stage in json.load(f)["stages"])
+    with open(new) as f:
+        new_stages = json.load(f)["stages"]
+
+    regressions = []
+    print("%-12s %14s %14s %8s %12s" % ("stage", "old el/sec", "new el/sec", "change", "peak RSS kB"))
+    for stage in new_stages:
+        before = old_stages.get(stage["stage"])
+        if before is None or not before["elements_per_sec"] or not stage["elements_per_sec"]:
+            continue
+        change = stage["elements_per_sec"] / before["elements_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(stage["stage"])
+        print("%-12s %14.0f %14.0f %+7.1f%% %5s -> %s%s" % (
+            stage["stage"], before["elements_per_sec"], stage["elements_per_sec"],
+            100 * change, before["peak_rss_kb"], stage["peak_rss_kb"],
+            "   REGRESSION" if change < -tolerance else ""))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="OSM pipeline benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    generate = commands.add_parser("generate", help="write a synthetic OSM file")
+    generate.add_argument("filename")
+    generate.add_argument("--nodes", type=int, default=100000)
+    generate.add_argument("--ways-per-node", type=float, default=0.12)
+    generate.add_argument("--tag-density", type=float, default=0.15)
+    generate.add_argument("--dirty-phone-rate", type=float, default=0.2)
+    generate.add_argument("--dirty-postcode-rate", type=float, default=0.05)
+    generate.add_argument("--seed", type=int, default=0)
+    run = commands.add_parser("run", help="benchmark the stages of the pipeline")
+    run.add_argument("filename")
+    run.add_argument("--shape", default="osm_shape:shape_element",
+                     help="module:function shaping the elements, or '' to only "
+                          "parse and audit")
+    run.add_argument("--mongo", metavar="DB.COLLECTION",
+                     help="also time loading the documents into this collection")
+    run.add_argument("--out")
+    run.add_argument("--repeat", type=int, default=1)
+    compare = commands.add_parser("compare", help="compare two result files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        params = generate_osm(args.filename, nodes=args.nodes,
+                              ways_per_node=args.ways_per_node,
+                              tag_density=args.tag_density,
+                              dirty_phone_rate=args.dirty_phone_rate,
+                              dirty_postcode_rate=args.dirty_postcode_rate, seed=args.seed)
+        print(json.dumps(params, sort_keys=True))
+    elif args.command == "run":
+        try:
+            shape = load_function(args.shape) if args.shape else None
+        except ValueError as e:
+            parser.error(str(e))
+        collection = None
+        if args.mongo:
+            from pymongo import MongoClient
+            database, _, name = args.mongo.partition(".")
+            collection = MongoClient()[database][name]
+        run_benchmarks(args.filename, shape=shape, collection=collection, out=args.out,
+                       repeat=args.repeat)
+    elif args.command == "compare":
+        return 1 if compare_results(args.old, args.new, args.tolerance) else 0
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+    Memoization for the value cleaners.
+
+    Street names, postcodes and the phone numbers of chain stores repeat
+    constantly, so cleaning every value again wastes the regex work.
+    memoize() wraps a one-argument cleaner in a bounded LRU cache:
+
+    @memoize(maxsize=100000)
+    def cleanPostCode(postcode):
+        ...
+
+    cleanPostCode.cache_info()  -> hits, misses, evictions, size
+
+    Cleaners report the values they cannot clean to an ExceptionReport
+    instead of printing every one of them; the report keeps each value
+    once, in the order they were first seen. A memoized cleaner only
+    sees a value once, so the report counts distinct values, not
+    occurrences.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+
+
+class LRUCache(object):
+    """ mapping of at most `maxsize` entries, dropping the least recently
+        used one when full
+    """
+
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-inserting moves the key to the most recently used end
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key not in self._data and len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        self._data[key] = value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+_MISSING = object()
+
+
+def memoize(maxsize=65536):
+    """ decorator caching the results of a one-argument function in an
+        LRUCache of `maxsize` entries
+
+        The wrapped function gets cache_info() and cache_clear().
+    """
+    def decorator(func):
+        cache = LRUCache(maxsize)
+
+        @wraps(func)
+        def wrapper(value):
+            result = cache.get(value, _MISSING)
+            if result is _MISSING:
+                result = func(value)
+                cache.put(value, result)
+            return result
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+class ExceptionReport(object):
+    """ values the cleaners could not clean, deduplicated per kind """
+
+    def __init__(self):
+        self._values = OrderedDict()
+
+    def add(self, kind, value):
+        self._values.setdefault(kind, OrderedDict())[value] = None
+
+    def values(self, kind):
+        return list(self._values.get(kind, ()))
+
+    def kinds(self):
+        return list(self._values)
+
+    def clear(self):
+        self._values.clear()
+
+    def __len__(self):
+        return sum(len(values) for values in self._values.values())
+
+    def __str__(self):
+        lines = []
+        for kind, values in self._values.items():
+            lines.append("EXCEPTION %s: %d distinct values" % (kind, len(values)))
+            lines.extend("    %s" % value for value in values)
+        return "\n".join(lines)
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+"""
+    Checkpointed, resumable loading of an OSM file into MongoDB.
+
+    When run() fails halfway through a large import (the server goes
+    away, the process runs out of memory or is killed), starting again
+    means parsing from the first byte and inserting the documents that
+    were already loaded a second time. checkpointed_load() saves a
+    Checkpoint every `every` documents instead, as soon as the batches
+    holding them are acknowledged: the byte offset of the element of the
+    last document written, its type and id, the number of documents
+    written and the length of the JSON output so far. A fresh load also
+    saves one before its first document, so a run killed before the
+    first `every` documents is resumed like any other.
+
+    path = "data/singapore.osm.checkpoint"
+    source = ResumableSource("data/singapore.osm", shape_element)
+    stats = checkpointed_load(source, db.singaporeOSM, path)
+
+    To resume, the source starts from the saved checkpoint:
+
+    source = ResumableSource("data/singapore.osm", shape_element,
+                             Checkpoint.load(path))
+    stats = checkpointed_load(source, db.singaporeOSM, path)
+
+    Parsing then starts at the recorded offset (with a seek for an
+    uncompressed file, by skipping that many decompressed bytes for a
+    .bz2 or .gz one), and the element found there must be the recorded
+    one. The interrupted run may have written up to `window` documents
+    after its last checkpoint, so that many documents after the resume
+    point are upserted on their type and id (like the changes of
+    osm_delta.py) instead of inserted; the ones after them are inserted
+    as usual. The checkpoint file is replaced atomically, so a run
+    killed while saving it leaves the previous checkpoint.
+"""
+
+import json
+import os
+import time
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.write_concern import WriteConcern
+
+from osm_loader import LoadStats
+from osm_utils import TOP_LEVEL_TAGS, clock, is_compressed, open_osm
+
+
+READ_SIZE = 1024 * 1024
+
+# documents between two checkpoints
+CHECKPOINT_EVERY = 100000
+
+
+class Checkpoint(object):
+    """ how far a checkpointed_load() of `filename` got """
+
+    FIELDS = ("filename", "offset", "type", "id", "documents", "output_offset",
+              "window", "saved", "state")
+
+    def __init__(self, filename, offset=0, type=None, id=None, documents=0,
+                 output_offset=0, window=0, saved=None, state=None):
+        self.filename = filename
+        # byte offset (in the decompressed file) of the element of the last
+        # document written, and its type and id
+        self.offset = offset
+        self.type = type
+        self.id = id
+        self.documents = documents
+        # length of the JSON output holding those documents
+        self.output_offset = output_offset
+        # most documents that may have been written after this checkpoint
+        self.window = window
+        self.saved = saved
+        # anything else the caller needs to resume, e.g. the summaries
+        self.state = state if state is not None else {}
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def save(self, path):
+        """ write the checkpoint to `path`, replacing the previous one
+            only once it is complete on disk
+        """
+        self.saved = time.time()
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        # os.replace() is Python 3 only; rename() replaces on POSIX
+        getattr(os, "replace", os.rename)(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        """ the checkpoint saved at `path`, or None when there is none """
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(**dict((name, data.get(name)) for name in cls.FIELDS))
+
+    def __str__(self):
+        return "%d documents of %s, up to %s %s at byte %d" % (
+            self.documents, self.filename, self.type, self.id, self.offset)
+
+
+def reopen_output(filename, offset):
+    """ the JSON output of an interrupted run, cut back to the `offset`
+        bytes written up to its checkpoint and open for appending
+    """
+    fo = open(filename, "r+")
+    fo.seek(offset)
+    fo.truncate()
+    return fo
+
+
+def _skip(f, offset, compressed):
+    if not compressed:
+        f.seek(offset)
+        return
+    while offset > 0:
+        data = f.read(min(offset, READ_SIZE))
+        if not data:
+            raise ValueError("the file ends before byte %d" % offset)
+        offset -= len(data)
+
+
+def iter_elements_at(filename, offset=0, tags=TOP_LEVEL_TAGS):
+    """ yield (offset, element) for every top-level element of an OSM
+        file whose name is in `tags`, from the one whose start tag is at
+        byte `offset` of the (decompressed) file on
+
+        offset is the position of the start tag of the element. Unlike
+        iter_elements(), every element is built on its own, so it can be
+        kept.
+    """
+    f = open_osm(filename)
+    try:
+        if offset:
+            _skip(f, offset, is_compressed(filename))
+            # the elements after the offset are parsed as the children of
+            # a root element of their own
+            prefix = b"<osm>"
+        else:
+            prefix = b""
+        base = offset - len(prefix)
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        done = []
+        # [depth, element being built, its offset], and its open children
+        current = [0, None, None]
+        stack = []
+
+        def start(name, attrs):
+            current[0] += 1
+            if stack:
+                stack.append(ET.SubElement(stack[-1], name, attrs))
+            elif current[0] == 2 and name in tags:
+                current[1] = ET.Element(name, attrs)
+                current[2] = base + parser.CurrentByteIndex
+                stack.append(current[1])
+
+        def end(name):
+            current[0] -= 1
+            if stack:
+                stack.pop()
+                if not stack:
+                    done.append((current[2], current[1]))
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        if prefix:
+            parser.Parse(prefix, False)
+        while True:
+            data = f.read(READ_SIZE)
+            parser.Parse(data, not data)
+            for item in done:
+                yield item
+            del done[:]
+            if not data:
+                break
+    finally:
+        f.close()
+
+
+class ResumableSource(object):
+    """ the documents shape() makes of the elements of an OSM file, from
+        the start or from the element after a Checkpoint; offset, type
+        and id are those of the element of the last document yielded
+    """
+
+    def __init__(self, filename, shape, checkpoint=None):
+        self.filename = filename
+        self.shape = shape
+        self.checkpoint = checkpoint
+        if checkpoint is not None:
+            self.offset, self.type, self.id = checkpoint.offset, checkpoint.type, checkpoint.id
+        else:
+            self.offset, self.type, self.id = 0, None, None
+
+    def __iter__(self):
+        shape = self.shape
+        elements = iter_elements_at(self.filename, self.offset)
+        if self.checkpoint is not None and self.checkpoint.id is not None:
+            # the element of the last document of the checkpoint was
+            # written already
+            _, element = next(elements)
+            if (element.tag, element.get("id")) != (self.type, self.id):
+                raise ValueError("%s has %s %s at byte %d, not the %s %s of the "
+                                 "checkpoint" % (self.filename, element.tag,
+                                                 element.get("id"), self.offset,
+                                                 self.type, self.id))
+        for offset, element in elements:
+            doc = shape(element)
+            if doc:
+                self.offset, self.type, self.id = offset, element.tag, element.get("id")
+                yield doc
+
+
+class CheckpointStats(LoadStats):
+    """ LoadStats with the checkpoints saved and the documents upserted
+        around the resume point
+    """
+
+    def __init__(self):
+        super(CheckpointStats, self).__init__()
+        self.checkpoints = 0
+        self.upserted = 0
+        self.resumed_from = 0
+
+    def __str__(self):
+        return "%s; resumed after %d documents, %d upserted, %d checkpoints" % (
+            super(CheckpointStats, self).__str__(), self.resumed_from,
+            self.upserted, self.checkpoints)
+
+
+def checkpointed_load(source, collection, path, documents=None, output=None,
+                      every=CHECKPOINT_EVERY, batch_size=1000, write_concern=None,
+                      on_checkpoint=None):
+    """ insert the documents of a ResumableSource into `collection` like
+        load_documents(), saving a Checkpoint to `path` every `every`
+        documents; returns a CheckpointStats
+
+        documents is the source with any filters or writers the caller
+        wraps around it (they must pull one document at a time from it).
+        output, a file object the documents are also written to, is
+        flushed at every checkpoint and its length recorded. on_checkpoint
+        is called with the Checkpoint before it is saved, to add to its
+        state.
+
+        The checkpoints are only safe with acknowledged writes, i.e. not
+        with write_concern={"w": 0}.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if every < 1:
+        raise ValueError("every must be at least 1")
+    if isinstance(write_concern, dict):
+        write_concern = WriteConcern(**write_concern)
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+
+    resumed = source.checkpoint
+    stats = CheckpointStats()
+    written = resumed.documents if resumed is not None else 0
+    stats.resumed_from = written
+    # documents the interrupted run may have written already
+    upsert_left = resumed.window if resumed is not None else 0
+    if upsert_left:
+        collection.create_index([("id", ASCENDING), ("type", ASCENDING)])
+    last_checkpoint = [written]
+    start_time = clock()
+
+    def flush(batch):
+        write_start = clock()
+        upserts = batch[:upsert_left]
+        if upserts:
+            collection.bulk_write([ReplaceOne({"type": doc["type"], "id": doc["id"]},
+                                              doc, upsert=True) for doc in upserts],
+                                  ordered=False)
+            stats.upserted += len(upserts)
+        if len(batch) > len(upserts):
+            collection.insert_many(batch[len(upserts):], ordered=False)
+        stats.write_seconds += clock() - write_start
+        stats.documents += len(batch)
+        stats.batches += 1
+        return len(upserts)
+
+    def save():
+        if output is not None:
+            output.flush()
+        checkpoint = Checkpoint(source.filename, source.offset, source.type, source.id,
+                                written, output.tell() if output is not None else 0,
+                                # a checkpoint is due after every + batch_size
+                                # documents at the latest
+                                every + batch_size)
+        if on_checkpoint is not None:
+            on_checkpoint(checkpoint)
+        checkpoint.save(path)
+        stats.checkpoints += 1
+        last_checkpoint[0] = written
+
+    if resumed is None:
+        # a run killed before its first checkpoint is resumed from the
+        # start, upserting the documents it may have written
+        save()
+
+    batch = []
+    for doc in (source if documents is None else documents):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            upsert_left -= flush(batch)
+            written += len(batch)
+            batch = []
+            if written - last_checkpoint[0] >= every:
+                save()
+    if batch:
+        flush(batch)
+        written += len(batch)
+    save()
+
+    stats.seconds = clock() - start_time
+    return stats
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+"""
+    Columnar export of shaped OSM documents.
+
+    process_map() writes one JSON line per element, and every analysis has
+    to parse all of that JSON again even when it needs a single field.
+    ColumnWriter stores the same documents column by column, in chunks of
+    `chunk_rows` rows, as raw typed arrays in a directory:
+
+    id, lat, lon, created.version, created.changeset, created.uid,
+    created.timestamp     numeric arrays, one value per document
+    type, created.user    dictionary-encoded: int32 codes + list of values
+    every other field     sparse dictionary-encoded tag column: the rows
+                          that have the field, their codes and the values
+                          (names.* and address.* are flattened)
+    node_refs             int64 offsets + int64 ids
+
+    with ColumnWriter("data/singapore.osm.columns") as columns:
+        for doc in docs:
+            columns.write(doc)
+
+    load_columns() memory-maps only the columns asked for. Tag columns
+    are named "tags/<field>", so a tag called 'lat' or 'id' does not
+    clash with the column of the same name:
+
+    cols = load_columns("data/singapore.osm.columns", ["lat", "lon", "tags/amenity"])
+"""
+
+import array
+import calendar
+import json
+import mmap
+import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from osm_utils import INT64
+
+
+TYPECODES = {"int64": INT64, "int32": 'i', "uint8": 'B', "float64": 'd'}
+NUMPY_DTYPES = {"int64": "=i8", "int32": "=i4", "uint8": "u1", "float64": "=f8"}
+
+MISSING = -1
+
+NUMERIC_COLUMNS = (("id", "int64"), ("lat", "float64"), ("lon", "float64"),
+                   ("created.version", "int32"), ("created.changeset", "int64"),
+                   ("created.uid", "int64"), ("created.timestamp", "int64"))
+DICTIONARY_COLUMNS = ("type", "created.user")
+# fields with a column of their own, the rest become tag columns
+FIXED_FIELDS = ("id", "type", "pos", "created", "node_refs")
+NESTED_FIELDS = ("names", "address")
+
+MANIFEST = "manifest.json"
+
+# the namespace of the tag columns in load_columns()
+TAG_PREFIX = "tags/"
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def _timestamp(value):
+    """ seconds since the epoch of an OSM timestamp, 2014-11-25T21:38:36Z """
+    try:
+        return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                int(value[11:13]), int(value[14:16]),
+                                int(value[17:19]), 0, 0, 0))
+    except (TypeError, ValueError):
+        return MISSING
+
+
+class _Dictionary(object):
+    """ value <-> int32 code mapping of a dictionary-encoded column """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return code
+
+
+class ColumnWriter(object):
+    """ writes shaped documents as typed column files in `out_dir` """
+
+    def __init__(self, out_dir, chunk_rows=65536):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self._chunk_start = 0
+        self._columns = {}
+        self._dictionaries = {}
+        self._tags = {}
+        for name, dtype in NUMERIC_COLUMNS:
+            self._add_column(name, dtype)
+        for name in DICTIONARY_COLUMNS:
+            self._add_column(name, "int32")
+            self._dictionaries[name] = _Dictionary()
+        self._add_column("node_refs.offsets", "int64")
+        self._add_column("node_refs.values", "int64")
+        self._columns["node_refs.offsets"][1].append(0)
+        self._ref_count = 0
+
+    def _add_column(self, name, dtype):
+        filename = name + ".bin"
+        path = os.path.join(self.out_dir, filename)
+        open(path, 'wb').close()
+        self._columns[name] = [dtype, array.array(TYPECODES[dtype]), filename]
+
+    def _tag_column(self, field):
+        try:
+            return self._tags[field]
+        except KeyError:
+            # tag keys can hold characters that are not valid in filenames
+            number = len(self._tags)
+            rows_name, codes_name = "tag.%d.rows" % number, "tag.%d.codes" % number
+            self._add_column(rows_name, "int64")
+            self._add_column(codes_name, "int32")
+            column = self._tags[field] = (self._columns[rows_name][1],
+                                          self._columns[codes_name][1],
+                                          _Dictionary(), number)
+            return column
+
+    def _add_tag(self, row, field, value):
+        if value is None:
+            return
+        rows, codes, dictionary, _ = self._tag_column(field)
+        rows.append(row)
+        codes.append(dictionary.encode(value))
+
+    def write(self, doc):
+        columns = self._columns
+        row = self.rows
+        pos = doc.get("pos") or (None, None)
+        created = doc.get("created") or {}
+
+        columns["id"][1].append(_int(doc.get("id")))
+        columns["lat"][1].append(pos[0] if pos[0] is not None else float('nan'))
+        columns["lon"][1].append(pos[1] if pos[1] is not None else float('nan'))
+        columns["created.version"][1].append(_int(created.get("version")))
+        columns["created.changeset"][1].append(_int(created.get("changeset")))
+        columns["created.uid"][1].append(_int(created.get("uid")))
+        columns["created.timestamp"][1].append(_timestamp(created.get("timestamp")))
+        columns["type"][1].append(self._dictionaries["type"].encode(doc.get("type")))
+        columns["created.user"][1].append(
+            self._dictionaries["created.user"].encode(created.get("user")))
+
+        refs = columns["node_refs.values"][1]
+        for ref in doc.get("node_refs") or ():
+            refs.append(_int(ref))
+        self._ref_count += len(doc.get("node_refs") or ())
+        columns["node_refs.offsets"][1].append(self._ref_count)
+
+        for field, value in doc.items():
+            if field in FIXED_FIELDS:
+                continue
+            if field in NESTED_FIELDS and isinstance(value, dict):
+                for sub_field, sub_value in value.items():
+                    self._add_tag(row, field + "." + sub_field, sub_value)
+            elif not isinstance(value, (dict, list)):
+                self._add_tag(row, field, value)
+
+        self.rows += 1
+        if self.rows - self._chunk_start >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """ append the buffered chunk to the column files """
+        for dtype, values, filename in self._columns.values():
+            if values:
+                with open(os.path.join(self.out_dir, filename), 'ab') as f:
+                    values.tofile(f)
+                del values[:]
+        self._chunk_start = self.rows
+
+    def close(self):
+        self.flush()
+        manifest = {"rows": self.rows, "byteorder": sys.byteorder,
+                    "missing": MISSING, "columns": {}, "tags": {}}
+        for name, (dtype, _, filename) in self._columns.items():
+            manifest["columns"][name] = {"dtype": dtype, "file": filename}
+        for name, dictionary in self._dictionaries.items():
+            manifest["columns"][name]["values"] = dictionary.values
+        for field, (_, _, dictionary, number) in self._tags.items():
+            manifest["tags"][field] = {"rows": "tag.%d.rows" % number,
+                                       "codes": "tag.%d.codes" % number,
+                                       "values": dictionary.values}
+        with open(os.path.join(self.out_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DictColumn(object):
+    """ dictionary-encoded column: value of row i is values[codes[i]]
+
+        For sparse tag columns `rows` lists the rows that have a value;
+        codes[j] belongs to row rows[j].
+    """
+
+    def __init__(self, codes, values, rows=None):
+        self.codes = codes
+        self.values = values
+        self.rows = rows
+
+    def decode(self):
+        values = self.values
+        return [values[code] for code in self.codes]
+
+
+class ListColumn(object):
+    """ variable-length lists: row i is values[offsets[i]:offsets[i + 1]] """
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __getitem__(self, row):
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+
+def _map_array(path, dtype):
+    """ a read-only array over a column file, memory-mapped when possible """
+    if np is not None:
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=NUMPY_DTYPES[dtype])
+        return np.memmap(path, dtype=NUMPY_DTYPES[dtype], mode='r')
+    typecode = TYPECODES[dtype]
+    if os.path.getsize(path) and hasattr(memoryview, "cast"):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped).cast(typecode)
+    values = array.array(typecode)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+def read_manifest(in_dir):
+    with open(os.path.join(in_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def load_columns(in_dir, names=None):
+    """ {name: column} for the requested columns, tag fields named
+        "tags/<field>" (all of them when `names` is None)
+
+        Numeric columns are arrays (numpy memmaps when numpy is
+        installed), 'type', 'created.user' and tag fields are DictColumns,
+        'node_refs' is a ListColumn.
+    """
+    manifest = read_manifest(in_dir)
+    columns, tags = manifest["columns"], manifest["tags"]
+    if names is None:
+        names = ([name for name, _ in NUMERIC_COLUMNS] + list(DICTIONARY_COLUMNS)
+                 + ["node_refs"] + [TAG_PREFIX + field for field in sorted(tags)])
+
+    def load(name):
+        spec = columns[name]
+        return _map_array(os.path.join(in_dir, spec["file"]), spec["dtype"])
+
+    result = {}
+    for name in names:
+        if name == "node_refs":
+            result[name] = ListColumn(load("node_refs.offsets"), load("node_refs.values"))
+        elif name in DICTIONARY_COLUMNS:
+            result[name] = DictColumn(load(name), columns[name]["values"])
+        elif name.startswith(TAG_PREFIX):
+            spec = tags.get(name[len(TAG_PREFIX):])
+            if spec is None:
+                raise KeyError("no tag column %r in %s" % (name, in_dir))
+            result[name] = DictColumn(load(spec["codes"]), spec["values"],
+                                      rows=load(spec["rows"]))
+        elif name in columns:
+            result[name] = load(name)
+        else:
+            raise KeyError("no column %r in %s (tag columns are named %s<field>)"
+                           % (name, in_dir, TAG_PREFIX))
+    return result
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""
+    Incremental ingestion of OsmChange (.osc) files.
+
+    Rerunning run() on a full extract inserts millions of documents again.
+    apply_changes() reads a daily or hourly change file instead, shapes
+    the created and modified elements with the same shape_element() as
+    the full import, and applies them to the collection as bulk upserts
+    and deletes keyed on the element type and id:
+
+    stats = apply_changes("data/singapore-daily.osc.gz", shape_element,
+                          db.singaporeOSM)
+
+    An element is only written when its version is higher than the one
+    already stored, so replaying a change file, or applying files out of
+    order, never rolls a stored document back to an older version.
+    Nodes and ways that shape_element() rejects on modify (e.g. moved
+    outside Singapore) are deleted. Relations, which shape_element()
+    never shapes, are only deleted by a delete. Every delete leaves a
+    tombstone, the type, id and version of the element, in the
+    `tombstones` collection (<collection>_tombstones by default), so an
+    older create or modify replayed afterwards does not bring a deleted
+    element back.
+
+    When `summaries` (a Summaries, see osm_summary.py) is given, the
+    replaced and deleted documents are taken out of its counts and the
+    new ones added, so the summaries stay in step with the collection.
+"""
+
+from collections import OrderedDict
+import xml.etree.cElementTree as ET
+
+from pymongo import ASCENDING, DeleteOne, ReplaceOne
+
+from osm_summary import FIELDS as SUMMARY_FIELDS
+from osm_utils import TOP_LEVEL_TAGS, clock, open_osm, string_types
+
+
+ACTIONS = ("create", "modify", "delete")
+
+
+class DeltaStats(object):
+    """ what apply_changes() did to the collection """
+
+    def __init__(self):
+        self.changes = 0
+        self.upserted = 0
+        self.deleted = 0
+        self.stale = 0
+        self.ignored = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return ("%d changes in %.2f seconds: %d upserted, %d deleted, %d older "
+                "than the stored version, %d ignored" % (
+                    self.changes, self.seconds, self.upserted, self.deleted,
+                    self.stale, self.ignored))
+
+
+def iter_changes(source):
+    """ yield (action, element) for every node, way and relation of an
+        OsmChange file, where action is 'create', 'modify' or 'delete'
+
+        Elements are cleared once the caller asks for the next one.
+    """
+    f = open_osm(source) if isinstance(source, string_types) else source
+    try:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        action, block = None, None
+        for event, elem in context:
+            if event == "start":
+                if elem.tag in ACTIONS:
+                    action, block = elem.tag, elem
+            elif elem.tag in TOP_LEVEL_TAGS and block is not None:
+                yield action, elem
+                block.clear()
+            elif elem.tag in ACTIONS:
+                action, block = None, None
+                root.clear()
+    finally:
+        if f is not source:
+            f.close()
+
+
+def _version(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _stored_documents(collection, keys, fields=()):
+    """ {(type, id): (version, document)} of the documents already in the
+        collection, with only the id, type, version and `fields`
+    """
+    ids = list(set(element_id for _, element_id in keys))
+    projection = dict.fromkeys(("id", "type", "created.version") + tuple(fields), 1)
+    stored = {}
+    for doc in collection.find({"id": {"$in": ids}}, projection):
+        version = _version((doc.get("created") or {}).get("version"))
+        stored[(doc.get("type"), doc.get("id"))] = (version, doc)
+    return stored
+
+
+def _deleted_versions(tombstones, keys):
+    """ {(type, id): version} of the tombstones of deleted elements """
+    ids = list(set(element_id for _, element_id in keys))
+    deleted = {}
+    for doc in tombstones.find({"id": {"$in": ids}}, {"id": 1, "type": 1, "version": 1}):
+        deleted[(doc.get("type"), doc.get("id"))] = _version(doc.get("version"))
+    return deleted
+
+
+def _flush(collection, tombstones, batch, stats, summaries=None):
+    stored = _stored_documents(collection, list(batch),
+                               SUMMARY_FIELDS if summaries is not None else ())
+    deleted = _deleted_versions(tombstones, list(batch))
+    requests = []
+    tombstone_requests = []
+    for key, (action, version, doc) in batch.items():
+        stored_version, stored_doc = stored.get(key, (None, None))
+        # a deleted element has no document, only its tombstone
+        versions = [v for v in (stored_version, deleted.get(key)) if v is not None]
+        current = max(versions) if versions else None
+        if current is not None and current >= version:
+            stats.stale += 1
+            continue
+        key_filter = {"type": key[0], "id": key[1]}
+        if action == "delete" or doc is None:
+            tombstone_requests.append(ReplaceOne(
+                key_filter, {"type": key[0], "id": key[1], "version": version},
+                upsert=True))
+            if stored_doc is None:
+                stats.ignored += 1
+                continue
+            requests.append(DeleteOne(key_filter))
+            stats.deleted += 1
+        else:
+            requests.append(ReplaceOne(key_filter, doc, upsert=True))
+            stats.upserted += 1
+        if summaries is not None:
+            if stored_doc is not None:
+                summaries.remove(stored_doc)
+            if doc is not None and action != "delete":
+                summaries.add(doc)
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    if tombstone_requests:
+        tombstones.bulk_write(tombstone_requests, ordered=False)
+    stats.batches += 1
+
+
+def apply_changes(filename, shape, collection, batch_size=1000, summaries=None,
+                  tombstones=None):
+    """ apply an OsmChange file to `collection` and return a DeltaStats
+
+        Changes are applied in unordered bulk writes of up to `batch_size`
+        elements; within a batch only the highest version of an element
+        is kept. The versions of deleted elements are kept in
+        `tombstones`, a collection that defaults to
+        <collection>_tombstones.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if tombstones is None:
+        tombstones = collection.database[collection.name + "_tombstones"]
+    # every batch looks up and writes documents by type and id
+    collection.create_index([("id", ASCENDING), ("type", ASCENDING)])
+    tombstones.create_index([("id", ASCENDING), ("type", ASCENDING)])
+
+    stats = DeltaStats()
+    start_time = clock()
+    batch = OrderedDict()
+    for action, element in iter_changes(filename):
+        stats.changes += 1
+        key = (element.tag, element.get("id"))
+        version = _version(element.get("version"))
+        doc = shape(element) if action != "delete" else None
+        if doc is None and action != "delete" and element.tag == "relation":
+            # shape_element() skips every relation, which does not mean the
+            # relation written by join_map() is to be deleted
+            stats.ignored += 1
+            continue
+
+        previous = batch.get(key)
+        if previous is not None:
+            # one of the two versions in this batch is superseded
+            stats.stale += 1
+            if version < previous[1]:
+                continue
+        batch[key] = (action, version, doc)
+        if len(batch) >= batch_size:
+            _flush(collection, tombstones, batch, stats, summaries)
+            batch = OrderedDict()
+    if batch:
+        _flush(collection, tombstones, batch, stats, summaries)
+
+    stats.seconds = clock() - start_time
+    return stats
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+    expat parsing backend for the audit and the shaping of an OSM file.
+
+    iterparse() builds an Element, with its own attrib dict, for every
+    <tag> and <nd> child, only for it to be read once and cleared.
+    The functions here work straight from the start-tag callbacks of
+    expat instead, and give the same results as their ElementTree
+    counterparts:
+
+    expat_audit("data/singapore.osm")     -> same AuditReport as audit_map()
+    expat_shape_map("data/singapore.osm", rules, CREATED)
+                                          -> same documents as
+                                             shape_map(filename, shape_element)
+
+    expat_shape_map() does what shape_element() of osm_shape.py does --
+    id, type, created fields and pos from the attributes, tags through
+    the TagRules, node refs -- so both have to be changed together;
+    test_osm_expat.py checks that they give the same documents. Run this
+    module on an OSM file to compare the speed of the audits:
+
+    python osm_expat.py data/singapore.osm
+"""
+
+import os
+import sys
+from xml.parsers import expat
+
+from osm_audit import AuditReport, audit_map, classify_key
+from osm_utils import MemorySampler, clock, open_osm, string_types
+
+
+READ_SIZE = 1024 * 1024
+
+
+def _parse(source, start, end=None, flush=None):
+    """ feed `source` to an expat parser calling start(name, attrs) and
+        end(name); flush() is called after every block and yields what
+        the callbacks produced
+    """
+    f = open_osm(source) if isinstance(source, string_types) else source
+    try:
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        if end is not None:
+            parser.EndElementHandler = end
+        while True:
+            data = f.read(READ_SIZE)
+            parser.Parse(data, not data)
+            if flush is not None:
+                for item in flush():
+                    yield item
+            if not data:
+                break
+    finally:
+        if f is not source:
+            f.close()
+
+
+def expat_audit(filename):
+    """ audit_map() with expat: count elements, attributes, keys and key
+        format classes in a single pass and return an AuditReport
+    """
+    report = AuditReport(filename)
+    try:
+        report.bytes = os.path.getsize(filename)
+    except (TypeError, OSError):
+        pass
+
+    tags, attrs, keys, key_types = (report.tags, report.attrs, report.keys,
+                                    report.key_types)
+    classified = {}
+
+    def start(name, attributes):
+        tags[name] += 1
+        for attr in attributes:
+            attrs[attr] += 1
+        if name == "tag":
+            key = attributes.get("k")
+            if key:
+                keys[key] += 1
+                try:
+                    key_types[classified[key]] += 1
+                except KeyError:
+                    key_type = classified[key] = classify_key(key)
+                    key_types[key_type] += 1
+
+    start_time = clock()
+    with MemorySampler() as memory:
+        for _ in _parse(filename, start):
+            pass
+
+    report.elements = sum(tags.values())
+    report.seconds = clock() - start_time
+    report.peak_rss_kb = memory.peak_kb
+    return report
+
+
+def expat_shape_map(filename, rules, created):
+    """ yield the documents of shape_map(filename, shape_element) of the
+        wrangling script, for the same TagRules and CREATED fields
+    """
+    done = []
+    # [document being built or None, True once one of its tags rejected it]
+    current = [None, False]
+    apply_rule = rules.apply
+    created = tuple(created)
+
+    # there is no end tag callback: a document is complete when the next
+    # top-level element starts, or at the end of the file
+    def start(name, attrs):
+        if name == "tag":
+            doc = current[0]
+            if doc is not None and not current[1]:
+                if not apply_rule(doc, attrs.get("k"), attrs.get("v")):
+                    current[1] = True
+        elif name == "node" or name == "way":
+            if current[0] is not None and not current[1]:
+                done.append(current[0])
+            get = attrs.get
+            doc = {"id": get("id"),
+                   "type": name,
+                   "visible": "true",
+                   "names": {},
+                   "address": {},
+                   "node_refs": [],
+                   "created": dict(zip(created, map(get, created)))}
+            lat, lon = get("lat"), get("lon")
+            if lat and lon:
+                doc["pos"] = [float(lat), float(lon)]
+            current[0] = doc
+            current[1] = False
+        elif name == "nd":
+            doc = current[0]
+            if doc is not None:
+                doc["node_refs"].append(attrs.get("ref"))
+        elif name == "relation":
+            if current[0] is not None and not current[1]:
+                done.append(current[0])
+            current[0] = None
+
+    def flush():
+        documents = list(done)
+        del done[:]
+        return documents
+
+    for doc in _parse(filename, start, flush=flush):
+        yield doc
+    if current[0] is not None and not current[1]:
+        yield current[0]
+
+
+def benchmark(filename):
+    """ elements/sec of audit_map() and expat_audit(), and whether they
+        found the same counts
+    """
+    results = []
+    for audit in (audit_map, expat_audit):
+        report = audit(filename)
+        results.append(report)
+        print("%-12s %.2f seconds, %.0f elements/sec" % (
+            audit.__name__, report.seconds, report.elements_per_sec))
+    same = all(getattr(results[0], name) == getattr(results[1], name)
+               for name in ("tags", "attrs", "keys", "key_types", "elements"))
+    print("same counts" if same else "DIFFERENT COUNTS")
+    return same
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else "data/singapore.osm")
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""
+    Geometric filter of the documents against a boundary polygon.
+
+    inSingapore() only drops Malaysian and Indonesian data when an
+    addr:city, is_in:country or addr:country tag says so, and most nodes
+    of Johor Bahru and Batam have no such tag. A Geofence tests the pos
+    of every document against the boundary polygon of Singapore instead,
+    read from a local Osmosis .poly or GeoJSON file:
+
+    fence = Geofence.from_file("data/singapore.poly")
+    fence.contains(1.2834, 103.8607)    -> True
+    fence.contains(1.4927, 103.7414)    -> False (Johor Bahru)
+
+    for doc in inside_fence(shape_map("data/singapore.osm", shape_element), fence):
+        ...
+
+    The bounding box of the polygon is covered by a grid whose cells are
+    marked inside, outside or boundary when the fence is built. A point
+    in an inside or outside cell costs one lookup; only points in the
+    cells the boundary passes through get an exact (even-odd) point in
+    polygon test, against the edges that cross the row of the cell.
+
+    Run this module to time the fence on random points:
+
+    python osm_geofence.py data/singapore.poly
+"""
+
+import json
+import math
+import random
+import sys
+from bisect import bisect_right
+
+from osm_utils import clock
+
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+# cells along the longer side of the bounding box
+GRID_SIZE = 512
+
+
+def read_poly(filename):
+    """ rings of (lon, lat) points of an Osmosis .poly file; holes (the
+        sections whose name starts with '!') are rings like the others,
+        since the even-odd test handles them
+    """
+    rings = []
+    with open(filename) as f:
+        lines = [line.strip() for line in f]
+    # the first line is the name of the polygon
+    i = 1
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if not line or line == "END":
+            continue
+        ring = []
+        while i < len(lines) and lines[i] != "END":
+            if lines[i]:
+                lon, lat = lines[i].split()[:2]
+                ring.append((float(lon), float(lat)))
+            i += 1
+        i += 1
+        if ring:
+            rings.append(ring)
+    return rings
+
+
+def read_geojson(filename):
+    """ rings of (lon, lat) points of the Polygons and MultiPolygons of a
+        GeoJSON geometry, Feature or FeatureCollection
+    """
+    with open(filename) as f:
+        data = json.load(f)
+    rings = []
+
+    def add(geometry):
+        kind = geometry["type"]
+        if kind == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif kind == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        elif kind == "GeometryCollection":
+            for part in geometry["geometries"]:
+                add(part)
+            return
+        else:
+            return
+        for polygon in polygons:
+            for ring in polygon:
+                rings.append([(float(point[0]), float(point[1])) for point in ring])
+
+    if data["type"] == "FeatureCollection":
+        for feature in data["features"]:
+            add(feature["geometry"])
+    elif data["type"] == "Feature":
+        add(data["geometry"])
+    else:
+        add(data)
+    return rings
+
+
+class Geofence(object):
+    """ point in polygon test accelerated by a grid of inside, outside
+        and boundary cells
+    """
+
+    def __init__(self, rings, grid_size=GRID_SIZE):
+        edges = []
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if (x1, y1) != (x2, y2):
+                    edges.append((x1, y1, x2, y2))
+        if not edges:
+            raise ValueError("the polygon has no edges")
+        self.edges = edges
+
+        xs = [x for x1, _, x2, _ in edges for x in (x1, x2)]
+        ys = [y for _, y1, _, y2 in edges for y in (y1, y2)]
+        self.min_x, self.max_x = min(xs), max(xs)
+        self.min_y, self.max_y = min(ys), max(ys)
+        cell = max(self.max_x - self.min_x, self.max_y - self.min_y) / float(grid_size)
+        self.cell = cell
+        self.columns = max(int(math.ceil((self.max_x - self.min_x) / cell)), 1)
+        self.rows = max(int(math.ceil((self.max_y - self.min_y) / cell)), 1)
+        self.cells = bytearray(self.columns * self.rows)
+        # indexes of the edges overlapping each row
+        self.row_edges = [[] for _ in range(self.rows)]
+
+        for index, (x1, y1, x2, y2) in enumerate(edges):
+            self._mark_edge(index, x1, y1, x2, y2)
+        for row in range(self.rows):
+            self._fill_row(row)
+
+    @classmethod
+    def from_file(cls, filename, grid_size=GRID_SIZE):
+        """ the fence of an Osmosis .poly file, or of a GeoJSON file when
+            the name ends in .json or .geojson
+        """
+        if filename.lower().endswith((".json", ".geojson")):
+            rings = read_geojson(filename)
+        else:
+            rings = read_poly(filename)
+        return cls(rings, grid_size)
+
+    def _row(self, y):
+        return min(max(int((y - self.min_y) / self.cell), 0), self.rows - 1)
+
+    def _column(self, x):
+        return min(max(int((x - self.min_x) / self.cell), 0), self.columns - 1)
+
+    def _mark_edge(self, index, x1, y1, x2, y2):
+        """ mark every cell the edge passes through as boundary """
+        if y1 == y2:
+            # a horizontal edge never crosses the ray of the exact test,
+            # but the cells on either side of it differ
+            row = self._row(y1)
+            offset = row * self.columns
+            for column in range(self._column(min(x1, x2)), self._column(max(x1, x2)) + 1):
+                self.cells[offset + column] = BOUNDARY
+            return
+        if y1 > y2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        slope = (x2 - x1) / (y2 - y1)
+        for row in range(self._row(y1), self._row(y2) + 1):
+            self.row_edges[row].append(index)
+            # the part of the edge within the row
+            bottom = max(y1, self.min_y + row * self.cell)
+            top = min(y2, self.min_y + (row + 1) * self.cell)
+            xa = x1 + (bottom - y1) * slope
+            xb = x1 + (top - y1) * slope
+            first, last = self._column(min(xa, xb)), self._column(max(xa, xb))
+            offset = row * self.columns
+            for column in range(first, last + 1):
+                self.cells[offset + column] = BOUNDARY
+
+    def _fill_row(self, row):
+        """ mark the other cells of a row from the crossings of the edges
+            with a line through the middle of the row
+        """
+        y = self.min_y + (row + 0.5) * self.cell
+        crossings = sorted(self._crossings(self.row_edges[row], y))
+        offset = row * self.columns
+        for column in range(self.columns):
+            if self.cells[offset + column] == BOUNDARY:
+                continue
+            x = self.min_x + (column + 0.5) * self.cell
+            # crossings to the right of the centre
+            if (len(crossings) - bisect_right(crossings, x)) % 2:
+                self.cells[offset + column] = INSIDE
+
+    def _crossings(self, edge_indexes, y):
+        edges = self.edges
+        for index in edge_indexes:
+            x1, y1, x2, y2 = edges[index]
+            if (y1 > y) != (y2 > y):
+                yield x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+
+    def exact_contains(self, lat, lon, edge_indexes=None):
+        """ even-odd point in polygon test against all the edges (or the
+            given ones, which must include every edge crossing lat)
+        """
+        if edge_indexes is None:
+            edge_indexes = range(len(self.edges))
+        inside = False
+        for x in self._crossings(edge_indexes, lat):
+            if x > lon:
+                inside = not inside
+        return inside
+
+    def contains(self, lat, lon):
+        """ True when the point is inside the polygon """
+        if not (self.min_y <= lat <= self.max_y and self.min_x <= lon <= self.max_x):
+            return False
+        row = min(int((lat - self.min_y) / self.cell), self.rows - 1)
+        column = min(int((lon - self.min_x) / self.cell), self.columns - 1)
+        state = self.cells[row * self.columns + column]
+        if state == BOUNDARY:
+            return self.exact_contains(lat, lon, self.row_edges[row])
+        return state == INSIDE
+
+    def cell_counts(self):
+        """ {OUTSIDE: cells, INSIDE: cells, BOUNDARY: cells} """
+        return dict((state, self.cells.count(bytearray([state])))
+                    for state in (OUTSIDE, INSIDE, BOUNDARY))
+
+
+def inside_fence(documents, fence, rejected=None):
+    """ yield the documents whose pos (or centroid, for ways shaped with
+        geometry) is inside the fence; documents with neither are kept
+
+        rejected, a dict, counts the dropped documents by type.
+    """
+    contains = fence.contains
+    for doc in documents:
+        point = doc.get("pos") or doc.get("centroid")
+        if point and not contains(point[0], point[1]):
+            if rejected is not None:
+                rejected[doc.get("type")] = rejected.get(doc.get("type"), 0) + 1
+            continue
+        yield doc
+
+
+def benchmark(fence, n=1000000, seed=0):
+    """ points/sec of contains() on random points of the bounding box
+        (plus a margin), checked against exact_contains() on a sample
+    """
+    rng = random.Random(seed)
+    margin_x = 0.1 * (fence.max_x - fence.min_x)
+    margin_y = 0.1 * (fence.max_y - fence.min_y)
+    points = [(rng.uniform(fence.min_y - margin_y, fence.max_y + margin_y),
+               rng.uniform(fence.min_x - margin_x, fence.max_x + margin_x))
+              for _ in range(n)]
+
+    contains = fence.contains
+    start_time = clock()
+    inside = sum(1 for lat, lon in points if contains(lat, lon))
+    seconds = clock() - start_time
+
+    checked = points[:10000]
+    wrong = sum(1 for lat, lon in checked
+                if contains(lat, lon) != fence.exact_contains(lat, lon))
+    counts = fence.cell_counts()
+    print("%d edges, %dx%d grid: %d inside, %d outside, %d boundary cells" % (
+        len(fence.edges), fence.columns, fence.rows, counts[INSIDE],
+        counts[OUTSIDE], counts[BOUNDARY]))
+    print("%d of %d points inside in %.2f seconds (%.0f points/sec, %.1f million/min)" % (
+        inside, n, seconds, n / seconds, n / seconds * 60 / 1e6))
+    print("%d of %d differ from the exact test" % (wrong, len(checked)))
+    return n / seconds
+
+
+if __name__ == '__main__':
+    benchmark(Geofence.from_file(sys.argv[1] if len(sys.argv) > 1 else "data/singapore.poly"))
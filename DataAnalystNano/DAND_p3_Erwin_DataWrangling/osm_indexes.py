@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+"""
+    Indexes for the queries of the wrangling script, built after the load.
+
+    process_map() loads final_project.singaporeOSM without any index, so
+    every Section III query is a collection scan. build_indexes() creates
+    one index per query pattern of the script once the bulk load is done
+    (maintaining them during the load would slow every insert down):
+
+    build_indexes(db.singaporeOSM)
+
+    type                     counts of nodes and ways
+    amenity                  top amenities
+    created.user             distinct users, documents per user
+    amenity + cuisine        cuisines of the restaurants
+    amenity + religion       religions of the places of worship
+    pos (2d)                 geospatial queries
+
+    pos is stored as [lat, lon], while a 2dsphere index reads legacy
+    coordinate pairs as [lon, lat] and rejects Singapore's longitudes as
+    latitudes, so pos gets a flat '2d' index; queries on it give points as
+    [lat, lon] too.
+
+    Run this module against a local mongod to time the Section III
+    queries with and without the indexes:
+
+    python osm_indexes.py
+"""
+
+import sys
+
+from pymongo import ASCENDING, GEO2D, IndexModel, MongoClient
+
+from osm_aggregate import SECTION_III_PIPELINES, count_documents, same_results
+from osm_utils import clock
+
+
+INDEXES = [
+    ([("type", ASCENDING)], "type"),
+    ([("amenity", ASCENDING)], "amenity"),
+    ([("created.user", ASCENDING)], "created_user"),
+    ([("amenity", ASCENDING), ("cuisine", ASCENDING)], "amenity_cuisine"),
+    ([("amenity", ASCENDING), ("religion", ASCENDING)], "amenity_religion"),
+    ([("pos", GEO2D)], "pos_2d"),
+]
+
+# name, query, pipeline of the query
+SECTION_III_QUERIES = [
+    ("documents", lambda c: count_documents(c, {}), None),
+    ("nodes", lambda c: count_documents(c, {"type": "node"}), None),
+    ("ways", lambda c: count_documents(c, {"type": "way"}), None),
+    ("unique users", lambda c: sorted(c.distinct("created.user")), None),
+] + [(name, lambda c, pipeline=pipeline: list(c.aggregate(pipeline)), pipeline)
+     for name, pipeline in SECTION_III_PIPELINES]
+
+
+def build_indexes(collection, indexes=INDEXES):
+    """ create the indexes, which is a no-op for the ones that exist, and
+        return how many seconds it took
+    """
+    start_time = clock()
+    collection.create_indexes([IndexModel(keys, name=name) for keys, name in indexes])
+    return clock() - start_time
+
+
+def drop_indexes(collection, indexes=INDEXES):
+    """ drop the indexes created by build_indexes() """
+    existing = collection.index_information()
+    for _, name in indexes:
+        if name in existing:
+            collection.drop_index(name)
+
+
+def time_queries(collection, queries=SECTION_III_QUERIES, repeat=5):
+    """ {name: (median seconds, result)} of the queries """
+    timings = {}
+    for name, query, _ in queries:
+        seconds = []
+        for _ in range(repeat):
+            start_time = clock()
+            result = query(collection)
+            seconds.append(clock() - start_time)
+        seconds.sort()
+        timings[name] = (seconds[len(seconds) // 2], result)
+    return timings
+
+
+def benchmark(collection, repeat=5):
+    """ median latency of the Section III queries without and with the
+        indexes; the indexes are left in place
+    """
+    drop_indexes(collection)
+    without = time_queries(collection, repeat=repeat)
+    build_seconds = build_indexes(collection)
+    with_indexes = time_queries(collection, repeat=repeat)
+
+    print("indexes built in %.2f seconds" % build_seconds)
+    print("%-24s %12s %12s" % ("query", "no index", "indexed"))
+    for name, _, pipeline in SECTION_III_QUERIES:
+        if pipeline is None:
+            verdict = "match" if without[name][1] == with_indexes[name][1] else "MISMATCH"
+        else:
+            verdict = same_results(with_indexes[name][1], without[name][1], pipeline)
+        print("%-24s %10.1fms %10.1fms   %s" % (
+            name, 1000 * without[name][0], 1000 * with_indexes[name][0], verdict))
+
+
+if __name__ == '__main__':
+    benchmark(MongoClient().final_project.singaporeOSM,
+              repeat=int(sys.argv[1]) if len(sys.argv) > 1 else 5)
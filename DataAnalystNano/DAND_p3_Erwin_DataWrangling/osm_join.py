@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+"""
+    Out-of-core join of ways and relations with their node coordinates.
+
+    NodeStore (osm_nodes.py) keeps every node position in memory, which is
+    fine for a city but not for a country or continent extract. join_map()
+    resolves way and relation geometry with bounded memory instead, by
+    external sorting:
+
+    1. one pass over the file spills (node id, lat, lon), the node refs
+       of the ways and relations and the way members of the relations to
+       sorted runs in a temporary directory;
+    2. the sorted nodes are merge-joined with the sorted refs, giving the
+       points of every way and node member, and the way points are
+       merge-joined with the way members of the relations;
+    3. a second pass shapes the elements and merges in the geometry,
+       which is sorted by id like the elements of the file.
+
+    for doc in join_map("data/north-america.osm.bz2", shape_element, rules, CREATED,
+                        memory_mb=512):
+        ...
+
+    Ways get a 'geometry' list of [lat, lon] points plus the fields of
+    geometry_fields(); relations get 'members' whose node members have a
+    'pos' and whose way members have a 'geometry'. Relation members of
+    relations are listed without geometry. Relations that shape() skips
+    are shaped by shape_relation() with the same TagRules and CREATED
+    fields, so their tags are placed and cleaned like those of the nodes
+    and ways.
+
+    The file must list the ways and the relations in ascending id order,
+    as extracts sorted by osmosis or osmium do.
+"""
+
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+from itertools import groupby
+
+from osm_nodes import geometry_fields
+from osm_utils import clock, iter_elements
+
+
+MEMORY_MB = 256
+FAN_IN = 64
+BLOCK_RECORDS = 4096
+
+# (node id, lat, lon)
+NODE = struct.Struct("=qdd")
+# (node id, owner kind, owner id, position in the owner)
+NODE_REF = struct.Struct("=qbqq")
+# (way id, position in the way, lat, lon)
+WAY_POINT = struct.Struct("=qqdd")
+# (way id, relation id, member position)
+WAY_MEMBER = struct.Struct("=qqq")
+# (relation id, member position, position in the member, lat, lon)
+MEMBER_POINT = struct.Struct("=qqqdd")
+
+WAY, RELATION = 0, 1
+
+# rough size of a record as a tuple in memory: the tuple plus its fields
+TUPLE_BYTES = 56
+FIELD_BYTES = 32
+
+
+class ExternalSorter(object):
+    """ sorts fixed-size records (tuples packed with `record`, a
+        struct.Struct) that do not fit in `memory_bytes`, by spilling
+        sorted runs to `tmp_dir` and merging them
+    """
+
+    def __init__(self, record, memory_bytes, tmp_dir):
+        self.record = record
+        fields = len(record.unpack(b"\0" * record.size))
+        self.max_records = max(1, memory_bytes // (TUPLE_BYTES + FIELD_BYTES * fields))
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self.records = 0
+        self._buffer = []
+
+    def add(self, *values):
+        self._buffer.append(values)
+        self.records += 1
+        if len(self._buffer) >= self.max_records:
+            self._spill()
+
+    def _write_run(self, records):
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self.tmp_dir)
+        pack = self.record.pack
+        with os.fdopen(fd, "wb") as f:
+            block = []
+            for values in records:
+                block.append(pack(*values))
+                if len(block) >= BLOCK_RECORDS:
+                    f.write(b"".join(block))
+                    block = []
+            f.write(b"".join(block))
+        self.runs.append(path)
+
+    def _spill(self):
+        self._buffer.sort()
+        self._write_run(self._buffer)
+        self._buffer = []
+
+    def _read_run(self, path):
+        size = self.record.size
+        unpack_from = self.record.unpack_from
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(size * BLOCK_RECORDS)
+                if not data:
+                    break
+                for offset in range(0, len(data), size):
+                    yield unpack_from(data, offset)
+
+    def __iter__(self):
+        """ all the records in order; can be iterated more than once """
+        if self._buffer:
+            self._spill()
+        # merge the oldest runs first so no merge opens more than FAN_IN files
+        while len(self.runs) > FAN_IN:
+            merged, self.runs = self.runs[:FAN_IN], self.runs[FAN_IN:]
+            self._write_run(heapq.merge(*[self._read_run(path) for path in merged]))
+            for path in merged:
+                os.remove(path)
+        return heapq.merge(*[self._read_run(path) for path in self.runs])
+
+
+class JoinStats(object):
+    """ what join_map() resolved and how much it spilled """
+
+    def __init__(self):
+        self.nodes = 0
+        self.ways = 0
+        self.relations = 0
+        self.refs = 0
+        self.missing_refs = 0
+        self.runs = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return ("%d nodes, %d ways, %d relations; %d refs (%d missing) joined "
+                "through %d sorted runs in %.2f seconds" % (
+                    self.nodes, self.ways, self.relations, self.refs,
+                    self.missing_refs, self.runs, self.seconds))
+
+
+def shape_relation(element, rules, created):
+    """ the document of a <relation> shaped like shape_element() shapes
+        a way, with its tags applied by `rules` (a TagRules), or None when
+        one of them rejects it
+
+        The 'type' tag of a relation (multipolygon, route, ...) goes to
+        'relation_type', so that 'type' stays "relation".
+    """
+    doc = {"id": element.get("id"),
+           "type": "relation",
+           "visible": "true",
+           "names": {},
+           "address": {},
+           "created": dict((field, element.get(field)) for field in created)}
+    for tag in element.iter("tag"):
+        key, value = tag.get("k"), tag.get("v")
+        if key == "type":
+            doc["relation_type"] = value
+        elif not rules.apply(doc, key, value):
+            return None
+    return doc
+
+
+def _spill_refs(filename, sorters, stats):
+    """ first pass: nodes, node refs of ways and relations, way members """
+    nodes, node_refs, way_members = sorters
+    for element in iter_elements(filename):
+        if element.tag == "node":
+            if element.get("lat") is not None and element.get("lon") is not None:
+                nodes.add(int(element.get("id")), float(element.get("lat")),
+                          float(element.get("lon")))
+                stats.nodes += 1
+        elif element.tag == "way":
+            way_id = int(element.get("id"))
+            for position, nd in enumerate(element.iter("nd")):
+                node_refs.add(int(nd.get("ref")), WAY, way_id, position)
+            stats.ways += 1
+        elif element.tag == "relation":
+            relation_id = int(element.get("id"))
+            for position, member in enumerate(element.iter("member")):
+                if member.get("type") == "node":
+                    node_refs.add(int(member.get("ref")), RELATION, relation_id, position)
+                elif member.get("type") == "way":
+                    way_members.add(int(member.get("ref")), relation_id, position)
+            stats.relations += 1
+
+
+def _join_nodes(nodes, node_refs, way_points, member_points, stats):
+    """ merge-join sorted nodes with the sorted node refs """
+    node_iter = iter(nodes)
+    node = next(node_iter, None)
+    for node_id, kind, owner_id, position in node_refs:
+        stats.refs += 1
+        while node is not None and node[0] < node_id:
+            node = next(node_iter, None)
+        if node is None or node[0] != node_id:
+            stats.missing_refs += 1
+            continue
+        if kind == WAY:
+            way_points.add(owner_id, position, node[1], node[2])
+        else:
+            member_points.add(owner_id, position, 0, node[1], node[2])
+
+
+def _join_way_members(way_points, way_members, member_points):
+    """ merge-join the points of the ways with the sorted way members of
+        the relations
+    """
+    ways = groupby(way_points, key=lambda point: point[0])
+    way_id, points = next(ways, (None, None))
+    for member_way_id, relation_id, position in way_members:
+        while way_id is not None and way_id < member_way_id:
+            way_id, points = next(ways, (None, None))
+        if way_id != member_way_id:
+            continue
+        if not isinstance(points, list):
+            # several relations can share a way
+            points = list(points)
+        for point_position, (_, _, lat, lon) in enumerate(points):
+            member_points.add(relation_id, position, point_position, lat, lon)
+
+
+class _Groups(object):
+    """ groups of sorted records keyed on their first field, looked up in
+        ascending key order
+    """
+
+    def __init__(self, records, what):
+        self._groups = groupby(records, key=lambda record: record[0])
+        self._what = what
+        self._last = None
+        self._next()
+
+    def _next(self):
+        self._key, self._records = next(self._groups, (None, None))
+
+    def get(self, key):
+        if self._last is not None and key < self._last:
+            raise ValueError("%ss are not sorted by id: %d after %d"
+                             % (self._what, key, self._last))
+        self._last = key
+        while self._key is not None and self._key < key:
+            self._next()
+        if self._key != key:
+            return []
+        records = list(self._records)
+        self._next()
+        return records
+
+
+def join_map(filename, shape, rules, created, memory_mb=MEMORY_MB, tmp_dir=None,
+             stats=None):
+    """ yield shape(element) for every top-level element of the file,
+        skipping the ones shape() rejects, with the geometry of ways and
+        relations resolved in `memory_mb` megabytes
+
+        Relations that shape() skips are shaped by shape_relation() with
+        `rules` and the `created` fields, the ones shape() uses for nodes
+        and ways. Pass a JoinStats as `stats` to get the counts. The sorted runs go
+        to a temporary directory in `tmp_dir` and are removed at the end.
+    """
+    stats = stats if stats is not None else JoinStats()
+    start_time = clock()
+    work_dir = tempfile.mkdtemp(prefix="osm_join", dir=tmp_dir)
+    try:
+        # at most three sorters fill at the same time
+        memory_bytes = memory_mb * 1024 * 1024 // 3
+        sorters = [ExternalSorter(record, memory_bytes, work_dir)
+                   for record in (NODE, NODE_REF, WAY_MEMBER, WAY_POINT, MEMBER_POINT)]
+        nodes, node_refs, way_members, way_points, member_points = sorters
+
+        _spill_refs(filename, (nodes, node_refs, way_members), stats)
+        _join_nodes(nodes, node_refs, way_points, member_points, stats)
+        _join_way_members(way_points, way_members, member_points)
+
+        way_groups = _Groups(way_points, "way")
+        member_groups = _Groups(member_points, "relation")
+        stats.runs = sum(len(sorter.runs) for sorter in sorters)
+        stats.seconds = clock() - start_time
+
+        for element in iter_elements(filename):
+            doc = shape(element)
+            if element.tag == "way":
+                points = [[lat, lon] for _, _, lat, lon
+                          in way_groups.get(int(element.get("id")))]
+                if doc:
+                    doc["geometry"] = points
+                    doc.update(geometry_fields(points) or {})
+            elif element.tag == "relation":
+                points = member_groups.get(int(element.get("id")))
+                doc = doc or shape_relation(element, rules, created)
+                if doc:
+                    doc["members"] = _members(element, points)
+            if doc:
+                yield doc
+        stats.seconds = clock() - start_time
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _members(element, member_points):
+    """ the members of a relation with the points resolved for them """
+    points = dict((position, [[lat, lon] for _, _, _, lat, lon in group])
+                  for position, group in groupby(member_points, key=lambda point: point[1]))
+    members = []
+    for position, member in enumerate(element.iter("member")):
+        doc = {"type": member.get("type"), "ref": member.get("ref"),
+               "role": member.get("role")}
+        if position in points:
+            if doc["type"] == "node":
+                doc["pos"] = points[position][0]
+            else:
+                doc["geometry"] = points[position]
+        members.append(doc)
+    return members
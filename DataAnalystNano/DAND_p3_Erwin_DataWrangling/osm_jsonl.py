@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+"""
+    Compressed JSON-lines output of the shaped documents, and a streaming
+    reader for it.
+
+    The JSON file written by process_map() is several times the size of
+    the OSM file. JSONLinesWriter writes the documents gzip or zstd
+    compressed instead: they are encoded into blocks of `block_size`
+    bytes, and every block is compressed on a thread pool as a gzip
+    member or zstd frame of its own (zlib and zstd release the GIL while
+    compressing) and written in order. Concatenated members and frames
+    are valid .gz and .zst files, readable by zcat, zstdcat or any
+    library:
+
+    with JSONLinesWriter("data/singapore.osm.json.gz") as out:
+        for doc in docs:
+            out.write_document(doc)
+
+    for doc in read_json_lines("data/singapore.osm.json.gz"):
+        ...
+
+    Without `pretty`, documents are encoded with orjson when it is
+    installed, and with a compact json encoder otherwise. zstd needs the
+    zstandard module.
+"""
+
+import json
+import zlib
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from osm_utils import DecompressingReader
+
+
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+SUFFIXES = dict((compression, suffix) for suffix, compression in COMPRESSIONS.items())
+
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+_compact_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def compression_of(filename):
+    """ 'gzip', 'zstd' or None, from the extension of a file name """
+    for suffix, compression in COMPRESSIONS.items():
+        if filename.lower().endswith(suffix):
+            return compression
+    return None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ValueError("zstd compression needs the zstandard module "
+                         "(pip install zstandard)")
+
+
+def encode_document(doc):
+    """ one line of compact JSON, as UTF-8 bytes """
+    if orjson is not None:
+        return orjson.dumps(doc) + b"\n"
+    return (_compact_encoder.encode(doc) + "\n").encode("utf-8")
+
+
+def encode_pretty(doc):
+    """ the document indented like process_map(pretty=True) """
+    return (json.dumps(doc, indent=2) + "\n").encode("utf-8")
+
+
+def _gzip_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zstd_block(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class JSONLinesWriter(object):
+    """ write documents one JSON document a line to a plain, gzip or
+        zstd file, compressing blocks of it on `threads` threads
+    """
+
+    def __init__(self, filename, compression="infer", level=None, threads=None,
+                 block_size=BLOCK_SIZE, pretty=False, offset=None):
+        if compression == "infer":
+            compression = compression_of(filename)
+        if compression not in (None, "gzip", "zstd"):
+            raise ValueError("compression must be None, 'gzip' or 'zstd', not %r"
+                             % (compression,))
+        if compression == "zstd":
+            _require_zstandard()
+        self.filename = filename
+        self.compression = compression
+        self.level = DEFAULT_LEVELS.get(compression) if level is None else level
+        self.block_size = block_size
+        self.encode = encode_pretty if pretty else encode_document
+        self.documents = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self._compress = {"gzip": _gzip_block, "zstd": _zstd_block}.get(compression)
+        threads = threads or cpu_count()
+        self._pool = ThreadPool(threads) if self._compress else None
+        # at most this many compressed blocks wait to be written
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        if offset is None:
+            self._file = open(filename, "wb")
+        else:
+            # keep the first `offset` bytes of the file and append to them,
+            # e.g. to resume from a checkpoint (see osm_checkpoint.py)
+            self._file = open(filename, "r+b")
+            self._file.seek(offset)
+            self._file.truncate()
+        self._offset = offset or 0
+
+    def write_document(self, doc):
+        self.write(self.encode(doc))
+        self.documents += 1
+
+    def write(self, data):
+        """ write already encoded text, e.g. from pipeline_load() """
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._buffer:
+            return
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self.bytes_in += len(block)
+        if self._compress is None:
+            self._write(block)
+            return
+        while len(self._pending) >= self._max_pending:
+            self._write(self._pending.popleft().get())
+        self._pending.append(self._pool.apply_async(self._compress, (block, self.level)))
+
+    def _write(self, data):
+        self._file.write(data)
+        self.bytes_out += len(data)
+
+    def flush(self):
+        """ compress and write everything written so far; the file then
+            ends with a complete gzip member or zstd frame
+        """
+        self._flush_block()
+        while self._pending:
+            self._write(self._pending.popleft().get())
+        self._file.flush()
+
+    def tell(self):
+        """ bytes written to the file, up to the last flush() """
+        return self._offset + self.bytes_out
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+            self._file.close()
+            self._file = None
+
+    @property
+    def ratio(self):
+        if not self.bytes_out:
+            return None
+        return self.bytes_in / float(self.bytes_out)
+
+    def __str__(self):
+        return "%d documents, %.1f MB of JSON written as %.1f MB (%s)" % (
+            self.documents, self.bytes_in / 1048576.0, self.bytes_out / 1048576.0,
+            self.compression or "uncompressed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _ZstdReader(object):
+    """ file object decompressing every frame of a .zst file """
+
+    def __init__(self, filename):
+        _require_zstandard()
+        self._raw = open(filename, "rb")
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            self._raw, read_across_frames=True)
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        self._reader.close()
+        self._raw.close()
+
+
+def _open(filename):
+    compression = compression_of(filename)
+    if compression == "gzip":
+        return DecompressingReader(filename)
+    if compression == "zstd":
+        return _ZstdReader(filename)
+    return open(filename, "rb")
+
+
+def _lines(f):
+    rest = b""
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def read_json_lines(filename):
+    """ yield the documents of a plain, .gz or .zst file written by
+        process_map() or JSONLinesWriter, with or without pretty=True
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    f = _open(filename)
+    try:
+        pending = []
+        for line in _lines(f):
+            line = line.rstrip(b"\r")
+            if pending:
+                pending.append(line)
+                # a pretty-printed document ends with an unindented brace
+                if line == b"}":
+                    yield loads(b"\n".join(pending))
+                    pending = []
+            elif line == b"{":
+                pending.append(line)
+            elif line.strip():
+                yield loads(line)
+    finally:
+        f.close()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+"""
+    Bounded-memory MongoDB loader for shaped OSM documents.
+
+    Instead of collecting every document in a list and calling
+    insert_many() once at the end, shape_map() yields the documents as
+    the file is parsed and load_documents() writes them in fixed-size
+    unordered batches, so memory stays flat and data reaches Mongo while
+    parsing is still going on:
+
+    docs = shape_map("data/singapore.osm", shape_element)
+    stats = load_documents(docs, db.singaporeOSM, batch_size=1000,
+                           write_concern={"w": 1})
+    print(stats)
+"""
+
+from pymongo.write_concern import WriteConcern
+
+from osm_utils import clock, iter_elements
+
+
+class LoadStats(object):
+    """ number of documents and batches written and how long it took """
+
+    def __init__(self):
+        self.documents = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.write_seconds = 0.0
+
+    @property
+    def docs_per_sec(self):
+        if not self.seconds:
+            return 0.0
+        return self.documents / self.seconds
+
+    def __str__(self):
+        return ("%d documents in %d batches, %.2f seconds (%.0f documents/sec, "
+                "%.2f seconds writing)" % (self.documents, self.batches,
+                                            self.seconds, self.docs_per_sec,
+                                            self.write_seconds))
+
+
+def shape_map(filename, shape):
+    """ yield shape(element) for every top-level element of the file,
+        skipping the ones shape() rejects
+    """
+    for element in iter_elements(filename):
+        el = shape(element)
+        if el:
+            yield el
+
+
+def load_documents(documents, collection, batch_size=1000, write_concern=None):
+    """ insert an iterable of documents into `collection` in unordered
+        batches of `batch_size` and return a LoadStats
+
+        write_concern can be a pymongo WriteConcern or a dict of its
+        arguments, e.g. {"w": 0} for unacknowledged writes.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if isinstance(write_concern, dict):
+        write_concern = WriteConcern(**write_concern)
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+
+    stats = LoadStats()
+    start_time = clock()
+
+    def flush(batch):
+        write_start = clock()
+        collection.insert_many(batch, ordered=False)
+        stats.write_seconds += clock() - write_start
+        stats.documents += len(batch)
+        stats.batches += 1
+
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    stats.seconds = clock() - start_time
+    return stats
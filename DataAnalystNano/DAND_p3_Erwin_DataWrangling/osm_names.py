@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+"""
+    Exact and prefix search over the names of the shaped documents.
+
+    shape_element() keeps the name of an element in 'name' and its names
+    in other languages and alternate names in 'names' ({'zh': ...,
+    'ms': ..., 'alt': ...}), and finding an element by name means a
+    regex scan over the whole collection. NameIndexBuilder collects every
+    one of those names while the documents are loaded, and saves them as
+    a sorted array of normalized names (case-folded, without accents and
+    punctuation) with the sorted ids of the elements having each:
+
+    builder = NameIndexBuilder()
+    for doc in docs:
+        builder.add(doc)
+    builder.save("data/singapore.osm.names")
+
+    A NameIndex memory-maps the file on its first lookup, and finds a
+    name by binary search, in a few microseconds:
+
+    names = NameIndex("data/singapore.osm.names")
+    names.exact("ION Orchard")         -> [('way', '46587564')]
+    names.prefix("ion orch")           -> [('way', '46587564'), ...]
+    names.completions("ion")           -> ['ion orchard', ...]
+
+    Run this module on a saved index to time the lookups:
+
+    python osm_names.py data/singapore.osm.names
+"""
+
+import array
+import mmap
+import random
+import struct
+import sys
+import unicodedata
+
+from osm_utils import INT64, clock, string_types
+
+
+TYPES = ("node", "way", "relation")
+TYPE_CODES = dict((name, code) for code, name in enumerate(TYPES))
+# an element is stored as id * TYPE_STRIDE + its type code
+TYPE_STRIDE = 4
+
+MAGIC = b"OSMNAMES"
+# magic, byte order, number of names, bytes of names, number of elements
+HEADER = struct.Struct("=8sc7xqqq")
+
+# the apostrophes of "McDonald's" are dropped rather than split on
+APOSTROPHES = (u"'", u"\u2019")
+
+
+def _frombytes(values, data):
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+def normalize_name(name):
+    """ the form names are indexed and looked up in: case-folded,
+        without accents, apostrophes dropped and every other run of
+        punctuation and spaces made one space
+    """
+    name = unicodedata.normalize("NFKD", _text(name))
+    name = name.casefold() if hasattr(name, "casefold") else name.lower()
+    chars = []
+    for char in name:
+        category = unicodedata.category(char)
+        if category == "Mn" or char in APOSTROPHES:
+            continue
+        if category[0] in "LNM":
+            chars.append(char)
+        else:
+            chars.append(u" ")
+    return unicodedata.normalize("NFC", u" ".join(u"".join(chars).split()))
+
+
+def document_names(doc):
+    """ the 'name' and every value of 'names' of a document """
+    names = []
+    if doc.get("name"):
+        names.append(doc["name"])
+    for value in (doc.get("names") or {}).values():
+        if value:
+            names.append(value)
+    return names
+
+
+class NameIndexBuilder(object):
+    """ normalized names and the elements having them, in memory """
+
+    def __init__(self):
+        self._refs = {}
+
+    @classmethod
+    def from_documents(cls, documents):
+        builder = cls()
+        for doc in documents:
+            builder.add(doc)
+        return builder
+
+    def add_name(self, name, element_type, element_id):
+        key = normalize_name(name)
+        if key:
+            ref = int(element_id) * TYPE_STRIDE + TYPE_CODES[element_type]
+            self._refs.setdefault(key, []).append(ref)
+
+    def add(self, doc):
+        """ add every name of a shaped document """
+        for name in document_names(doc):
+            if isinstance(name, string_types):
+                self.add_name(name, doc["type"], doc["id"])
+
+    def __len__(self):
+        return len(self._refs)
+
+    def save(self, path):
+        """ write the index to a single file that NameIndex maps """
+        # sorted by their UTF-8 bytes, the order the lookups compare in
+        keys = sorted((key.encode("utf-8"), key) for key in self._refs)
+        key_offsets = array.array(INT64, [0])
+        ref_offsets = array.array(INT64, [0])
+        refs = array.array(INT64)
+        for encoded, key in keys:
+            key_offsets.append(key_offsets[-1] + len(encoded))
+            refs.extend(sorted(set(self._refs[key])))
+            ref_offsets.append(len(refs))
+        byteorder = b"<" if sys.byteorder == "little" else b">"
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, byteorder, len(keys), key_offsets[-1], len(refs)))
+            key_offsets.tofile(f)
+            ref_offsets.tofile(f)
+            refs.tofile(f)
+            f.write(b"".join(encoded for encoded, _ in keys))
+
+
+class NameIndex(object):
+    """ a saved name index, opened on the first lookup """
+
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.use_mmap = use_mmap
+        self._loaded = False
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            magic, byteorder, count, key_bytes, ref_count = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a name index" % self.path)
+            if byteorder != (b"<" if sys.byteorder == "little" else b">"):
+                raise ValueError("%s was saved on a machine with the other byte order"
+                                 % self.path)
+            itemsize = array.array(INT64).itemsize
+            offsets_bytes = (count + 1) * itemsize
+            refs_bytes = ref_count * itemsize
+            if self.use_mmap and hasattr(memoryview, "cast"):
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+                start = HEADER.size
+                self._key_offsets = view[start:start + offsets_bytes].cast(INT64)
+                start += offsets_bytes
+                self._ref_offsets = view[start:start + offsets_bytes].cast(INT64)
+                start += offsets_bytes
+                self._refs = view[start:start + refs_bytes].cast(INT64)
+                # the names are sliced straight out of the mmap, as bytes
+                self._keys = mapped
+                self._keys_start = start + refs_bytes
+            else:
+                self._key_offsets = _frombytes(array.array(INT64), f.read(offsets_bytes))
+                self._ref_offsets = _frombytes(array.array(INT64), f.read(offsets_bytes))
+                self._refs = _frombytes(array.array(INT64), f.read(refs_bytes))
+                self._keys = f.read(key_bytes)
+                self._keys_start = 0
+        self._count = count
+        self._loaded = True
+
+    def _key(self, i):
+        start = self._keys_start
+        return self._keys[start + self._key_offsets[i]:start + self._key_offsets[i + 1]]
+
+    def _bisect(self, key):
+        """ the first position whose name is not before `key` """
+        if not self._loaded:
+            self._load()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _elements(self, i):
+        refs = self._refs
+        return [(TYPES[refs[j] % TYPE_STRIDE], str(refs[j] // TYPE_STRIDE))
+                for j in range(self._ref_offsets[i], self._ref_offsets[i + 1])]
+
+    def __len__(self):
+        if not self._loaded:
+            self._load()
+        return self._count
+
+    def exact(self, name):
+        """ (type, id) of the elements with a name that normalizes to the
+            same as `name`
+        """
+        key = normalize_name(name).encode("utf-8")
+        i = self._bisect(key)
+        if i < self._count and self._key(i) == key:
+            return self._elements(i)
+        return []
+
+    def _prefixed(self, text):
+        """ positions of the names starting with the normalized `text` """
+        key = normalize_name(text).encode("utf-8")
+        i = self._bisect(key)
+        while i < self._count and self._key(i).startswith(key):
+            yield i
+            i += 1
+
+    def prefix(self, text, limit=None):
+        """ (type, id) of the elements with a name starting with `text`,
+            at most `limit` of them, in the order of their names
+        """
+        seen = set()
+        elements = []
+        for i in self._prefixed(text):
+            for element in self._elements(i):
+                if element not in seen:
+                    seen.add(element)
+                    elements.append(element)
+                    if limit is not None and len(elements) >= limit:
+                        return elements
+        return elements
+
+    def completions(self, text, limit=10):
+        """ the normalized names starting with `text`, in order """
+        names = []
+        for i in self._prefixed(text):
+            if limit is not None and len(names) >= limit:
+                break
+            names.append(self._key(i).decode("utf-8"))
+        return names
+
+
+def benchmark(index, n=10000, seed=0):
+    """ microseconds per exact() and prefix(limit=10) lookup of names of
+        the index and of their first three characters
+    """
+    rng = random.Random(seed)
+    if not len(index):
+        print("the index is empty")
+        return
+    names = [index._key(rng.randrange(len(index))).decode("utf-8") for _ in range(n)]
+    prefixes = [name[:3] for name in names]
+    results = {}
+    for label, lookup, queries in (("exact", index.exact, names),
+                                   ("prefix", lambda text: index.prefix(text, limit=10),
+                                    prefixes)):
+        start_time = clock()
+        found = sum(1 for query in queries if lookup(query))
+        seconds = clock() - start_time
+        results[label] = seconds / n * 1e6
+        print("%-7s %.1f microseconds a lookup, %d of %d found" % (
+            label, results[label], found, n))
+    return results
+
+
+if __name__ == '__main__':
+    index = NameIndex(sys.argv[1] if len(sys.argv) > 1 else "data/singapore.osm.names")
+    print("%d names" % len(index))
+    benchmark(index)
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+"""
+    Multi-process parsing of an OSM XML file.
+
+    The file is split into byte ranges that start on a top-level <node>,
+    <way> or <relation> tag. Each range is wrapped in a bare <osm> root and
+    parsed on its own in a process pool, and the results are merged in the
+    main process:
+
+    report = parallel_audit("data/singapore.osm")      # counts are summed
+    for doc in parallel_shape("data/singapore.osm", shape_element):
+        ...                                            # documents in file order
+
+    Ranges are merged in file order, so the documents come out in the same
+    order as the serial path (by type, then id, for a sorted extract) and
+    every run gives the same result whatever the number of processes.
+    Run this module on an OSM file to compare it with the serial audit:
+
+    python osm_parallel.py data/singapore.osm
+"""
+
+import gc
+import marshal
+import os
+import re
+import sys
+from collections import deque
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from osm_audit import AuditReport, audit_map
+from osm_utils import clock, is_compressed, iter_elements
+
+
+CHUNK_BYTES = 32 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+
+element_start = re.compile(br'<(?:node|way|relation)[\s/>]')
+document_end = b'</osm>'
+
+
+class RangeReader(object):
+    """ file-like object reading bytes [start, end) of a file, with
+        `prefix` and `suffix` around them so the range parses as a
+        document of its own
+    """
+
+    def __init__(self, filename, start, end, prefix=b'<osm>', suffix=b'</osm>'):
+        self._file = open(filename, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._prefix = prefix
+        self._suffix = suffix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining + len(self._prefix) + len(self._suffix)
+        out = b''
+        if self._prefix:
+            out, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(out) < size and self._remaining > 0:
+            data = self._file.read(min(size - len(out), self._remaining))
+            self._remaining -= len(data)
+            if not data:
+                self._remaining = 0
+            out += data
+        if len(out) < size and self._remaining <= 0 and self._suffix:
+            tail = self._suffix[:size - len(out)]
+            self._suffix = self._suffix[len(tail):]
+            out += tail
+        return out
+
+    def close(self):
+        self._file.close()
+
+
+def next_element_start(f, offset, limit):
+    """ offset of the first top-level element tag at or after `offset`,
+        or `limit` when there is none before it
+    """
+    f.seek(offset)
+    position = offset
+    carry = b''
+    while position < limit:
+        block = f.read(min(BLOCK_SIZE, limit - position))
+        if not block:
+            break
+        data = carry + block
+        m = element_start.search(data)
+        if m:
+            return position - len(carry) + m.start()
+        # a tag split across two blocks is found on the next round
+        carry = data[-10:]
+        position += len(block)
+    return limit
+
+
+def split_ranges(filename, chunks=None):
+    """ split an OSM file into (start, end) byte ranges aligned on
+        top-level elements
+
+        Returns (header_end, ranges): bytes [0, header_end) hold the XML
+        declaration, the <osm> root tag and <bounds>.
+    """
+    if is_compressed(filename):
+        raise ValueError("cannot split compressed file %s into byte ranges, "
+                         "decompress it first" % filename)
+    size = os.path.getsize(filename)
+    if chunks is None:
+        chunks = max(cpu_count() * 4, size // CHUNK_BYTES)
+
+    with open(filename, 'rb') as f:
+        first = next_element_start(f, 0, size)
+        f.seek(max(first, size - BLOCK_SIZE))
+        tail = f.read()
+        last = tail.rfind(document_end)
+        last = size if last < 0 else size - len(tail) + last
+        last = max(last, first)
+
+        bounds = [first]
+        step = max((last - first) // max(chunks, 1), 1)
+        for i in range(1, chunks):
+            boundary = next_element_start(f, first + i * step, last)
+            if boundary > bounds[-1]:
+                bounds.append(boundary)
+        if last > bounds[-1] or len(bounds) == 1:
+            bounds.append(last)
+
+    return first, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _audit_range(filename, byte_range):
+    reader = RangeReader(filename, byte_range[0], byte_range[1])
+    try:
+        report = audit_map(reader)
+    finally:
+        reader.close()
+    # the bare <osm> wrapper is not part of the file
+    report.tags['osm'] -= 1
+    return (dict(report.tags), dict(report.attrs), dict(report.keys),
+            report.key_types, report.peak_rss_kb)
+
+
+def _shape_range(filename, shape, collect, byte_range):
+    reader = RangeReader(filename, byte_range[0], byte_range[1])
+    try:
+        docs = []
+        for element in iter_elements(reader):
+            el = shape(element)
+            if el:
+                docs.append(el)
+    finally:
+        reader.close()
+    # shaped documents only hold dicts, lists, strings and floats, which
+    # marshal handles many times faster than pickle
+    return marshal.dumps(docs), collect() if collect is not None else None
+
+
+def _load_documents(data):
+    # unpacking allocates hundreds of thousands of containers; keep the
+    # cyclic garbage collector from rescanning them all on every batch
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _ordered_results(pool, func, ranges, window):
+    """ yield func(range) for every range, in order, keeping at most
+        `window` ranges in flight so results cannot pile up in memory
+    """
+    ranges = iter(ranges)
+    pending = deque()
+    for byte_range in ranges:
+        pending.append(pool.apply_async(func, (byte_range,)))
+        if len(pending) >= window:
+            break
+    while pending:
+        result = pending.popleft().get()
+        byte_range = next(ranges, None)
+        if byte_range is not None:
+            pending.append(pool.apply_async(func, (byte_range,)))
+        yield result
+
+
+def parallel_audit(filename, processes=None, chunks=None):
+    """ audit_map() spread over a process pool; returns an AuditReport
+        with the counts of all ranges summed
+    """
+    processes = processes or cpu_count()
+    start_time = clock()
+    header_end, ranges = split_ranges(filename, chunks)
+
+    # the <osm> root and <bounds> live in the header
+    header = RangeReader(filename, 0, header_end, prefix=b'', suffix=document_end)
+    try:
+        header_report = audit_map(header)
+    finally:
+        header.close()
+
+    report = AuditReport(filename)
+    report.bytes = os.path.getsize(filename)
+    parts = [(dict(header_report.tags), dict(header_report.attrs),
+              dict(header_report.keys), header_report.key_types,
+              header_report.peak_rss_kb)]
+
+    pool = Pool(processes)
+    try:
+        parts.extend(pool.map(partial(_audit_range, filename), ranges))
+    finally:
+        pool.close()
+        pool.join()
+
+    for tags, attrs, keys, key_types, peak in parts:
+        for counts, part in ((report.tags, tags), (report.attrs, attrs),
+                             (report.keys, keys), (report.key_types, key_types)):
+            for name, count in part.items():
+                counts[name] += count
+        if peak is not None:
+            report.peak_rss_kb = max(report.peak_rss_kb or 0, peak)
+
+    for name in [name for name, count in report.tags.items() if not count]:
+        del report.tags[name]
+    report.elements = sum(report.tags.values())
+    report.seconds = clock() - start_time
+    return report
+
+
+def parallel_shape(filename, shape, processes=None, chunks=None, collect=None,
+                   merge=None):
+    """ yield shape(element) for every top-level element of the file, the
+        same documents in the same order as the serial shape_map(), with
+        the parsing spread over a process pool
+
+        shape must be picklable, i.e. a module-level function. Whatever
+        shape() counts on the side (exceptions, cache and rule hits) is
+        counted in the workers; give `collect`, called in a worker after
+        each range to return and reset its counts, and `merge`, called
+        with them in this process, to bring the counts back (see
+        osm_shape.collect_stats). collect is also called as each worker
+        starts, to drop the counts it inherited.
+    """
+    processes = processes or cpu_count()
+    _, ranges = split_ranges(filename, chunks)
+    pool = Pool(processes, initializer=collect)
+    try:
+        for data, counts in _ordered_results(pool,
+                                             partial(_shape_range, filename, shape, collect),
+                                             ranges, processes * 2):
+            if merge is not None and counts is not None:
+                merge(counts)
+            for doc in _load_documents(data):
+                yield doc
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else "data/singapore.osm"
+    print(audit_map(filename))
+    print(parallel_audit(filename))
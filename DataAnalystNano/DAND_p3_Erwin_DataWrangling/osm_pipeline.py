@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+"""
+    Pipelined loading of shaped documents into a JSON file and MongoDB.
+
+    load_documents() parses, shapes, serializes and writes one batch after
+    the other, so the parser waits for every disk write and every
+    insert_many(). pipeline_load() runs the writes on threads of their
+    own, connected by bounded queues:
+
+    parse/shape          serialize              sinks
+    (calling thread) --> (json.dumps thread) -+-> JSON file thread
+                                              +-> MongoDB thread
+
+    stats = pipeline_load(shape_map("data/singapore.osm", shape_element),
+                          fo, db.singaporeOSM, batch_size=1000)
+
+    The queues hold at most `queue_size` batches, so a slow sink holds
+    the parser back instead of letting batches pile up in memory. The
+    file and the collection get the documents in the order they were
+    parsed. When any stage fails, every stage stops at its next batch,
+    the threads are joined and the first error is raised by
+    pipeline_load().
+"""
+
+import json
+import threading
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from pymongo.write_concern import WriteConcern
+
+from osm_loader import LoadStats
+from osm_utils import clock
+
+
+_EOF = object()
+
+# seconds a blocked stage waits before checking whether to stop
+POLL_SECONDS = 0.1
+
+
+class PipelineStats(LoadStats):
+    """ LoadStats with the time spent in each stage of the pipeline """
+
+    def __init__(self):
+        super(PipelineStats, self).__init__()
+        self.serialize_seconds = 0.0
+        self.file_seconds = 0.0
+        self.stall_seconds = 0.0
+
+    def __str__(self):
+        return ("%s; %.2f seconds serializing, %.2f seconds writing the file, "
+                "parser held back %.2f seconds" % (
+                    super(PipelineStats, self).__str__(), self.serialize_seconds,
+                    self.file_seconds, self.stall_seconds))
+
+
+class _Pipeline(object):
+
+    def __init__(self, fo, collection, pretty, queue_size, dumps, stats):
+        self.fo = fo
+        self.collection = collection
+        self.pretty = pretty
+        self.dumps = dumps
+        self.stats = stats
+        self.stop = threading.Event()
+        self.error = None
+        self.to_serialize = Queue(queue_size)
+        self.to_file = Queue(queue_size)
+        self.to_mongo = Queue(queue_size)
+        self.threads = [self._thread(self._serialize, "serialize"),
+                        self._thread(self._write_file, "write file"),
+                        self._thread(self._write_mongo, "write mongo")]
+
+    def _thread(self, target, name):
+        thread = threading.Thread(target=self._run, args=(target,), name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def put(self, queue, item):
+        """ put item on queue, waiting while it is full; False when the
+            pipeline is stopping
+        """
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(self, queue):
+        """ the next item of queue, or _EOF when the pipeline is stopping """
+        while not self.stop.is_set():
+            try:
+                return queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                pass
+        return _EOF
+
+    def _serialize(self):
+        while True:
+            batch = self.get(self.to_serialize)
+            if batch is _EOF:
+                break
+            start_time = clock()
+            if self.pretty:
+                text = "".join(self.dumps(doc, indent=2) + "\n" for doc in batch)
+            else:
+                text = "".join(self.dumps(doc) + "\n" for doc in batch)
+            self.stats.serialize_seconds += clock() - start_time
+            # insert_many() adds an _id to the documents, so they are only
+            # handed to MongoDB once they are serialized
+            if not (self.put(self.to_file, text) and self.put(self.to_mongo, batch)):
+                return
+        self.put(self.to_file, _EOF)
+        self.put(self.to_mongo, _EOF)
+
+    def _write_file(self):
+        while True:
+            text = self.get(self.to_file)
+            if text is _EOF:
+                return
+            start_time = clock()
+            self.fo.write(text)
+            self.stats.file_seconds += clock() - start_time
+
+    def _write_mongo(self):
+        while True:
+            batch = self.get(self.to_mongo)
+            if batch is _EOF:
+                return
+            start_time = clock()
+            self.collection.insert_many(batch, ordered=False)
+            self.stats.write_seconds += clock() - start_time
+            self.stats.documents += len(batch)
+            self.stats.batches += 1
+
+    def send(self, batch):
+        start_time = clock()
+        sent = self.put(self.to_serialize, batch)
+        self.stats.stall_seconds += clock() - start_time
+        if not sent:
+            raise self.error
+
+    def close(self):
+        self.put(self.to_serialize, _EOF)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def pipeline_load(documents, fo, collection, batch_size=1000, write_concern=None,
+                  pretty=False, queue_size=8, dumps=json.dumps):
+    """ write an iterable of documents to the file object `fo`, one JSON
+        document a line (indented when `pretty` is set), and insert them
+        into `collection` in unordered batches of `batch_size`, with the
+        serialization and both writes on background threads; returns a
+        PipelineStats
+
+        write_concern is the same as for load_documents().
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if queue_size < 1:
+        raise ValueError("queue_size must be at least 1")
+    if isinstance(write_concern, dict):
+        write_concern = WriteConcern(**write_concern)
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+
+    stats = PipelineStats()
+    start_time = clock()
+    pipeline = _Pipeline(fo, collection, pretty, queue_size, dumps, stats)
+    try:
+        batch = []
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                pipeline.send(batch)
+                batch = []
+        if batch:
+            pipeline.send(batch)
+    except BaseException:
+        pipeline.abort()
+        raise
+    pipeline.close()
+
+    stats.seconds = clock() - start_time
+    return stats
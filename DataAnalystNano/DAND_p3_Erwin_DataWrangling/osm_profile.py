@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""
+    Per-stage timers and counters for the import.
+
+    A Profiler wraps the functions of the pipeline -- parsing, key_type(),
+    shape_element(), the cleaners, json.dumps() and the Mongo writes --
+    and adds up the calls, elements and seconds of each stage:
+
+    profiler = Profiler(enabled=True)
+    shape = profiler.wrap("shape", shape_element)
+    dumps = profiler.wrap("serialize", json.dumps)
+    for element in profiler.iterate("parse", iter_elements(filename)):
+        fo.write(dumps(shape(element)))
+    print(profiler)
+    profiler.report()   -> {"stages": [...], "slowest_cleaners": [...]}
+
+    Stages can be nested, e.g. the cleaners run inside shape_element():
+    `seconds` of a stage include its nested stages and `self_seconds` do
+    not, so the self seconds of all stages add up to the time profiled.
+
+    A disabled profiler returns the functions and iterables it is given
+    unchanged, so leaving the calls in place costs nothing.
+"""
+
+import json
+from contextlib import contextmanager
+
+from osm_utils import clock
+
+
+# stages named CLEANER_PREFIX + cleaner name are listed as cleaners
+CLEANER_PREFIX = "clean."
+
+
+class StageStats(object):
+    """ calls, elements and seconds of one stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+
+    def as_dict(self):
+        return {"stage": self.name,
+                "calls": self.calls,
+                "items": self.items,
+                "seconds": self.seconds,
+                "self_seconds": self.self_seconds,
+                "us_per_item": 1e6 * self.seconds / self.items if self.items else None}
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+class Profiler(object):
+    """ timers and counters of the stages of the import """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+        self._order = []
+        # seconds spent in nested stages, one entry per running stage
+        self._stack = []
+
+    def _stage(self, name):
+        try:
+            return self.stages[name]
+        except KeyError:
+            self._order.append(name)
+            stage = self.stages[name] = StageStats(name)
+            return stage
+
+    def _enter(self):
+        self._stack.append(0.0)
+        return clock()
+
+    def _exit(self, stage, start_time, items=1):
+        elapsed = clock() - start_time
+        nested = self._stack.pop()
+        stage.calls += 1
+        stage.items += items
+        stage.seconds += elapsed
+        stage.self_seconds += elapsed - nested
+        if self._stack:
+            self._stack[-1] += elapsed
+
+    def wrap(self, name, func):
+        """ func, counting every call as one element of stage `name` """
+        if not self.enabled:
+            return func
+        stage = self._stage(name)
+
+        def timed(*args, **kwargs):
+            start_time = self._enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(stage, start_time)
+        timed.__name__ = getattr(func, "__name__", name)
+        timed.__wrapped__ = func
+        return timed
+
+    def iterate(self, name, iterable):
+        """ iterable, timing every next() as one element of stage `name` """
+        if not self.enabled:
+            return iterable
+        return self._iterate(self._stage(name), iter(iterable))
+
+    def _iterate(self, stage, iterator):
+        while True:
+            start_time = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._exit(stage, start_time, items=0)
+                return
+            except BaseException:
+                self._exit(stage, start_time)
+                raise
+            self._exit(stage, start_time)
+            yield item
+
+    def stage(self, name, items=1):
+        """ context manager timing a block as `items` elements of stage
+            `name`
+        """
+        if not self.enabled:
+            return _nothing()
+        return self._block(self._stage(name), items)
+
+    @contextmanager
+    def _block(self, stage, items):
+        start_time = self._enter()
+        try:
+            yield
+        finally:
+            self._exit(stage, start_time, items)
+
+    def add(self, name, seconds, calls=1, items=1):
+        """ record a stage timed elsewhere, e.g. the write seconds of a
+            LoadStats
+        """
+        if not self.enabled:
+            return
+        stage = self._stage(name)
+        stage.calls += calls
+        stage.items += items
+        stage.seconds += seconds
+        stage.self_seconds += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.stages.clear()
+        self.counters.clear()
+        del self._order[:]
+
+    def report(self, cleaners=5):
+        """ {'stages': [...], 'counters': {...}, 'slowest_cleaners': [...]}
+            with the stages in the order they first ran and the `cleaners`
+            slowest cleaners by total seconds
+        """
+        stages = [self.stages[name].as_dict() for name in self._order]
+        slowest = sorted((stage for stage in stages
+                          if stage["stage"].startswith(CLEANER_PREFIX)),
+                         key=lambda stage: -stage["seconds"])
+        return {"stages": stages,
+                "counters": dict(self.counters),
+                "total_seconds": sum(stage["self_seconds"] for stage in stages),
+                "slowest_cleaners": slowest[:cleaners]}
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def __str__(self):
+        report = self.report()
+        if not report["stages"]:
+            return "no stages profiled"
+        total = report["total_seconds"] or 1.0
+        lines = ["%-28s %10s %10s %10s %10s %6s %10s" % (
+            "stage", "calls", "items", "seconds", "self", "%self", "us/item")]
+        for stage in report["stages"]:
+            lines.append("%-28s %10d %10d %10.3f %10.3f %5.1f%% %10s" % (
+                stage["stage"], stage["calls"], stage["items"], stage["seconds"],
+                stage["self_seconds"], 100.0 * stage["self_seconds"] / total,
+                "%.1f" % stage["us_per_item"] if stage["us_per_item"] is not None else "-"))
+        for name in sorted(report["counters"]):
+            lines.append("%-28s %10d" % (name, report["counters"][name]))
+        if report["slowest_cleaners"]:
+            lines.append("slowest cleaners: " + ", ".join(
+                "%s (%.3fs)" % (stage["stage"][len(CLEANER_PREFIX):], stage["seconds"])
+                for stage in report["slowest_cleaners"]))
+        return "\n".join(lines)
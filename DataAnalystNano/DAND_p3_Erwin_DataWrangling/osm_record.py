@@ -0,0 +1,318 @@
+#!/usr/bin/python
+
+"""
+    Compact in-memory form of the documents made by shape_element().
+
+    A shaped document is a dict with its own 'names', 'address' and
+    'created' dicts and a 'node_refs' list of id strings, and every user
+    name, tag key and common tag value is a separate string. Holding a
+    whole city that way takes over a kilobyte per node and a few per way.
+    OSMRecord keeps the same data in a __slots__ object instead:
+
+    - id, version, changeset, uid and timestamp (in seconds) as ints
+    - pos as separate lat and lon floats
+    - names, address and the other fields as flat (key, value, key,
+      value, ...) tuples with interned keys, and values interned when
+      they are short enough to repeat (amenity values, postcodes, "yes")
+    - the user interned
+    - node_refs as an int64 array
+
+    and turns back into the dict of shape_element() only when it is
+    written out:
+
+    interner = Interner()
+    records = list(shape_map("data/singapore.osm", compact(shape_element, interner)))
+    records[0].to_dict()    -> the document of shape_element()
+    records[0].to_json()
+
+    memory_report(docs) compares the size of a list of documents with
+    the size of the same documents as records.
+"""
+
+import array
+import calendar
+import json
+import sys
+
+from osm_utils import INT64, string_types
+
+
+# order of the 'created' fields of shape_element()
+CREATED = ("version", "changeset", "timestamp", "user", "uid")
+
+# OSM timestamps, e.g. 2014-11-25T21:38:36Z
+TIMESTAMP_FORMAT = "%04d-%02d-%02dT%02d:%02d:%02dZ"
+
+# values up to this long are interned
+INTERN_MAX_LEN = 16
+
+# document fields that have slots of their own
+SLOT_FIELDS = frozenset(["id", "type", "visible", "names", "address", "node_refs",
+                         "created", "pos"])
+
+_EMPTY = ()
+
+# slot of a field the document does not have
+_MISSING = object()
+
+
+def _to_int(value):
+    """ value as an int when it is the decimal string of one, otherwise
+        value itself
+    """
+    if isinstance(value, string_types) and value.isdigit() and value[0] != "0":
+        return int(value)
+    return value
+
+
+def _to_str(value):
+    return str(value) if isinstance(value, int) and not isinstance(value, bool) else value
+
+
+def _to_seconds(timestamp):
+    """ an OSM timestamp as seconds since the epoch, or the timestamp
+        itself when it does not read back the same
+    """
+    if not isinstance(timestamp, string_types) or len(timestamp) != 20:
+        return timestamp
+    try:
+        seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                                   int(timestamp[8:10]), int(timestamp[11:13]),
+                                   int(timestamp[14:16]), int(timestamp[17:19]),
+                                   0, 0, 0))
+    except ValueError:
+        return timestamp
+    return seconds if _to_timestamp(seconds) == timestamp else timestamp
+
+
+def _to_timestamp(seconds):
+    if not isinstance(seconds, int):
+        return seconds
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    year, month, day = _civil_from_days(days)
+    return TIMESTAMP_FORMAT % (year, month, day, hours, minutes, seconds)
+
+
+def _civil_from_days(days):
+    # days since 1970-01-01 -> (year, month, day) in the proleptic
+    # Gregorian calendar, without going through datetime
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524
+                   - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + 3 if month_index < 10 else month_index - 9
+    year = year_of_era + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+
+class Interner(object):
+    """ table of the strings shared by the records """
+
+    def __init__(self, max_len=INTERN_MAX_LEN):
+        self.max_len = max_len
+        self._strings = {}
+
+    def __call__(self, value):
+        """ the shared copy of a string (or number) """
+        if value is _MISSING or value is None:
+            return value
+        return self._strings.setdefault(value, value)
+
+    def value(self, value):
+        """ the shared copy of a short string, or the value itself """
+        if isinstance(value, string_types) and len(value) <= self.max_len:
+            return self._strings.setdefault(value, value)
+        return value
+
+    def __len__(self):
+        return len(self._strings)
+
+
+class OSMRecord(object):
+    """ a shaped document in __slots__, converted back to a dict by
+        to_dict()
+    """
+
+    __slots__ = ("id", "type", "visible", "names", "address", "node_refs",
+                 "created", "version", "changeset", "timestamp", "user", "uid",
+                 "lat", "lon", "fields")
+
+    @classmethod
+    def from_dict(cls, doc, intern=None):
+        """ the record of a document made by shape_element() """
+        intern = Interner() if intern is None else intern
+        record = cls()
+        record.id = _to_int(doc.get("id", _MISSING))
+        record.type = intern(doc.get("type", _MISSING))
+        record.visible = intern(doc.get("visible", _MISSING))
+        record.names = _pairs(doc.get("names", _MISSING), intern)
+        record.address = _pairs(doc.get("address", _MISSING), intern)
+        record.node_refs = _refs(doc.get("node_refs", _MISSING))
+
+        created = doc.get("created", _MISSING)
+        if isinstance(created, dict) and len(created) == len(CREATED) and all(
+                key in created for key in CREATED):
+            # None marks the created fields as stored in their own slots
+            record.created = None
+            record.version = intern(_to_int(created["version"]))
+            record.changeset = _to_int(created["changeset"])
+            record.timestamp = _to_seconds(created["timestamp"])
+            record.user = intern(created["user"])
+            record.uid = intern(_to_int(created["uid"]))
+        else:
+            record.created = created
+
+        pos = doc.get("pos", _MISSING)
+        if isinstance(pos, list) and len(pos) == 2:
+            record.lat, record.lon = pos
+        else:
+            record.lat = pos
+
+        record.fields = _flatten((intern(key), _compact_value(value, intern))
+                                 for key, value in doc.items()
+                                 if key not in SLOT_FIELDS)
+        return record
+
+    def to_dict(self):
+        """ the document of shape_element(), with the keys in the same
+            order
+        """
+        doc = {}
+        if self.id is not _MISSING:
+            doc["id"] = _to_str(self.id)
+        if self.type is not _MISSING:
+            doc["type"] = self.type
+        if self.visible is not _MISSING:
+            doc["visible"] = self.visible
+        for key in ("names", "address"):
+            value = getattr(self, key)
+            if isinstance(value, tuple):
+                doc[key] = _expand(value)
+            elif value is not _MISSING:
+                doc[key] = value
+
+        refs = self.node_refs
+        if isinstance(refs, (array.array, tuple)):
+            doc["node_refs"] = [str(ref) for ref in refs]
+        elif refs is not _MISSING:
+            doc["node_refs"] = refs
+
+        if self.created is None:
+            doc["created"] = {"version": _to_str(self.version),
+                              "changeset": _to_str(self.changeset),
+                              "timestamp": _to_timestamp(self.timestamp),
+                              "user": self.user,
+                              "uid": _to_str(self.uid)}
+        elif self.created is not _MISSING:
+            doc["created"] = self.created
+
+        try:
+            doc["pos"] = [self.lat, self.lon]
+        except AttributeError:
+            # no lon: lat holds the pos of the document, if it had one
+            if self.lat is not _MISSING:
+                doc["pos"] = self.lat
+
+        fields = self.fields
+        for i in range(0, len(fields), 2):
+            doc[fields[i]] = _expand_value(fields[i + 1])
+        return doc
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def __repr__(self):
+        return "OSMRecord(%s %s)" % (self.type, _to_str(self.id))
+
+
+def _refs(refs):
+    if isinstance(refs, list) and all(isinstance(ref, string_types)
+                                      and _to_int(ref) is not ref for ref in refs):
+        return array.array(INT64, [int(ref) for ref in refs]) if refs else _EMPTY
+    return refs
+
+
+def _flatten(pairs):
+    return tuple(item for pair in pairs for item in pair) or _EMPTY
+
+
+def _pairs(mapping, intern):
+    if not isinstance(mapping, dict):
+        return mapping
+    return _flatten((intern(key), intern.value(value)) for key, value in mapping.items())
+
+
+def _expand(pairs):
+    return dict((pairs[i], pairs[i + 1]) for i in range(0, len(pairs), 2))
+
+
+# values that are dicts are stored as a _Pairs, so they can be told
+# apart from tuple values
+class _Pairs(tuple):
+    __slots__ = ()
+
+
+def _compact_value(value, intern):
+    if isinstance(value, dict):
+        return _Pairs(_flatten((intern(key), _compact_value(item, intern))
+                               for key, item in value.items()))
+    return intern.value(value)
+
+
+def _expand_value(value):
+    if isinstance(value, _Pairs):
+        return dict((value[i], _expand_value(value[i + 1])) for i in range(0, len(value), 2))
+    return value
+
+
+def compact(shape, intern=None):
+    """ shape function returning the OSMRecord of shape(element) """
+    intern = Interner() if intern is None else intern
+
+    def shape_record(element):
+        doc = shape(element)
+        if not doc:
+            return doc
+        return OSMRecord.from_dict(doc, intern)
+    return shape_record
+
+
+def deep_sizeof(obj, seen=None):
+    """ bytes used by obj and everything it refers to, counting shared
+        objects once
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, Interner):
+            stack.append(obj._strings)
+        elif isinstance(obj, OSMRecord):
+            stack.extend(getattr(obj, name) for name in obj.__slots__
+                         if hasattr(obj, name))
+    return size
+
+
+def memory_report(documents):
+    """ (bytes as dicts, bytes as records including the interned strings)
+        of a list of documents
+    """
+    intern = Interner()
+    records = [OSMRecord.from_dict(doc, intern) for doc in documents]
+    return deep_sizeof(documents), deep_sizeof([records, intern])
@@ -0,0 +1,391 @@
+#!/usr/bin/python
+
+"""
+    Smaller OSM files for iterating on the cleaning rules, and audits of a
+    sample with confidence intervals.
+
+    sample_osm() writes a valid OSM file holding a sample of the elements
+    of each type in one streaming pass over the source, either every k-th
+    element ("systematic", with a random start) or a uniform sample of a
+    fixed size ("reservoir"):
+
+    sample_osm("data/singapore.osm", "data/sample.osm", rate=0.01)
+    sample_osm("data/singapore.osm", "data/sample.osm", method="reservoir",
+               size={"node": 20000, "way": 2000, "relation": 100})
+
+    Every node referenced by a sampled way is written too, so the ways of
+    the sample can be shaped and resolved like the full file. The nodes
+    are held in a temporary file until the sampled ways are known, and
+    are written first, as in the source. Relations are sampled like the
+    other elements and keep all their members, as relations in a regional
+    extract do.
+
+    approximate_audit() estimates the proportions (and counts) of the key
+    format classes of audit_map() from a sample, with confidence
+    intervals. On an uncompressed file it parses only a random sample of
+    byte ranges (see osm_parallel.py), so it takes a fraction of the time
+    of a full audit:
+
+    print(approximate_audit("data/singapore.osm", rate=0.05))
+
+    Run this module on an OSM file, with the rate, to print the estimate:
+
+    python osm_sample.py data/singapore.osm 0.05
+"""
+
+import math
+import random
+import struct
+import sys
+import tempfile
+import xml.etree.cElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+from osm_audit import KEY_TYPES, audit_map, classify_key
+from osm_parallel import RangeReader, split_ranges
+from osm_utils import TOP_LEVEL_TAGS, clock, is_compressed, open_osm, string_types
+
+
+METHODS = ("systematic", "reservoir")
+
+# id and length of a node spilled to the temporary file
+NODE_HEADER = struct.Struct("=qI")
+
+# two-sided 95% normal quantile
+Z_95 = 1.959963984540054
+
+
+class SampleStats(object):
+    """ elements seen and written by sample_osm(), by type """
+
+    def __init__(self, method):
+        self.method = method
+        self.seen = dict((tag, 0) for tag in TOP_LEVEL_TAGS)
+        self.sampled = dict((tag, 0) for tag in TOP_LEVEL_TAGS)
+        # nodes written only because a sampled way refers to them
+        self.referenced_nodes = 0
+        # node refs of sampled ways that are not in the source
+        self.missing_nodes = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        lines = ["%s sample in %.2f seconds" % (self.method, self.seconds)]
+        for tag in TOP_LEVEL_TAGS:
+            lines.append("%-9s %10d of %10d sampled" % (tag, self.sampled[tag], self.seen[tag]))
+        lines.append("%d nodes added for the sampled ways, %d referenced nodes "
+                     "not in the source" % (self.referenced_nodes, self.missing_nodes))
+        return "\n".join(lines)
+
+
+def _per_type(value, name):
+    if isinstance(value, dict):
+        unknown = set(value) - set(TOP_LEVEL_TAGS)
+        if unknown:
+            raise ValueError("unknown element types in %s: %s" % (name, sorted(unknown)))
+        return dict((tag, value.get(tag, 0)) for tag in TOP_LEVEL_TAGS)
+    return dict((tag, value) for tag in TOP_LEVEL_TAGS)
+
+
+class _Systematic(object):
+    """ every k-th element, starting at a random one of the first k """
+
+    def __init__(self, rate, rng):
+        if not 0 <= rate <= 1:
+            raise ValueError("rate must be between 0 and 1, not %r" % (rate,))
+        self.step = int(round(1.0 / rate)) if rate else 0
+        self.next = rng.randrange(self.step) if self.step else -1
+        self.seen = 0
+
+    def take(self):
+        """ True when the next element is in the sample """
+        index = self.seen
+        self.seen += 1
+        if index != self.next:
+            return False
+        self.next += self.step
+        return True
+
+
+class _Reservoir(object):
+    """ uniform sample of `size` items of a stream (algorithm R) """
+
+    def __init__(self, size, rng):
+        if size < 0:
+            raise ValueError("size must not be negative, not %r" % (size,))
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+
+    def offer(self, make_item):
+        """ add make_item() to the sample if the next element is drawn;
+            make_item is only called then
+        """
+        index = self.seen
+        self.seen += 1
+        if index < self.size:
+            self.items.append((index, make_item()))
+        else:
+            slot = self.rng.randint(0, index)
+            if slot < self.size:
+                self.items[slot] = (index, make_item())
+
+    def in_order(self):
+        return [item for _, item in sorted(self.items, key=lambda pair: pair[0])]
+
+
+def _serialize(elem):
+    elem.tail = None
+    return b"  " + ET.tostring(elem) + b"\n"
+
+
+def _refs(elem):
+    return [int(nd.get("ref")) for nd in elem.iter("nd")]
+
+
+def sample_osm(filename, out, rate=0.01, size=None, method="systematic", seed=None):
+    """ write a sample of the elements of an OSM file to `out` and return
+        a SampleStats
+
+        rate (systematic) and size (reservoir) can be a number for every
+        element type or a dict {"node": ..., "way": ..., "relation": ...},
+        where missing types are not sampled. The same seed gives the same
+        sample.
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of %s, not %r" % (METHODS, method))
+    if method == "reservoir" and size is None:
+        raise ValueError("reservoir sampling needs a size")
+    rng = random.Random(seed)
+    stats = SampleStats(method)
+    start_time = clock()
+
+    if method == "systematic":
+        samplers = dict((tag, _Systematic(r, rng)) for tag, r in _per_type(rate, "rate").items())
+    else:
+        samplers = dict((tag, _Reservoir(n, rng)) for tag, n in _per_type(size, "size").items())
+
+    header = []
+    sampled_nodes = set()
+    needed = set()
+    nodes = tempfile.TemporaryFile()
+    others = dict((tag, tempfile.TemporaryFile()) for tag in ("way", "relation"))
+    f = open_osm(filename) if isinstance(filename, string_types) else filename
+    try:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        attrib = dict(root.attrib, generator="osm_sample")
+        header.append(("<osm%s>\n" % "".join(
+            " %s=%s" % (name, quoteattr(value)) for name, value in sorted(attrib.items())
+        )).encode("utf-8"))
+
+        for event, elem in context:
+            if event != "end":
+                continue
+            tag = elem.tag
+            if tag == "bounds":
+                header.append(_serialize(elem))
+            if tag not in TOP_LEVEL_TAGS:
+                continue
+            stats.seen[tag] += 1
+            sampler = samplers[tag]
+
+            if tag == "node":
+                data = _serialize(elem)
+                node_id = int(elem.get("id"))
+                nodes.write(NODE_HEADER.pack(node_id, len(data)))
+                nodes.write(data)
+                if method == "systematic":
+                    if sampler.take():
+                        sampled_nodes.add(node_id)
+                else:
+                    sampler.offer(lambda: node_id)
+            elif method == "systematic":
+                if sampler.take():
+                    others[tag].write(_serialize(elem))
+                    stats.sampled[tag] += 1
+                    if tag == "way":
+                        needed.update(_refs(elem))
+            else:
+                sampler.offer(lambda: (_serialize(elem), _refs(elem) if tag == "way" else None))
+            root.clear()
+    finally:
+        if f is not filename:
+            f.close()
+
+    if method == "reservoir":
+        sampled_nodes = set(node_id for _, node_id in samplers["node"].items)
+        for tag in ("way", "relation"):
+            for data, refs in samplers[tag].in_order():
+                others[tag].write(data)
+                stats.sampled[tag] += 1
+                if refs:
+                    needed.update(refs)
+    stats.sampled["node"] = len(sampled_nodes)
+
+    written = set()
+    with open(out, "wb") as fo:
+        fo.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        fo.writelines(header)
+        nodes.seek(0)
+        while True:
+            head = nodes.read(NODE_HEADER.size)
+            if not head:
+                break
+            node_id, length = NODE_HEADER.unpack(head)
+            data = nodes.read(length)
+            if node_id in sampled_nodes or node_id in needed:
+                fo.write(data)
+                written.add(node_id)
+        for tag in ("way", "relation"):
+            others[tag].seek(0)
+            while True:
+                block = others[tag].read(1024 * 1024)
+                if not block:
+                    break
+                fo.write(block)
+        fo.write(b"</osm>\n")
+    nodes.close()
+    for temp in others.values():
+        temp.close()
+
+    stats.referenced_nodes = len(written) - len(sampled_nodes & written)
+    stats.missing_nodes = len(needed - written)
+    stats.seconds = clock() - start_time
+    return stats
+
+
+class _ClusterTotals(object):
+    """ running sums over the clusters of a sample (byte ranges or
+        elements) for the ratio estimator of the key class proportions
+    """
+
+    def __init__(self):
+        self.clusters = 0
+        self.keys = 0
+        self.keys_sq = 0
+        self.classes = dict((key_type, [0, 0, 0]) for key_type in KEY_TYPES)
+
+    def add(self, key_types):
+        """ add a cluster with {key class: keys} """
+        keys = sum(key_types.values())
+        self.clusters += 1
+        self.keys += keys
+        self.keys_sq += keys * keys
+        for key_type in KEY_TYPES:
+            y = key_types.get(key_type, 0)
+            sums = self.classes[key_type]
+            sums[0] += y
+            sums[1] += y * y
+            sums[2] += y * keys
+
+
+class ApproximateAudit(object):
+    """ estimated key class proportions and counts of an OSM file, with
+        confidence intervals
+    """
+
+    def __init__(self, filename, totals, population, unit, z, elements, seconds):
+        self.filename = filename
+        self.unit = unit
+        self.sampled = totals.clusters
+        self.population = population
+        self.elements = elements
+        self.seconds = seconds
+        self.keys = totals.keys
+        self.proportions = {}
+        self.counts = {}
+
+        n = float(totals.clusters)
+        fpc = 1.0 - n / population if population else 1.0
+        for key_type in KEY_TYPES:
+            y, y_sq, y_keys = totals.classes[key_type]
+            if not totals.keys or n < 2:
+                self.proportions[key_type] = (0.0, 0.0, 1.0)
+                self.counts[key_type] = (0.0, 0.0, float("inf"))
+                continue
+            p = float(y) / totals.keys
+            # sum of (y_i - p * keys_i)^2 over the clusters
+            residual = max(y_sq - 2 * p * y_keys + p * p * totals.keys_sq, 0.0)
+            mean_keys = totals.keys / n
+            se = math.sqrt(fpc * residual / (n - 1) / n) / mean_keys
+            self.proportions[key_type] = (p, max(p - z * se, 0.0), min(p + z * se, 1.0))
+
+            count = population * y / n
+            count_se = population * math.sqrt(fpc * max(y_sq - y * y / n, 0.0) / (n - 1) / n)
+            self.counts[key_type] = (count, max(count - z * count_se, 0.0), count + z * count_se)
+
+    def __str__(self):
+        lines = ["%d of %d %s sampled (%d elements, %d keys) in %.2f seconds" % (
+            self.sampled, self.population, self.unit, self.elements, self.keys, self.seconds)]
+        lines.append("%-16s %8s %18s %12s" % ("key type", "share", "interval", "est. keys"))
+        for key_type in sorted(KEY_TYPES, key=lambda k: -self.proportions[k][0]):
+            p, low, high = self.proportions[key_type]
+            lines.append("%-16s %7.2f%% [%6.2f%%, %6.2f%%] %12.0f" % (
+                key_type, 100 * p, 100 * low, 100 * high, self.counts[key_type][0]))
+        return "\n".join(lines)
+
+
+def approximate_audit(filename, rate=0.01, seed=None, z=Z_95, chunks=2000):
+    """ estimate the key class proportions of audit_map() from a sample
+        and return an ApproximateAudit; z = 1.96 gives 95% intervals
+
+        An uncompressed file is split into `chunks` byte ranges and a
+        `rate` share of them is parsed (cluster sampling). Compressed files
+        cannot be read from the middle, so they are parsed in full and the
+        keys of a random `rate` share of the elements are classified (a
+        systematic sample would be biased by any period in the file).
+    """
+    if not 0 < rate <= 1:
+        raise ValueError("rate must be above 0 and at most 1, not %r" % (rate,))
+    rng = random.Random(seed)
+    totals = _ClusterTotals()
+    start_time = clock()
+    elements = 0
+
+    if isinstance(filename, string_types) and not is_compressed(filename):
+        unit = "byte ranges"
+        _, ranges = split_ranges(filename, chunks=chunks)
+        population = len(ranges)
+        sample = sorted(rng.sample(ranges, max(2, int(math.ceil(rate * population)))
+                                   if population >= 2 else population))
+        for start, end in sample:
+            reader = RangeReader(filename, start, end)
+            try:
+                report = audit_map(reader)
+            finally:
+                reader.close()
+            totals.add(report.key_types)
+            elements += sum(report.tags[tag] for tag in TOP_LEVEL_TAGS)
+    else:
+        unit = "elements"
+        population = 0
+        f = open_osm(filename) if isinstance(filename, string_types) else filename
+        try:
+            context = ET.iterparse(f, events=("start", "end"))
+            _, root = next(context)
+            for event, elem in context:
+                if event != "end" or elem.tag not in TOP_LEVEL_TAGS:
+                    continue
+                population += 1
+                if rng.random() < rate:
+                    key_types = {}
+                    for tag in elem.iter("tag"):
+                        key = tag.get("k")
+                        if key:
+                            key_type = classify_key(key)
+                            key_types[key_type] = key_types.get(key_type, 0) + 1
+                    totals.add(key_types)
+                    elements += 1
+                root.clear()
+        finally:
+            if f is not filename:
+                f.close()
+
+    return ApproximateAudit(filename, totals, population, unit, z, elements,
+                            clock() - start_time)
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else "data/singapore.osm"
+    print(approximate_audit(filename, rate=float(sys.argv[2]) if len(sys.argv) > 2 else 0.05))
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+"""
+    The cleaning rules of the wrangling script and shape_element(), which
+    turns an OSM <node> or <way> into the document loaded into MongoDB.
+
+    They live in a module of their own so the benchmarks (osm_bench.py),
+    the tests and the worker processes of osm_parallel.py can import them
+    without running the whole analysis:
+
+    from osm_shape import shape_element
+    for doc in shape_map("data/singapore.osm", shape_element):
+        ...
+
+    The cleaners are memoized (see osm_cache.py) and the values they
+    cannot clean are collected in `exceptions`; `rules` is the TagRules
+    table shape_element() applies to every <tag>. In the worker processes
+    of parallel_shape(), collect_stats() and merge_stats() carry those
+    counts back to the main process:
+
+    parallel_shape(filename, shape_element, collect=collect_stats, merge=merge_stats)
+"""
+
+import re
+
+from osm_audit import problemchars
+from osm_cache import ExceptionReport, memoize
+from tag_rules import TagRules, compile_mapping
+
+
+phone_re = re.compile(r'(60|65|\+60|\+65)?\D?(\d{4})\D?(\d{4})', re.IGNORECASE)
+housenumber_re = re.compile(r'(\d+[a-z]?|#?\d{2}-\d{2}|blk \d+)', re.IGNORECASE)
+postcode_re = re.compile(r'^\d{6}$')
+
+# the attributes kept in the 'created' field of a document
+CREATED = ["version", "changeset", "timestamp", "user", "uid"]
+
+# expected content of an address element
+expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road",
+            "Trail", "Parkway", "Commons", "Way", "Walk", "View", "Valley", "Green", "Crescent",
+            "Terrace", "road"]
+
+# unstandardized street name abbreviations and what they stand for
+mapping = {"Ave": "Avenue",
+           "Rd.": "Road",
+           "Rd": "Road",
+           "Jl.": "Jalan ",
+           "Jl": "Jalan",
+           "Jln": "Jalan",
+           "Btk": "Butik",
+           "Upp": "Upper"}
+
+CACHE_SIZE = 100000
+
+exceptions = ExceptionReport()
+
+# substitutes every whole-word 'mapping' key with its value
+substitute_mapping = compile_mapping(mapping)
+
+
+@memoize(CACHE_SIZE)
+def cleanName(name):
+    """ name with the abbreviations of `mapping` spelled out """
+    return substitute_mapping(name)
+
+
+@memoize(CACHE_SIZE)
+def cleanPhoneNumber(phone_number):
+    """ phone number with the +65 country code, or None when it is not
+        one
+    """
+    if not phone_number:
+        return
+
+    phone_number = phone_number.replace(" ", "")
+    phone_number = phone_number.replace("-", "")
+    if len(phone_number) == 8:
+        phone_number = "+65" + phone_number
+
+    m = phone_re.search(phone_number)
+    if not m:
+        exceptions.add("phone Number", phone_number)
+        return None
+    else:
+        return m.group()
+
+
+@memoize(CACHE_SIZE)
+def cleanHouseNumber(house_number):
+    """ the block or unit number of a house number, or None """
+    if not house_number:
+        return
+
+    m = housenumber_re.search(house_number)
+    if not m:
+        exceptions.add("House Number", house_number)
+        return None
+    else:
+        return m.group()
+
+
+@memoize(CACHE_SIZE)
+def cleanPostCode(postcode):
+    """ a 6 digit postal code, or None """
+    if not postcode:
+        return None
+
+    m = postcode_re.search(postcode.strip())
+    if not m:
+        exceptions.add("postcode", postcode)
+        return None
+    else:
+        return m.group()
+
+
+rules = TagRules(skip=problemchars)
+
+# excluding areas belonging to Malaysia or Indonesia
+rules.reject("addr:city", unless="Singapore")
+rules.reject("is_in:country", unless="Singapore")
+rules.reject("addr:country", unless="SG")
+
+# cleaners for the value of 'k' attributes
+rules.cleaner("addr:street", cleanName)
+rules.cleaner("name", cleanName)
+rules.cleaner("phone", cleanPhoneNumber)
+rules.cleaner("addr:housenumber", cleanHouseNumber)
+rules.cleaner("addr:postcode", cleanPostCode)
+
+# where the value of 'k' attributes goes in the document
+rules.place("name:", into="names", prefix=True)  # names in other languages: zh, ms, en, in
+rules.place("alt_name:", into="names", field="alt", prefix=True)  # alternate name of an amenity
+rules.place("name", cleaned=True)  # name of an amenity
+rules.place("addr:", into="address", prefix=True, cleaned=True)  # address tag
+
+
+CLEANERS = (cleanName, cleanPhoneNumber, cleanHouseNumber, cleanPostCode)
+
+
+def collect_stats():
+    """ the exceptions, cache counters and rule hits of this process
+        since the last call, which are reset
+    """
+    stats = {"exceptions": [(kind, exceptions.values(kind)) for kind in exceptions.kinds()],
+             "caches": [(cleaner.cache.hits, cleaner.cache.misses, cleaner.cache.evictions)
+                        for cleaner in CLEANERS],
+             "hits": dict(rules.hits),
+             "seconds": dict(rules.seconds)}
+    exceptions.clear()
+    for cleaner in CLEANERS:
+        cleaner.cache.hits = cleaner.cache.misses = cleaner.cache.evictions = 0
+    rules.hits.clear()
+    rules.seconds.clear()
+    return stats
+
+
+def merge_stats(stats):
+    """ add the counts of collect_stats() in another process to those of
+        this one
+    """
+    for kind, values in stats["exceptions"]:
+        for value in values:
+            exceptions.add(kind, value)
+    for cleaner, (hits, misses, evictions) in zip(CLEANERS, stats["caches"]):
+        cleaner.cache.hits += hits
+        cleaner.cache.misses += misses
+        cleaner.cache.evictions += evictions
+    for name, hits in stats["hits"].items():
+        rules.hits[name] += hits
+    for name, seconds in stats["seconds"].items():
+        rules.seconds[name] += seconds
+
+
+def cleanValue(tag):
+    """ the value of a <tag> cleaned by the cleaner of its key """
+    return rules.clean(tag.attrib['k'], tag.attrib['v'])
+
+
+def inSingapore(tag):
+    """ False for a <tag> placing its element outside Singapore """
+    return not rules.rejects(tag.get('k'), tag.get('v'))
+
+
+def shape_element(element):
+    """ the document of a <node> or <way>, or None for other elements and
+        for elements outside Singapore
+    """
+    node = {}
+    if element.tag == "node" or element.tag == "way":
+        node['id'] = element.get('id')
+        node['type'] = element.tag
+        node['visible'] = "true"
+        node['names'] = {}
+        node['address'] = {}
+        node['node_refs'] = []
+        node['created'] = {}
+
+        # get the element based on the key in CREATED dict
+        for c in CREATED:
+            node['created'][c] = element.get(c)
+
+        # get the lat and long position
+        if element.get('lat') and element.get('lon'):
+            node['pos'] = [float(element.get('lat')), float(element.get('lon'))]
+
+        # processing 'tag' children element
+        for tag in element.iter('tag'):
+            # excluding areas belonging to Malaysia or Indonesia
+            if not rules.apply(node, tag.get('k'), tag.get('v')):
+                return None
+
+        # processing 'nd' children element under 'way' element
+        for tag in element.iter('nd'):
+            node['node_refs'].append(tag.get('ref'))
+
+        return node
+    else:
+        return None
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+"""
+    In-process spatial index over the positions of shaped OSM nodes.
+
+    Questions like "how many restaurants within 500 m of a location" need
+    a MongoDB round trip (and a geo index the script never creates).
+    GridIndex answers them in memory. It is bulk loaded from the `pos`
+    field of the shaped documents: the points are sorted by grid cell
+    into flat arrays, so each cell is one contiguous slice.
+
+    index = GridIndex.from_documents(docs)
+    index.within_radius(1.2834, 103.8607, 500, tag=("amenity", "restaurant"))
+    index.within_bbox(1.28, 103.85, 1.29, 103.86)
+    index.nearest(1.2834, 103.8607, k=5, tag="amenity=restaurant")
+
+    Run this module to benchmark the index against a linear scan:
+
+    python osm_spatial.py 1000000
+"""
+
+import array
+import heapq
+import math
+import random
+import sys
+from bisect import bisect_left
+
+from osm_utils import EARTH_RADIUS_M, INT64, clock, haversine_m
+
+
+METRES_PER_DEGREE = math.radians(EARTH_RADIUS_M)
+# widens the search boxes to cover the curvature haversine_m() sees
+SLACK = 1.01
+
+# tag keys indexed for filtered queries
+TAG_KEYS = ("amenity", "shop", "cuisine", "religion", "leisure", "tourism",
+            "public_transport", "railway", "highway")
+
+
+def _tag_name(tag):
+    """ 'key=value' for a ('key', 'value') pair or a 'key=value' string """
+    if isinstance(tag, tuple):
+        return "%s=%s" % tag
+    return tag
+
+
+class GridIndex(object):
+    """ static grid of points with `cell_deg` degree square cells """
+
+    def __init__(self, points, cell_deg=0.005, tag_keys=TAG_KEYS):
+        """ bulk load from an iterable of (id, lat, lon, tags) """
+        self.cell_deg = cell_deg
+        loaded = []
+        for point_id, lat, lon, tags in points:
+            names = tuple(_tag_name((key, tags[key])) for key in tag_keys
+                          if tags.get(key) is not None)
+            loaded.append((self._cell(lat, lon), lat, lon, int(point_id), names))
+        loaded.sort(key=lambda point: point[0])
+
+        self.lats = array.array('d', (point[1] for point in loaded))
+        self.lons = array.array('d', (point[2] for point in loaded))
+        self.ids = array.array(INT64, (point[3] for point in loaded))
+        self.cells = {}
+        self.tags = tags = {}
+        for i, point in enumerate(loaded):
+            start, _ = self.cells.get(point[0], (i, i))
+            self.cells[point[0]] = (start, i + 1)
+            for name in point[4]:
+                # not setdefault(), which would build an array for every point
+                if name not in tags:
+                    tags[name] = array.array('i')
+                tags[name].append(i)
+
+        # a degree of longitude is shortest at the latitude furthest from
+        # the equator, so boxes sized with it never miss a point
+        max_lat = max([0.0] + [abs(point[1]) for point in loaded])
+        self._lon_scale = math.cos(math.radians(min(max_lat + cell_deg, 89.0)))
+        rows = [row for row, _ in self.cells] or [0]
+        cols = [col for _, col in self.cells] or [0]
+        self._bounds = (min(rows), min(cols), max(rows), max(cols))
+
+    @classmethod
+    def from_documents(cls, docs, cell_deg=0.005, tag_keys=TAG_KEYS):
+        """ index every shaped document that has a `pos` """
+        return cls(((doc["id"], doc["pos"][0], doc["pos"][1], doc)
+                    for doc in docs if doc.get("pos")),
+                   cell_deg=cell_deg, tag_keys=tag_keys)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_deg)),
+                int(math.floor(lon / self.cell_deg)))
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon, tag):
+        """ positions of the points in the cells overlapping a box """
+        if tag is not None:
+            tagged = self.tags.get(_tag_name(tag))
+            if tagged is None:
+                return
+        row0, col0 = self._cell(min_lat, min_lon)
+        row1, col1 = self._cell(max_lat, max_lon)
+
+        if tag is not None and len(tagged) < (row1 - row0 + 1) * (col1 - col0 + 1):
+            # fewer tagged points than cells: scanning them is cheaper
+            for i in tagged:
+                yield i
+            return
+
+        cells = self.cells
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                span = cells.get((row, col))
+                if span is None:
+                    continue
+                if tag is None:
+                    for i in range(span[0], span[1]):
+                        yield i
+                else:
+                    # tagged positions are sorted, so the cell is a slice
+                    first = bisect_left(tagged, span[0])
+                    last = bisect_left(tagged, span[1])
+                    for j in range(first, last):
+                        yield tagged[j]
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon, tag=None):
+        """ ids of the points inside a box, optionally only those with
+            `tag`, a ('key', 'value') pair or 'key=value'
+        """
+        lats, lons, ids = self.lats, self.lons, self.ids
+        return [ids[i] for i in self._candidates(min_lat, min_lon, max_lat, max_lon, tag)
+                if min_lat <= lats[i] <= max_lat and min_lon <= lons[i] <= max_lon]
+
+    def within_radius(self, lat, lon, radius_m, tag=None):
+        """ (distance in metres, id) of the points within `radius_m` of a
+            location, nearest first
+        """
+        dlat = SLACK * radius_m / METRES_PER_DEGREE
+        dlon = SLACK * radius_m / (METRES_PER_DEGREE * self._lon_scale)
+        lats, lons, ids = self.lats, self.lons, self.ids
+        found = []
+        for i in self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon, tag):
+            if abs(lats[i] - lat) > dlat:
+                continue
+            distance = haversine_m(lat, lon, lats[i], lons[i])
+            if distance <= radius_m:
+                found.append((distance, ids[i]))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k=1, tag=None):
+        """ (distance in metres, id) of the `k` points nearest to a
+            location, nearest first
+        """
+        lats, lons, ids = self.lats, self.lons, self.ids
+        if tag is not None:
+            tagged = self.tags.get(_tag_name(tag), ())
+            if len(tagged) <= 4 * k or len(tagged) < len(self.cells):
+                return heapq.nsmallest(k, ((haversine_m(lat, lon, lats[i], lons[i]), ids[i])
+                                           for i in tagged))
+
+        # search rings of cells around the location until the next ring
+        # cannot hold anything nearer than the k-th best so far
+        if not self.cells:
+            return []
+        cell_m = self.cell_deg * METRES_PER_DEGREE * self._lon_scale / SLACK
+        row0, col0 = self._cell(lat, lon)
+        min_row, min_col, max_row, max_col = self._bounds
+        max_ring = max(abs(row0 - min_row), abs(row0 - max_row),
+                       abs(col0 - min_col), abs(col0 - max_col))
+        best = []
+        for ring in range(max_ring + 1):
+            if len(best) == k and -best[0][0] <= (ring - 1) * cell_m:
+                break
+            box = (row0 - ring, col0 - ring, row0 + ring, col0 + ring)
+            for row in range(box[0], box[2] + 1):
+                step = 1 if row in (box[0], box[2]) else box[3] - box[1]
+                for col in range(box[1], box[3] + 1, max(step, 1)):
+                    span = self.cells.get((row, col))
+                    if span is None:
+                        continue
+                    for i in self._filter(span, tag):
+                        distance = haversine_m(lat, lon, lats[i], lons[i])
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, -ids[i]))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, -ids[i]))
+        return sorted((-distance, -point_id) for distance, point_id in best)
+
+    def _filter(self, span, tag):
+        if tag is None:
+            return range(span[0], span[1])
+        tagged = self.tags.get(_tag_name(tag), ())
+        return [tagged[j] for j in range(bisect_left(tagged, span[0]),
+                                         bisect_left(tagged, span[1]))]
+
+
+def linear_within_radius(points, lat, lon, radius_m, tag=None):
+    """ within_radius() by scanning every (id, lat, lon, tags) point """
+    tag = _tag_name(tag) if tag is not None else None
+    found = []
+    for point_id, plat, plon, tags in points:
+        if tag is not None and tag not in tags:
+            continue
+        distance = haversine_m(lat, lon, plat, plon)
+        if distance <= radius_m:
+            found.append((distance, point_id))
+    found.sort()
+    return found
+
+
+def benchmark(n=1000000, queries=100, radius_m=500, k=10, seed=0):
+    """ time GridIndex against a linear scan over `n` random points in
+        Singapore, 2% of them restaurants, and check both agree
+    """
+    rng = random.Random(seed)
+    points = []
+    for point_id in range(n):
+        tags = {"amenity": "restaurant"} if rng.random() < 0.02 else {}
+        points.append((point_id, rng.uniform(1.16, 1.47), rng.uniform(103.6, 104.05), tags))
+    targets = [(rng.uniform(1.25, 1.40), rng.uniform(103.7, 103.95)) for _ in range(queries)]
+    scan_points = [(point_id, lat, lon, set(_tag_name(item) for item in tags.items()))
+                   for point_id, lat, lon, tags in points]
+
+    start_time = clock()
+    index = GridIndex(points)
+    print("built index of %d points in %.2f seconds" % (len(index), clock() - start_time))
+
+    for tag in (None, ("amenity", "restaurant")):
+        start_time = clock()
+        indexed = [index.within_radius(lat, lon, radius_m, tag) for lat, lon in targets]
+        indexed_seconds = clock() - start_time
+        start_time = clock()
+        scanned = [linear_within_radius(scan_points, lat, lon, radius_m, tag)
+                   for lat, lon in targets[:max(1, queries // 10)]]
+        scan_seconds = (clock() - start_time) * len(targets) / len(scanned)
+        assert indexed[:len(scanned)] == scanned
+        print("radius %dm, tag %s: index %.3f ms/query, linear scan %.1f ms/query"
+              % (radius_m, tag, 1000 * indexed_seconds / queries, 1000 * scan_seconds / queries))
+
+    start_time = clock()
+    nearest = [index.nearest(lat, lon, k, ("amenity", "restaurant")) for lat, lon in targets]
+    indexed_seconds = clock() - start_time
+    start_time = clock()
+    scanned = [heapq.nsmallest(k, ((haversine_m(lat, lon, plat, plon), point_id)
+                                   for point_id, plat, plon, tags in scan_points
+                                   if "amenity=restaurant" in tags))
+               for lat, lon in targets[:max(1, queries // 10)]]
+    scan_seconds = (clock() - start_time) * len(targets) / len(scanned)
+    assert nearest[:len(scanned)] == scanned
+    print("%d nearest restaurants: index %.3f ms/query, linear scan %.1f ms/query"
+          % (k, 1000 * indexed_seconds / queries, 1000 * scan_seconds / queries))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""
+    Pre-aggregated summaries of the singaporeOSM collection.
+
+    Every Section III query scans the whole collection. Summaries keeps
+    the counts those queries compute -- documents per type, per
+    created.user, per amenity, per religion of the places of worship and
+    per cuisine of the restaurants -- and is updated document by document
+    while process_map() loads the data and apply_changes() applies a
+    delta, so the answers are ready without another pass:
+
+    summaries = Summaries()
+    for doc in docs:
+        summaries.add(doc)
+    summaries.save("data/singapore.osm.summaries.json")
+    summaries.top("amenity", 10)    -> [{"_id": "restaurant", "count": 2630}, ...]
+
+    The results have the same shape as the aggregation pipelines of
+    Section III. Summaries are stored as one document per counter, with
+    the counts as [value, count] pairs because user names can contain
+    dots and values can be null.
+"""
+
+import json
+from collections import Counter
+
+
+EXISTS = object()
+
+# counter name, field counted, condition on the document
+COUNTERS = (
+    ("type", "type", None),
+    ("created.user", "created.user", None),
+    ("amenity", "amenity", ("amenity", EXISTS)),
+    ("religion", "religion", ("amenity", "place_of_worship")),
+    ("cuisine", "cuisine", ("amenity", "restaurant")),
+)
+
+# fields of a stored document that the counters need
+FIELDS = ("type", "created.user", "amenity", "religion", "cuisine")
+
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class Summaries(object):
+    """ counters of the Section III queries """
+
+    def __init__(self):
+        self.documents = 0
+        self.counters = dict((name, Counter()) for name, _, _ in COUNTERS)
+
+    def _update(self, doc, step):
+        self.documents += step
+        for name, field, condition in COUNTERS:
+            if condition is not None:
+                key, expected = condition
+                if expected is EXISTS:
+                    if key not in doc:
+                        continue
+                elif doc.get(key) != expected:
+                    continue
+            counter = self.counters[name]
+            value = _get(doc, field)
+            counter[value] += step
+            if counter[value] <= 0:
+                del counter[value]
+
+    def add(self, doc):
+        self._update(doc, 1)
+
+    def remove(self, doc):
+        """ undo add() of a document that is deleted or replaced """
+        self._update(doc, -1)
+
+    def count(self, name, value):
+        return self.counters[name][value]
+
+    def distinct(self, name):
+        return len(self.counters[name])
+
+    def top(self, name, k=None):
+        """ [{'_id': value, 'count': n}] by descending count, like a
+            $group / $sort / $limit pipeline
+        """
+        return [{"_id": value, "count": count}
+                for value, count in self.counters[name].most_common(k)]
+
+    def users_by_posts(self):
+        """ [{'_id': posts, 'num_users': users}] by ascending number of
+            posts
+        """
+        users = Counter(self.counters["created.user"].values())
+        return [{"_id": posts, "num_users": users[posts]} for posts in sorted(users)]
+
+    def to_documents(self):
+        docs = [{"_id": "documents", "count": self.documents}]
+        for name, _, _ in COUNTERS:
+            docs.append({"_id": name,
+                         "counts": [[value, count] for value, count
+                                    in self.counters[name].items()]})
+        return docs
+
+    @classmethod
+    def from_documents(cls, docs):
+        summaries = cls()
+        for doc in docs:
+            if doc["_id"] == "documents":
+                summaries.documents = doc["count"]
+            elif doc["_id"] in summaries.counters:
+                summaries.counters[doc["_id"]].update(
+                    dict((value, count) for value, count in doc["counts"]))
+        return summaries
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_documents(), f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_documents(json.load(f))
+
+    def save_to(self, collection):
+        """ replace the summary documents of a collection """
+        collection.delete_many({})
+        collection.insert_many(self.to_documents())
+
+    @classmethod
+    def load_from(cls, collection):
+        return cls.from_documents(collection.find())
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+"""
+    Small helpers shared by the OSM wrangling modules.
+
+    iter_elements() streams the top-level elements (node, way, relation)
+    of an OSM XML file and clears each one once the caller is done with
+    it, so memory stays flat however large the extract is.
+
+    open_osm() opens an OSM file for parsing. Extracts are distributed as
+    singapore.osm.bz2, so .bz2 and .gz files are read directly: they are
+    decompressed on a background thread into a bounded buffer, and the
+    decompression overlaps with the parsing instead of needing a
+    separate pass and a decompressed copy on disk.
+
+    MemorySampler and clock are used to report throughput and peak
+    memory for a run; haversine_m() is the distance used by the spatial
+    modules.
+"""
+
+import array
+import bz2
+import math
+import mmap
+import sys
+import threading
+import time
+import zlib
+import xml.etree.cElementTree as ET
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+TOP_LEVEL_TAGS = ("node", "way", "relation")
+
+COMPRESSED_SUFFIXES = (".bz2", ".gz")
+
+# perf_counter is Python 3 only
+clock = getattr(time, "perf_counter", time.time)
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def _int64_typecode():
+    # array has no 'q' typecode before Python 3.3
+    for typecode in ('q', 'l'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise ValueError("no 64-bit integer array type on this platform")
+
+
+# array typecode of a 64-bit signed integer
+INT64 = _int64_typecode()
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """ great-circle distance in metres between two points in degrees """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def is_compressed(filename):
+    return filename.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+class _Failure(object):
+    """ an exception raised on the decompression thread """
+
+    def __init__(self, error):
+        self.error = error
+
+
+_EOF = object()
+
+
+class DecompressingReader(object):
+    """ read-only file object over a .bz2 or .gz file
+
+        A background thread reads `block_size` compressed bytes at a time
+        and queues the decompressed data, at most `max_blocks` blocks
+        ahead of the reader. Multi-stream bz2 files (as written by pbzip2)
+        and multi-member gzip files are read to the end.
+    """
+
+    def __init__(self, filename, block_size=1024 * 1024, max_blocks=8):
+        if filename.lower().endswith(".bz2"):
+            self._new_decompressor = bz2.BZ2Decompressor
+        else:
+            self._new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.name = filename
+        self._raw = open(filename, "rb")
+        self._block_size = block_size
+        self._queue = Queue(max_blocks)
+        self._stop = threading.Event()
+        self._block = b""
+        self._offset = 0
+        self._done = False
+        self._thread = threading.Thread(target=self._decompress,
+                                        name="decompress " + filename)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _decompress(self):
+        try:
+            decompressor = self._new_decompressor()
+            while not self._stop.is_set():
+                data = self._raw.read(self._block_size)
+                if not data:
+                    break
+                while data:
+                    try:
+                        out = decompressor.decompress(data)
+                    except EOFError:
+                        # Python 2 bz2: the previous stream ended exactly
+                        # at the end of the last block
+                        decompressor = self._new_decompressor()
+                        continue
+                    if out and not self._put(out):
+                        return
+                    # anything past the end of a stream starts the next one
+                    data = decompressor.unused_data
+                    if data:
+                        decompressor = self._new_decompressor()
+            self._put(_EOF)
+        except Exception as e:
+            self._put(_Failure(e))
+
+    def _next_block(self):
+        item = self._queue.get()
+        if item is _EOF:
+            self._done = True
+        elif isinstance(item, _Failure):
+            self._done = True
+            raise item.error
+        else:
+            self._block, self._offset = item, 0
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self._offset >= len(self._block):
+                if self._done:
+                    break
+                self._next_block()
+                continue
+            if wanted is None:
+                end = len(self._block)
+            else:
+                end = min(len(self._block), self._offset + wanted)
+                wanted -= end - self._offset
+            chunks.append(self._block[self._offset:end])
+            self._offset = end
+        return b"".join(chunks)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_osm(filename):
+    """ open an OSM file for parsing, decompressing .bz2 and .gz files on
+        the fly
+    """
+    if is_compressed(filename):
+        return DecompressingReader(filename)
+    return open(filename, "rb")
+
+
+def iter_elements(source, tags=TOP_LEVEL_TAGS):
+    """ yield every top-level element of `source` whose name is in `tags`
+
+        source can be a filename (optionally .bz2 or .gz) or an open file
+        object. The element is cleared (together with everything parsed
+        before it) as soon as the caller asks for the next one, so do not
+        keep references to it -- copy out whatever you need.
+    """
+    f = open_osm(source) if isinstance(source, string_types) else source
+    try:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event == "end" and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        if f is not source:
+            f.close()
+
+
+def current_rss_kb():
+    """ resident set size of this process in kilobytes now, or None when
+        the platform does not expose it (only Linux does, in /proc)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * mmap.PAGESIZE // 1024
+
+
+class MemorySampler(object):
+    """ peak resident set size of this process while it runs, above the
+        size at its start, sampled on a thread every `interval` seconds
+
+        with MemorySampler() as memory:
+            report = ...
+        memory.peak_kb      -> kilobytes, or None when the platform does
+                               not expose the RSS
+
+        peak_rss_kb() is the peak of the whole life of the process, so it
+        includes everything run before, e.g. an ET.parse() of the file.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start_kb = None
+        self.max_kb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def peak_kb(self):
+        if self.start_kb is None:
+            return None
+        return self.max_kb - self.start_kb
+
+    def _sample(self):
+        rss = current_rss_kb()
+        if rss is not None and rss > self.max_kb:
+            self.max_kb = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_kb = self.max_kb = current_rss_kb()
+        if self.start_kb is not None:
+            self._thread = threading.Thread(target=self._run, name="memory sampler")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+
+def peak_rss_kb():
+    """ peak resident set size of this process in kilobytes, or None when
+        the platform does not expose it
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes, Linux reports kilobytes
+        peak //= 1024
+    return peak
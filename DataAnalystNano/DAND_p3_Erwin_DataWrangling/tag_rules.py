@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+"""
+    Declarative rules for turning OSM <tag> elements into document fields.
+
+    Instead of running problemchars.search(), inSingapore(), a chain of
+    startswith() checks and the is_*() predicates for every tag, the rules
+    are registered once and compiled into a dispatch table keyed on the
+    tag key. The work for a key is done the first time it is seen; every
+    later tag with the same key costs one dict lookup:
+
+    rules = TagRules(skip=problemchars)
+    rules.reject("addr:city", unless="Singapore")
+    rules.cleaner("phone", cleanPhoneNumber)
+    rules.place("addr:", into="address", prefix=True, cleaned=True)
+
+    for tag in element.iter('tag'):
+        if not rules.apply(node, tag.get('k'), tag.get('v')):
+            return None     # rejected element
+
+    Every rule counts its hits, and cleaners are timed when `timed` is
+    set, so report() shows which cleaners cost the most. With a Profiler
+    (see osm_profile.py) the cleaners are also timed as its
+    "clean.<name>" stages:
+
+    rules.profile(profiler)
+"""
+
+import re
+from collections import defaultdict
+
+from osm_utils import clock
+
+
+# compiled table entry for keys that are dropped without a trace
+SKIP = None
+
+_WORD = re.compile(r'\w', re.UNICODE)
+
+
+def compile_mapping(mapping):
+    """ return a function replacing every whole-word occurrence of a
+        `mapping` key by its value, in a single regex pass
+
+        Longer keys are tried first, so "Jln" wins over "Jl". A key only
+        needs a word boundary on the sides where it has a word character,
+        so "Jl." also matches the "Jl." of "Jl.Sudirman".
+    """
+    def alternative(key):
+        escaped = re.escape(key)
+        if _WORD.match(key[:1]):
+            escaped = r'(?<!\w)' + escaped
+        if _WORD.match(key[-1:]):
+            escaped += r'(?!\w)'
+        return escaped
+
+    alternatives = sorted(mapping, key=len, reverse=True)
+    pattern = re.compile('(' + '|'.join(alternative(k) for k in alternatives) + ')',
+                         re.UNICODE)
+    replace = lambda m: mapping[m.group(1)]
+
+    def substitute(value):
+        return pattern.sub(replace, value)
+    return substitute
+
+
+class TagRules(object):
+    """ registry of tag rules compiled into a per-key dispatch table """
+
+    def __init__(self, skip=None, timed=False):
+        self.skip = skip
+        self.timed = timed
+        self.hits = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.profiler = None
+        self._rejects = {}
+        self._cleaners = {}
+        self._places = []
+        self._table = {}
+
+    # -- registration --------------------------------------------------
+
+    def reject(self, key, unless):
+        """ reject the whole element when `key` has a value other than
+            `unless`
+        """
+        self._rejects[key] = unless
+        self._table.clear()
+
+    def cleaner(self, key, func, name=None):
+        """ clean the values of `key` with func(value) """
+        self._cleaners[key] = (name or func.__name__, func)
+        self._table.clear()
+
+    def place(self, key, into=None, field=None, prefix=False, cleaned=False,
+              name=None):
+        """ store the value of `key` (or of every key starting with it when
+            `prefix` is set) in node[into][field], or in node[field] when
+            `into` is None
+
+            field defaults to the key, minus the prefix for prefix rules.
+            With `cleaned`, the value goes through the key's cleaner first
+            and keys without a cleaner are stored as None, just like
+            cleanValue() does.
+        """
+        self._places.append((key, prefix, into, field, cleaned,
+                             name or "place " + key + ("*" if prefix else "")))
+        self._table.clear()
+
+    def profile(self, profiler):
+        """ time the cleaners as stages of `profiler`, or stop timing
+            them when it is None
+        """
+        self.profiler = profiler
+        self._table.clear()
+
+    # -- dispatch ------------------------------------------------------
+
+    def _cleaner(self, key):
+        rule = self._cleaners.get(key)
+        if rule is None or self.profiler is None or not self.profiler.enabled:
+            return rule
+        name, func = rule
+        return (name, self.profiler.wrap("clean." + name, func))
+
+    def _compile(self, key):
+        if not key or (self.skip is not None and self.skip.search(key)):
+            return SKIP
+
+        # a leading colon is a typo for the same key without it
+        field_key = key[1:] if key.startswith(':') else key
+
+        into, field, cleaned, place_name = None, field_key, False, "place"
+        for rule_key, prefix, rule_into, rule_field, rule_cleaned, rule_name in self._places:
+            if field_key == rule_key or (prefix and field_key.startswith(rule_key)):
+                into, cleaned, place_name = rule_into, rule_cleaned, rule_name
+                if rule_field is not None:
+                    field = rule_field
+                elif prefix:
+                    field = field_key[len(rule_key):]
+                break
+
+        # resolved (and wrapped for the profiler) once per key
+        return (self._rejects.get(key), into, field, cleaned, self._cleaner(key), place_name)
+
+    def _entry(self, key):
+        try:
+            return self._table[key]
+        except KeyError:
+            entry = self._table[key] = self._compile(key)
+            return entry
+
+    def rejects(self, key, value):
+        """ True when a tag with this key and value rejects its element """
+        unless = self._rejects.get(key)
+        return unless is not None and value != unless
+
+    def clean(self, key, value):
+        """ the cleaned value of a tag, or None when the key has no cleaner
+            (or is skipped) or the cleaner rejects the value
+        """
+        entry = self._entry(key)
+        if entry is SKIP or entry[4] is None:
+            return None
+        return self._run_cleaner(entry[4], value)
+
+    def _run_cleaner(self, rule, value):
+        name, func = rule
+        self.hits[name] += 1
+        if not self.timed:
+            return func(value)
+        start_time = clock()
+        try:
+            return func(value)
+        finally:
+            self.seconds[name] += clock() - start_time
+
+    def apply(self, node, key, value):
+        """ add a tag to the document `node`; returns False when the tag
+            rejects the whole element
+        """
+        # inlined _entry(): this runs for every tag
+        try:
+            entry = self._table[key]
+        except KeyError:
+            entry = self._table[key] = self._compile(key)
+        if entry is SKIP:
+            return True
+
+        unless, into, field, cleaned, cleaner, place_name = entry
+        if unless is not None and value != unless:
+            self.hits["reject " + key] += 1
+            return False
+
+        if cleaned:
+            value = self._run_cleaner(cleaner, value) if cleaner else None
+        self.hits[place_name] += 1
+        if into is None:
+            node[field] = value
+        else:
+            node[into][field] = value
+        return True
+
+    def report(self):
+        """ (rule, hits, seconds) for every rule that fired, most
+            expensive first
+        """
+        return sorted(((name, hits, self.seconds.get(name, 0.0))
+                       for name, hits in self.hits.items()),
+                      key=lambda row: (-row[2], -row[1], row[0]))
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+"""
+    Checks that an interrupted checkpointed_load() resumes without
+    writing any element twice.
+
+    python -m unittest test_osm_checkpoint
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osm_bench import generate_osm
+from osm_checkpoint import Checkpoint, ResumableSource, checkpointed_load
+
+
+class ServerGone(Exception):
+    pass
+
+
+class ListCollection(object):
+    """ the part of a pymongo collection checkpointed_load() uses, keeping
+        every document written in a list; insert_many() fails after
+        `fail_after` calls
+    """
+
+    def __init__(self, fail_after=None):
+        self.docs = []
+        self.fail_after = fail_after
+
+    def create_index(self, keys):
+        pass
+
+    def insert_many(self, docs, ordered=True):
+        if self.fail_after is not None:
+            if not self.fail_after:
+                raise ServerGone()
+            self.fail_after -= 1
+        self.docs.extend(dict(doc) for doc in docs)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            key = (request._filter["type"], request._filter["id"])
+            self.docs = [doc for doc in self.docs if (doc["type"], doc["id"]) != key]
+            self.docs.append(dict(request._doc))
+
+
+def shape(element):
+    return {"type": element.tag, "id": element.get("id")}
+
+
+class CheckpointedLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "synthetic.osm")
+        self.path = self.filename + ".checkpoint"
+        generate_osm(self.filename, nodes=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_before_the_first_checkpoint(self):
+        expected = len(list(ResumableSource(self.filename, shape)))
+        collection = ListCollection(fail_after=3)
+        with self.assertRaises(ServerGone):
+            checkpointed_load(ResumableSource(self.filename, shape), collection,
+                              self.path, batch_size=10)
+        self.assertEqual(len(collection.docs), 30)
+
+        checkpoint = Checkpoint.load(self.path)
+        self.assertEqual((checkpoint.offset, checkpoint.id, checkpoint.documents), (0, None, 0))
+        collection.fail_after = None
+        stats = checkpointed_load(ResumableSource(self.filename, shape, checkpoint),
+                                  collection, self.path, batch_size=10)
+
+        keys = [(doc["type"], doc["id"]) for doc in collection.docs]
+        self.assertEqual(len(keys), expected)
+        self.assertEqual(len(set(keys)), expected)
+        self.assertEqual(stats.documents, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
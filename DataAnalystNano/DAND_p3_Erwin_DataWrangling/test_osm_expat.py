@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+"""
+    Checks that expat_shape_map() stays a faithful copy of shape_element().
+
+    python -m unittest test_osm_expat
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osm_bench import generate_osm
+from osm_expat import expat_shape_map
+from osm_loader import shape_map
+from osm_shape import CREATED, rules, shape_element
+
+
+class ExpatShapeMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "synthetic.osm")
+        # dirty values and addresses outside Singapore at high rates, so
+        # every cleaner and every reject rule fires
+        generate_osm(self.filename, nodes=5000, tag_density=0.5, dirty_phone_rate=0.5,
+                     dirty_postcode_rate=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_documents_as_shape_element(self):
+        expected = list(shape_map(self.filename, shape_element))
+        documents = list(expat_shape_map(self.filename, rules, CREATED))
+        self.assertTrue(any(doc["address"] for doc in expected))
+        self.assertEqual(len(documents), len(expected))
+        for doc, expected_doc in zip(documents, expected):
+            self.assertEqual(doc, expected_doc)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+
+"""
+    Checks of the grid of osm_geofence.Geofence against its exact point
+    in polygon test.
+
+    python -m unittest test_osm_geofence
+"""
+
+import random
+import unittest
+
+from osm_geofence import Geofence
+
+
+# (lon, lat) rings with edges along parallels
+L_SHAPE = [(0, 0), (1, 0), (1, 0.55), (0.5, 0.55), (0.5, 1), (0, 1)]
+SQUARE = [(0, 0), (1, 0), (1, 1), (0, 1)]
+HOLE = [(0.23, 0.31), (0.71, 0.31), (0.71, 0.67), (0.23, 0.67)]
+
+
+class GeofenceTest(unittest.TestCase):
+
+    def assertAgreesWithExact(self, fence, n=20000, seed=0):
+        rng = random.Random(seed)
+        for _ in range(n):
+            lat, lon = rng.uniform(-0.1, 1.1), rng.uniform(-0.1, 1.1)
+            self.assertEqual(fence.contains(lat, lon), fence.exact_contains(lat, lon),
+                             (lat, lon))
+
+    def test_l_shape(self):
+        fence = Geofence([L_SHAPE], grid_size=10)
+        self.assertTrue(fence.exact_contains(0.52, 0.75))
+        self.assertTrue(fence.contains(0.52, 0.75))
+        self.assertFalse(fence.contains(0.58, 0.75))
+        self.assertAgreesWithExact(fence)
+
+    def test_rectangular_hole(self):
+        for grid_size in (7, 10, 64):
+            fence = Geofence([SQUARE, HOLE], grid_size=grid_size)
+            self.assertFalse(fence.contains(0.5, 0.5))
+            self.assertTrue(fence.contains(0.1, 0.5))
+            self.assertAgreesWithExact(fence)
+
+
+if __name__ == '__main__':
+    unittest.main()
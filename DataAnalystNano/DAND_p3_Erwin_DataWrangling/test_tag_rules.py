@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+"""
+    Checks of tag_rules against the cleaning of the original script.
+
+    python -m unittest test_tag_rules
+"""
+
+import re
+import unittest
+
+from osm_profile import Profiler
+from tag_rules import TagRules, compile_mapping
+
+
+# the street name mapping of the wrangling script
+MAPPING = {"Ave": "Avenue", "Rd.": "Road", "Rd": "Road", "Jl.": "Jalan ",
+           "Jl": "Jalan", "Jln": "Jalan", "Btk": "Butik", "Upp": "Upper"}
+ORDER = ["Ave", "Rd.", "Rd", "Jl.", "Jl", "Jln", "Btk", "Upp"]
+
+
+def chained_clean_name(name):
+    """ the original cleanName(): one re.sub() per key, in the order of
+        the mapping
+    """
+    for key in ORDER:
+        name = re.sub(re.escape(key), MAPPING[key], name)
+    return name
+
+
+class CompileMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clean_name = compile_mapping(MAPPING)
+
+    def test_same_as_chained_re_sub(self):
+        for name in ("Jl.Sudirman", "Jl. Sudirman", "Jl Besar", "Upp Thomson Rd",
+                     "Jalan Btk Timah"):
+            self.assertEqual(self.clean_name(name), chained_clean_name(name), name)
+
+    def test_key_ending_in_punctuation(self):
+        self.assertEqual(self.clean_name("Jl.Sudirman"), "Jalan Sudirman")
+        self.assertEqual(self.clean_name("Rd.1"), "Road1")
+
+    def test_longest_key_first(self):
+        # the chain gives "Jalann. X", "Jl" replacing inside "Jln"
+        self.assertEqual(self.clean_name("Jln. X"), "Jalan. X")
+        self.assertEqual(self.clean_name("Jln Besar"), "Jalan Besar")
+
+    def test_keys_inside_words_are_left_alone(self):
+        self.assertEqual(self.clean_name("Avenue 3"), "Avenue 3")
+        self.assertEqual(self.clean_name("Upper Rdx"), "Upper Rdx")
+
+
+
+class CountingProfiler(Profiler):
+    """ a Profiler counting the functions it wraps """
+
+    def __init__(self):
+        super(CountingProfiler, self).__init__(enabled=True)
+        self.wrapped = 0
+
+    def wrap(self, name, func):
+        self.wrapped += 1
+        return super(CountingProfiler, self).wrap(name, func)
+
+
+class TagRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = TagRules(skip=re.compile(r'[ ]'))
+        self.rules.cleaner("addr:postcode", lambda value: value if len(value) == 6 else None,
+                           name="postcode")
+        self.rules.place("addr:", into="address", prefix=True, cleaned=True)
+
+    def test_clean(self):
+        self.assertEqual(self.rules.clean("addr:postcode", "238801"), "238801")
+        self.assertEqual(self.rules.clean("addr:postcode", "2388"), None)
+        self.assertEqual(self.rules.clean("addr:street", "Orchard Road"), None)
+        self.assertEqual(self.rules.clean("addr postcode", "238801"), None)
+        self.assertEqual(self.rules.hits["postcode"], 2)
+
+    def test_cleaner_wrapped_once_per_key(self):
+        profiler = CountingProfiler()
+        self.rules.profile(profiler)
+        node = {"address": {}}
+        for _ in range(3):
+            self.rules.apply(node, "addr:postcode", "238801")
+            self.rules.clean("addr:postcode", "238801")
+        self.assertEqual(node, {"address": {"postcode": "238801"}})
+        self.assertEqual(profiler.wrapped, 1)
+        self.assertEqual(self.rules.hits["postcode"], 6)
+        # profile() recompiles the table
+        self.rules.profile(profiler)
+        self.rules.clean("addr:postcode", "238801")
+        self.assertEqual(profiler.wrapped, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()